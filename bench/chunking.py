@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+chunking -- Benchmark and dedup check of the content defined chunking of the chunk store
+
+Splits synthetic text and incompressible binary data into chunks, then inserts one byte in the middle and splits it
+again. All chunks but the ones around the insertion have to be found again, otherwise the boundaries are not defined
+by the content. Exits with 1 if fewer chunks than --min-shared are shared.
+"""
+
+import sys
+import os
+import hashlib
+import io
+import json
+import random
+import time
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import rms
+
+
+def _data(kind, size, seed=0):
+    """
+    Create text lines or random bytes
+    :param kind: str 'text' or 'binary'
+    :param size: int
+    :param seed: int
+    :return: bytes
+    """
+    rnd = random.Random(seed)
+
+    if kind == 'binary':
+        return rnd.getrandbits(size * 8).to_bytes(size, 'little')
+
+    lines = []
+    length = 0
+    while length < size:
+        lines.append("{} {:.12f} {}\n".format(len(lines), rnd.random(), rnd.choice(["ACGT", "TTGA", "CCAG"]) * 8))
+        length += len(lines[-1])
+
+    return "".join(lines).encode('utf-8')
+
+
+def _chunks(data):
+    """
+    Split data and time it
+    :param data: bytes
+    :return: (list, float) sha1 digests of the chunks and the wall time in s
+    """
+    start = time.perf_counter()
+    digests = [hashlib.sha1(chunk).digest() for chunk in rms._iter_chunks(io.BytesIO(data))]
+
+    return digests, time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark and dedup check of the content defined chunking")
+    parser.add_argument('-s', '--size', type=int, default=64, help='Size of the data in MiB. Default = 64')
+    parser.add_argument('--min-shared', type=float, default=0.9,
+                        help='Share of the chunks which have to be found again after the insertion. Default = 0.9')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    errors = []
+
+    for kind in ('text', 'binary'):
+        data = _data(kind, args.size << 20)
+        before, wall = _chunks(data)
+        middle = len(data) // 2
+        after, _ = _chunks(data[:middle] + b'x' + data[middle:])
+        shared = len(set(before) & set(after)) / len(before)
+
+        results.append({'data': kind, 'chunks': len(before), 'mean_kb': round(len(data) / len(before) / 1024, 1),
+                        'mb_per_s': round(len(data) / 1e6 / wall, 1), 'shared': round(shared, 3)})
+        if shared < args.min_shared:
+            errors.append("only {:.1%} of the chunks of the {} data are shared after an insertion".format(shared, kind))
+
+    if args.json:
+        json.dump({'results': results, 'errors': errors}, sys.stdout, indent=2)
+        print()
+    else:
+        print("{:<8} {:>8} {:>10} {:>8} {:>8}".format("data", "chunks", "mean KiB", "MB/s", "shared"))
+        for r in results:
+            print("{:<8} {:>8} {:>10.1f} {:>8.1f} {:>8.1%}".format(r['data'], r['chunks'], r['mean_kb'], r['mb_per_s'],
+                                                                r['shared']))
+        for error in errors:
+            print(error)
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+hashing -- Benchmark of hashing and copying uncompressed files into the repository
+
+Compares the memory mapped one pass hash and copy of rms with chunked reads and with reading the whole file at
+once for files of several sizes. Each run is a fresh process so its peak RSS can be reported. The files are
+hashed right after they are written, so the numbers are for a warm page cache unless the file is larger than
+the memory. Set TMPDIR to a directory on the file system of interest.
+
+    bench/hashing.py -s 1M -s 64M -s 1G -s 50G
+"""
+
+import sys
+import os
+import json
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import rms
+
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def _size(text):
+    """
+    Parse a size like 64M
+    :param text: str
+    :return: int
+    """
+    if text[-1].upper() in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1].upper()])
+    return int(text)
+
+
+def _hash_mmap(src, dst):
+    import hashlib
+
+    sha1 = hashlib.sha1()
+    with open(src, 'rb') as f_r, open(dst, 'wb') as f_w:
+        if not rms._hash_mapped(f_r, sha1, f_w):
+            raise RuntimeError("{} can not be mapped".format(src))
+    return sha1.hexdigest()
+
+
+def _hash_chunked(src, dst):
+    import hashlib
+
+    sha1 = hashlib.sha1()
+    with open(src, 'rb') as f_r, open(dst, 'wb') as f_w:
+        for chunk in iter(lambda: f_r.read(rms.CHUNK_SIZE), b''):
+            sha1.update(chunk)
+            f_w.write(chunk)
+    return sha1.hexdigest()
+
+
+def _hash_whole(src, dst):
+    import hashlib
+
+    with open(src, 'rb') as f_r:
+        sha1 = hashlib.sha1(f_r.read()).hexdigest()
+    shutil.copy2(src, dst)
+    return sha1
+
+
+METHODS = {'mmap': _hash_mmap, 'chunked': _hash_chunked, 'whole': _hash_whole}
+
+
+def _worker(method, src, dst):
+    """
+    Run one method in this process and print its wall time and peak RSS as JSON
+    :return: int
+    """
+    start = time.perf_counter()
+    sha1 = METHODS[method](src, dst)
+    wall = time.perf_counter() - start
+
+    json.dump({'seconds': wall, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'sha1': sha1},
+              sys.stdout)
+    return 0
+
+
+def _make_file(path, size):
+    """
+    Write size bytes of incompressible data
+    :param path: str
+    :param size: int
+    :return: None
+    """
+    block = os.urandom(min(size, 64 << 20))
+
+    with open(path, 'wb') as f_w:
+        written = 0
+        while written < size:
+            n = min(len(block), size - written)
+            f_w.write(block[:n])
+            written += n
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == '--worker':
+        return _worker(*sys.argv[2:])
+
+    parser = ArgumentParser(description="Benchmark of hashing and copying uncompressed files")
+    parser.add_argument('-s', '--size', type=str, action='append',
+                        help='File size like 1M or 50G. Can be repeated. Default = 1M, 64M and 512M')
+    parser.add_argument('-m', '--method', choices=sorted(METHODS), action='append',
+                        help='Method to run. Can be repeated. Default = all')
+    parser.add_argument('--whole-limit', type=str, default='2G',
+                        help='Do not read files larger than this at once. Default = 2G')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    sizes = [_size(s) for s in args.size or ['1M', '64M', '512M']]
+    methods = args.method or ['chunked', 'mmap', 'whole']
+    tmp = tempfile.mkdtemp(prefix="rms-hashing-")
+    results = []
+
+    try:
+        for size in sizes:
+            src = os.path.join(tmp, "src")
+            dst = os.path.join(tmp, "dst")
+            _make_file(src, size)
+
+            for method in methods:
+                if method == 'whole' and size > _size(args.whole_limit):
+                    continue
+                out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--worker', method, src,
+                                               dst], universal_newlines=True)
+                os.remove(dst)
+                result = json.loads(out)
+                results.append({'size': size, 'method': method, 'seconds': round(result['seconds'], 4),
+                                'mb_per_s': round(size / 1e6 / max(result['seconds'], 1e-9), 1),
+                                'max_rss_mb': round(result['max_rss_kb'] / 1024, 1)})
+
+            os.remove(src)
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print("{:>12} {:<8} {:>10} {:>10} {:>12}".format("size", "method", "seconds", "MB/s", "peak RSS MB"))
+        for r in results:
+            print("{:>12} {:<8} {:>10.3f} {:>10.1f} {:>12.1f}".format(r['size'], r['method'], r['seconds'],
+                                                                      r['mb_per_s'], r['max_rss_mb']))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+serve -- Load test of the rms HTTP interface
+
+Creates a temporary repository with plain, compressed, seekable and chunked files, starts 'rms serve' on a local
+port and runs many concurrent keep-alive clients against it for a while. The clients mix tag lookups,
+descriptions, whole downloads and byte ranges and check every downloaded byte against the original files.
+Reports the requests per second and the latencies per request kind. Exits with 1 if a response was wrong.
+"""
+
+import sys
+import os
+import asyncio
+import json
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+RMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "rms")
+
+sys.path.insert(0, os.path.dirname(RMS))
+
+import rms
+
+
+def _setup(tmp, files, size):
+    """
+    Create a repository with files of each storage kind
+    :param tmp: str
+    :param files: int number of files per kind
+    :param size: int size of each file in bytes
+    :return: (str, dict) repository path and the contents by tag
+    """
+    repo = rms.Repository.create(tmp)
+    src = os.path.join(tmp, "files")
+    os.makedirs(src)
+    rnd = random.Random(0)
+    contents = dict()
+
+    for kind, options in [('plain', {}), ('zlib', {}), ('blocks', {'seekable': True}), ('chunks', {'chunked': True})]:
+        paths = []
+        for i in range(files):
+            name = "{}{}.{}".format(kind, i, 'bin' if kind == 'plain' else 'txt')
+            if kind == 'plain':
+                data = os.urandom(size)
+            else:
+                data = "".join("{} {} {}\n".format(kind, i, rnd.random()) for _ in range(size // 32)).encode('utf-8')
+            with open(os.path.join(src, name), 'wb') as f_w:
+                f_w.write(data)
+            contents[name] = data
+            paths.append(os.path.join(src, name))
+        repo.add(paths, "Load test {}".format(kind), **options)
+
+    return repo.path, contents
+
+
+def _free_port():
+    """
+    Returns a free local TCP port
+    :return: int
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _request(reader, writer, path, headers=None):
+    """
+    Send a GET request over a keep-alive connection and read the response
+    :param reader: asyncio.StreamReader
+    :param writer: asyncio.StreamWriter
+    :param path: str
+    :param headers: dict
+    :return: (int, dict, bytes) status, headers and body
+    """
+    lines = ["GET {} HTTP/1.1".format(path), "Host: localhost"]
+    lines += ["{}: {}".format(k, v) for k, v in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    head = (await reader.readuntil(b"\r\n\r\n")).decode('latin-1').split("\r\n")
+    response = dict()
+    for line in head[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            response[key.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(response.get('content-length', 0)))
+
+    return int(head[0].split(" ")[1]), response, body
+
+
+async def _client(port, contents, deadline, seed, stats, errors):
+    """
+    Run requests over one connection until the deadline
+    :param port: int
+    :param contents: dict contents by tag
+    :param deadline: float
+    :param seed: int
+    :param stats: dict lists of latencies by request kind
+    :param errors: list
+    :return: None
+    """
+    rnd = random.Random(seed)
+    tags = sorted(contents)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    try:
+        while time.perf_counter() < deadline:
+            tag = rnd.choice(tags)
+            data = contents[tag]
+            kind = rnd.choice(['tag', 'desc', 'blob', 'range', 'range'])
+            headers = None
+            expected = None
+
+            if kind == 'tag':
+                path = "/tags/" + tag
+            elif kind == 'desc':
+                path = "/desc/" + tag
+            else:
+                path = "/blob/" + tag
+                expected = data
+                if kind == 'range':
+                    start = rnd.randrange(len(data))
+                    end = min(len(data), start + rnd.randrange(1, 64 * 1024))
+                    headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+                    expected = data[start:end]
+
+            start_time = time.perf_counter()
+            status, response, body = await _request(reader, writer, path, headers)
+            stats[kind].append(time.perf_counter() - start_time)
+
+            if status not in (200, 206):
+                errors.append("{} returned {}".format(path, status))
+            elif expected is not None and body != expected:
+                errors.append("{} {} returned wrong content".format(path, headers))
+            elif kind == 'tag' and json.loads(body.decode('utf-8'))['size'] != len(data):
+                errors.append("{} reports a wrong size".format(path))
+    finally:
+        writer.close()
+
+
+async def _load(port, contents, clients, duration):
+    """
+    Run the clients concurrently
+    :return: (dict, list) latencies in s by request kind and errors
+    """
+    stats = {kind: [] for kind in ['tag', 'desc', 'blob', 'range']}
+    errors = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[_client(port, contents, deadline, i, stats, errors) for i in range(clients)])
+
+    return stats, errors
+
+
+def main():
+    parser = ArgumentParser(description="Load test of the rms HTTP interface")
+    parser.add_argument('-c', '--clients', type=int, default=50, help='Concurrent connections. Default = 50')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds of load. Default = 10')
+    parser.add_argument('-n', '--files', type=int, default=10, help='Files per storage kind. Default = 10')
+    parser.add_argument('-s', '--size', type=int, default=2 * 1024 * 1024,
+                        help='Size of each file in bytes. Default = 2 MiB')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="rms-serve-")
+    server = None
+
+    try:
+        path, contents = _setup(tmp, args.files, args.size)
+        port = _free_port()
+        server = subprocess.Popen([sys.executable, RMS, "serve", "--port", str(port)], env=dict(os.environ, RMS=path),
+                                  stderr=subprocess.DEVNULL)
+
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+        stats, errors = asyncio.run(_load(port, contents, args.clients, args.duration))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp)
+
+    results = {'clients': args.clients, 'duration_s': args.duration, 'errors': len(errors),
+               'requests_per_s': round(sum(len(t) for t in stats.values()) / args.duration, 1), 'kinds': {}}
+    for kind, times in stats.items():
+        times.sort()
+        if times:
+            results['kinds'][kind] = {'requests': len(times),
+                                      'p50_ms': round(times[len(times) // 2] * 1000, 2),
+                                      'p99_ms': round(times[min(len(times) - 1, len(times) * 99 // 100)] * 1000, 2)}
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for error in errors[:10]:
+            print(error)
+        print("{} clients: {} requests/s, {} errors".format(args.clients, results['requests_per_s'], len(errors)))
+        print("{:<8} {:>9} {:>9} {:>9}".format("kind", "requests", "p50 ms", "p99 ms"))
+        for kind, r in results['kinds'].items():
+            print("{:<8} {:>9} {:>9.2f} {:>9.2f}".format(kind, r['requests'], r['p50_ms'], r['p99_ms']))
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+startup -- Cold start benchmark of the rms subcommands
+
+Runs each subcommand with 'python -X importtime' against a small temporary repository and reports the wall time
+and the import time. Fails if a subcommand imports a module it does not need or is slower than the budget.
+
+Runs the stub src/rms like the installed command, so rms.py is loaded from its cached bytecode.
+"""
+
+import sys
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+RMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "rms")
+
+# Modules only some subcommands need
+HEAVY = ['magic', 'pdfkit', 'markdown', 'concurrent.futures', 'hashlib', 'tempfile', 'sqlite3', 'lzma', 'bz2']
+
+# Subcommand arguments and the modules they must not import
+COMMANDS = [
+    ('list', ['list'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures', 'hashlib', 'tempfile', 'sqlite3']),
+    ('list json', ['list', '-f', 'json'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures', 'sqlite3']),
+    ('tag', ['tag', 'text.txt'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures', 'hashlib', 'tempfile']),
+    ('desc json', ['desc', 'text.txt', '-f', 'json'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures']),
+    ('desc get', ['desc', 'text.txt', '-g', 'Description'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures']),
+    ('cat', ['cat', 'text.txt', '-l', '100'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures', 'hashlib']),
+    ('get', ['get', 'binary.bin', '-'], ['magic', 'pdfkit', 'markdown', 'concurrent.futures', 'hashlib']),
+    ('add', ['add', '{tmp}/other.txt', 'Benchmark file'], ['pdfkit', 'markdown', 'concurrent.futures']),
+]
+
+
+def _parse_importtime(stderr):
+    """
+    Sum the cumulative import times of the top level imports and collect the names of all imported modules
+    :param stderr: str output of python -X importtime
+    :return: (float, set) import time in ms and module names
+    """
+    total = 0
+    modules = set()
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        modules.add(name.strip())
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+
+    return total / 1000, modules
+
+
+def _run(argv, env, tmp):
+    """
+    Run rms once with -X importtime
+    :param argv: list
+    :param env: dict
+    :param tmp: str
+    :return: (float, float, set) wall time in ms, import time in ms and imported modules
+    """
+    argv = [a.format(tmp=tmp) for a in argv]
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", RMS] + argv, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    wall = (time.perf_counter() - start) * 1000
+
+    if proc.returncode != 0:
+        sys.exit("rms {} failed:\n{}".format(" ".join(argv), proc.stderr))
+
+    return (wall,) + _parse_importtime(proc.stderr)
+
+
+def _setup(tmp, env):
+    """
+    Create a repository with one compressed text file and one uncompressed binary file
+    :param tmp: str
+    :param env: dict
+    :return: None
+    """
+    with open(os.path.join(tmp, "text.txt"), 'w') as f_w:
+        f_w.write("".join("line {}\n".format(i) for i in range(10000)))
+    with open(os.path.join(tmp, "binary.bin"), 'wb') as f_w:
+        f_w.write(os.urandom(1 << 20))
+
+    subprocess.check_call([sys.executable, RMS, "init", tmp], env=env, stdout=subprocess.DEVNULL)
+    subprocess.check_call([sys.executable, RMS, "add", "-j", "1", os.path.join(tmp, "text.txt"),
+                           os.path.join(tmp, "binary.bin"), "Benchmark files"], env=env, stdout=subprocess.DEVNULL)
+
+
+def main():
+    parser = ArgumentParser(description="Cold start benchmark of the rms subcommands")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per subcommand. Default = 5')
+    parser.add_argument('-b', '--budget', type=float, default=100,
+                        help='Fail if the fastest run of a subcommand takes longer than this many ms. Default = 100')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="rms-startup-")
+    env = dict(os.environ, RMS=os.path.join(tmp, ".rms"))
+    results = []
+    failed = False
+
+    try:
+        _setup(tmp, env)
+
+        for name, argv, forbidden in COMMANDS:
+            runs = []
+            for _ in range(args.repeat):
+                with open(os.path.join(tmp, "other.txt"), 'w') as f_w:
+                    f_w.write(str(time.time()))
+                runs.append(_run(argv, env, tmp))
+
+            wall, imports, modules = min(runs, key=lambda r: r[0])
+            unexpected = sorted(m for m in forbidden if m in modules)
+            too_slow = wall > args.budget
+            failed = failed or bool(unexpected) or too_slow
+
+            results.append({'command': name, 'wall_ms': round(wall, 1), 'import_ms': round(imports, 1),
+                            'heavy_imports': sorted(m for m in HEAVY if m in modules),
+                            'unexpected_imports': unexpected, 'over_budget': too_slow})
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print("{:<12} {:>9} {:>10}  {}".format("command", "wall ms", "import ms", "heavy imports"))
+        for r in results:
+            print("{:<12} {:>9.1f} {:>10.1f}  {}{}{}".format(
+                r['command'], r['wall_ms'], r['import_ms'], ", ".join(r['heavy_imports']) or "-",
+                "  UNEXPECTED: " + ", ".join(r['unexpected_imports']) if r['unexpected_imports'] else "",
+                "  OVER BUDGET" if r['over_budget'] else ""))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
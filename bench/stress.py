@@ -0,0 +1,364 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+stress -- Concurrent writers stress test of a rms repository
+
+Runs several processes adding, updating, tagging, removing and describing files of a small pool of names and contents in
+one temporary repository at once and checks the invariants of the repository afterwards:
+
+- no journal is left behind
+- every tag is a hardlink of a hash file and the tag index agrees with the tag files
+- every tagged hash file has a description listing exactly its tags and every description has a hash file
+- every hash file holds the data its name promises
+- every chunk referenced by a manifest exists and the chunk reference counts are right
+- every packed hash file holds the data its name promises and lists its packed tags in its description
+- every older version listed by a tagged file can be read and the version reference counts are right
+- the sections of the descriptions kept by the repository are not searchable
+- a hash file linked by get can not be written through the link
+- a batch of more files than the process may open descriptors can be added and verified with one and more jobs
+
+Exits with 1 if an invariant is violated.
+"""
+
+import sys
+import os
+import collections
+import hashlib
+import json
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import rms
+
+
+def _contents(n, seed):
+    """
+    Create n text contents. Larger contents share blocks so their chunks are shared in the chunk store.
+    :param n: int
+    :param seed: int
+    :return: list of bytes
+    """
+    rnd = random.Random(seed)
+    blocks = [("".join("{} {}\n".format(b, rnd.random()) for _ in range(12000))).encode('utf-8') for b in range(4)]
+    contents = []
+
+    for i in range(n):
+        if i % 2:
+            contents.append(b"".join(rnd.sample(blocks, 2)))
+        else:
+            contents.append("small file {}\n".format(i).encode('utf-8') * (i + 1))
+
+    return contents
+
+
+def _worker(path, work, worker, ops, names, contents, chunked, repack=False):
+    """
+    Run random mutations on the repository
+    :param path: str repository
+    :param work: str directory for the files to add
+    :param worker: int
+    :param ops: int
+    :param names: int size of the tag name pool
+    :param contents: list of bytes
+    :param chunked: bool also add files to the chunk store
+    :param repack: bool also move files into packs
+    :return: None
+    """
+    rnd = random.Random(worker)
+    repo = rms.Repository(path)
+    work = os.path.join(work, str(worker))
+    os.makedirs(work)
+    counts = collections.Counter()
+
+    for i in range(ops):
+        op = rnd.choice(['add', 'add', 'update', 'tag', 'rm', 'desc'] + (['repack'] if repack else []))
+        name = "f{}.txt".format(rnd.randrange(names))
+        tags = [t for _, t in repo.list_tags()]
+
+        try:
+            if op == 'add':
+                file = os.path.join(work, name)
+                with open(file, 'wb') as f_w:
+                    f_w.write(rnd.choice(contents))
+                repo.add([file], "Added by worker {}".format(worker), chunked=chunked and rnd.random() < 0.25)
+            elif op == 'repack':
+                repo.repack()
+            elif not tags:
+                op = 'skip'
+            elif op == 'update':
+                file = os.path.join(work, name)
+                with open(file, 'wb') as f_w:
+                    f_w.write(rnd.choice(contents))
+                repo.update(rnd.choice(tags), file)
+            elif op == 'tag':
+                repo.add_tag(rnd.choice(tags), name)
+            elif op == 'rm':
+                repo.remove(rnd.choice(tags))
+            else:
+                repo.set_desc(rnd.choice(tags), {"Worker": worker, "Op": i})
+            counts[op] += 1
+        except rms.RepositoryError:
+            # The tag was removed by another worker meanwhile
+            counts[op + ' lost'] += 1
+
+    print("worker {}: {}".format(worker, dict(counts)), file=sys.stderr)
+
+
+def check(path):
+    """
+    Check the invariants of a repository
+    :param path: str
+    :return: list of str violations
+    """
+    repo = rms.Repository(path)
+    repo.recover()
+    errors = []
+
+    journals = os.listdir(os.path.join(path, "journal")) if os.path.isdir(os.path.join(path, "journal")) else []
+    if journals:
+        errors.append("journals left: {}".format(journals))
+
+    tags = collections.defaultdict(list)
+    for sha1, tag in repo.list_tags():
+        if sha1 is None:
+            errors.append("tag {} has no hash file".format(tag))
+        else:
+            tags[sha1].append(tag)
+
+    # The tags of packed hash files are only in the pack database
+    packs = repo._get_packs()
+    packed = dict(packs.execute("SELECT sha1, desc FROM objects")) if packs is not None else {}
+    indexed = dict(repo._get_index().execute("SELECT tag, sha1 FROM tags"))
+    for sha1, names in tags.items():
+        for tag in names:
+            if sha1 in packed and not os.path.lexists(os.path.join(path, "tags", tag)):
+                continue
+            if indexed.pop(tag, None) != sha1:
+                errors.append("tag {} is not indexed with {}".format(tag, sha1))
+    for tag in indexed:
+        errors.append("index holds removed tag {}".format(tag))
+
+    # Every indexed manifest refers to its chunks, also manifests without tags
+    refs = collections.Counter()
+    manifests = set(r[0] for r in repo._get_index().execute("SELECT sha1 FROM manifests"))
+    for sha1 in manifests:
+        for chunk_sha1, size in repo._get_manifest(sha1)['chunks']:
+            refs[chunk_sha1] += 1
+            if not os.path.exists(os.path.join(path, "chunks", chunk_sha1)):
+                errors.append("chunk {} of {} is missing".format(chunk_sha1, sha1))
+
+    orphans = 0
+
+    for sha1 in repo.hashes():
+        data = repo._data_path(sha1)
+        links = os.lstat(data).st_nlink - 1
+        json_data = repo._read_desc(sha1)
+
+        if links != len(tags.get(sha1, [])):
+            errors.append("{} has {} links but {} tags".format(sha1, links, len(tags.get(sha1, []))))
+        if not links:
+            orphans += 1
+            continue
+        if json_data is None:
+            errors.append("{} has no description".format(sha1))
+            continue
+        if sorted(json_data['tags']) != sorted(tags[sha1]):
+            errors.append("description of {} lists {} instead of {}".format(sha1, json_data['tags'], tags[sha1]))
+
+        blob = json_data.get('repo_blob', {})
+        if rms._is_chunked(json_data):
+            content = b"".join(repo._iter_range(sha1, blob))
+            if sha1 not in manifests:
+                errors.append("manifest {} is not indexed".format(sha1))
+        else:
+            with open(data, 'rb') as f_r:
+                content = f_r.read()
+            b"".join(repo._iter_range(sha1, blob))  # Decompressible
+
+        if hashlib.sha1(content).hexdigest() != sha1:
+            errors.append("content of {} does not match its name".format(sha1))
+
+    for sha1, desc in packed.items():
+        if sorted(json.loads(desc)['tags']) != sorted(tags.get(sha1, [])):
+            errors.append("packed description of {} lists {} instead of {}".format(sha1, json.loads(desc)['tags'],
+                                                                                   tags.get(sha1, [])))
+        if hashlib.sha1(repo._read_packed(sha1)).hexdigest() != sha1:
+            errors.append("packed content of {} does not match its name".format(sha1))
+
+    for entry in repo._scan("desc"):
+        if rms._is_hash_name(entry.name) and not os.path.exists(repo._data_path(entry.name)):
+            errors.append("description {} has no hash file".format(entry.name))
+
+    # The descriptions of the workers neither mention the codec nor versions
+    if repo.search(where=[('repo_blob.codec', 'zlib')]) or repo.search('zlib') or repo.search('version'):
+        errors.append("search finds files by the sections kept by the repository")
+
+    version_refs = collections.Counter()
+    for sha1, older in repo._get_index().execute("SELECT sha1, versions FROM chains"):
+        version_refs.update(json.loads(older))
+    for sha1 in tags:
+        for version in rms._older_versions(repo._read_desc(sha1) or {}, sha1):
+            if not repo._exists(version):
+                errors.append("version {} of {} is missing".format(version, sha1))
+                continue
+            blob = repo._stored_blob(version)
+            content = b"".join(repo._iter_range(version, blob))
+            if blob.get('layout') != 'chunked':
+                with repo._open_data(version) as f_r:
+                    content = f_r.read()
+            if hashlib.sha1(content).hexdigest() != version:
+                errors.append("content of version {} does not match its name".format(version))
+
+    for version, count in repo._get_index().execute("SELECT sha1, refs FROM versions WHERE refs > 0"):
+        if version_refs.pop(version, 0) != count:
+            errors.append("version {} has a wrong reference count".format(version))
+    for version in version_refs:
+        errors.append("version {} is not counted".format(version))
+
+    for chunk_sha1, count in repo._get_index().execute("SELECT sha1, refs FROM chunks WHERE refs > 0"):
+        if refs.pop(chunk_sha1, 0) != count:
+            errors.append("chunk {} has a wrong reference count".format(chunk_sha1))
+    for chunk_sha1 in refs:
+        errors.append("chunk {} is not counted".format(chunk_sha1))
+
+    print("{} tags, {} hash files, {} packed, {} without tags".format(
+        sum(len(t) for t in tags.values()), len(repo.hashes()), len(packed), orphans), file=sys.stderr)
+
+    return errors
+
+
+def check_link(path, work):
+    """
+    Add an uncompressed file, link it with get and write through the link. The hash file has to be read only and
+    keep its data. Root may write to read only files, so root only checks the mode.
+    :param path: str repository
+    :param work: str directory for the file to add
+    :return: list of str violations
+    """
+    repo = rms.Repository(path)
+    file = os.path.join(work, "linked.bin")
+    errors = []
+
+    os.makedirs(work, exist_ok=True)
+    with open(file, 'wb') as f_w:
+        f_w.write(b"\0" + os.urandom(4096))
+    sha1 = repo.add([file], "Linked file")[0].sha1
+    link = repo.get("linked.bin", os.path.join(work, "link.bin"), link=True)
+
+    if os.stat(link).st_mode & 0o222:
+        errors.append("the linked hash file {} is writable".format(sha1))
+    if os.geteuid() != 0:
+        try:
+            with open(link, 'ab') as f_w:
+                f_w.write(b"changed through the link")
+            errors.append("the linked hash file {} was written through the link".format(sha1))
+        except PermissionError:
+            pass
+
+    if rms._get_file_sha1(repo._data_path(sha1)) != sha1:
+        errors.append("content of the linked {} does not match its name".format(sha1))
+
+    return errors
+
+
+def _add_batch(path, work, jobs, files):
+    """
+    Add and verify a batch of new files with the descriptor limit of the process below the number of files
+    :param path: str repository
+    :param work: str directory for the files to add
+    :param jobs: int
+    :param files: int
+    :return: None. Exits with 1 if add or verify fail.
+    """
+    os.makedirs(work)
+    for i in range(files):
+        with open(os.path.join(work, "batch{}.txt".format(i)), 'w') as f_w:
+            f_w.write("batch file {} of {} jobs\n".format(i, jobs))
+
+    resource.setrlimit(resource.RLIMIT_NOFILE, (files // 4, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+
+    try:
+        repo = rms.Repository(path)
+        repo.add([work], "Batch file", jobs=jobs)
+        repo.verify(jobs=jobs)
+    except (OSError, rms.RepositoryError) as e:
+        print("adding {} files with {} jobs failed: {!r}".format(files, jobs, e), file=sys.stderr)
+        sys.exit(1)
+
+
+def check_batch(path, work, files=1000):
+    """
+    Add batches of files in processes which may open fewer descriptors than there are files. Every file has to be
+    stored without keeping a descriptor open.
+    :param path: str repository
+    :param work: str directory for the files to add
+    :param files: int files per batch
+    :return: list of str violations
+    """
+    errors = []
+
+    for jobs in (1, 2):
+        process = Process(target=_add_batch, args=(path, os.path.join(work, str(jobs)), jobs, files))
+        process.start()
+        process.join()
+        if process.exitcode:
+            errors.append("adding a batch of {} files with {} jobs failed".format(files, jobs))
+
+    return errors
+
+
+def main():
+    parser = ArgumentParser(description="Concurrent writers stress test of a rms repository")
+    parser.add_argument('-p', '--processes', type=int, default=8, help='Concurrent writers. Default = 8')
+    parser.add_argument('-o', '--ops', type=int, default=100, help='Operations per writer. Default = 100')
+    parser.add_argument('-n', '--names', type=int, default=20, help='Size of the tag name pool. Default = 20')
+    parser.add_argument('-c', '--contents', type=int, default=10, help='Number of different contents. Default = 10')
+    parser.add_argument('--no-chunked', action='store_true', help='Do not add files to the chunk store')
+    parser.add_argument('--sharded', action='store_true', help='Use the sharded layout')
+    parser.add_argument('--repack', action='store_true', help='Also move files into packs meanwhile')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="rms-stress-")
+
+    try:
+        repo = rms.Repository.create(tmp, sharded=args.sharded)
+        contents = _contents(args.contents, 0)
+
+        start = time.time()
+        workers = [Process(target=_worker, args=(repo.path, os.path.join(tmp, "work"), i, args.ops, args.names,
+                                                 contents, not args.no_chunked, args.repack))
+                   for i in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        print("{} writers with {} operations each in {:.1f} s".format(args.processes, args.ops, time.time() - start))
+
+        if any(worker.exitcode for worker in workers):
+            print("A writer failed", file=sys.stderr)
+            return 1
+
+        errors = check(repo.path)
+        errors += check_link(repo.path, os.path.join(tmp, "link"))
+        errors += check_batch(repo.path, os.path.join(tmp, "batch"))
+    finally:
+        shutil.rmtree(tmp)
+
+    for error in errors:
+        print(error)
+    print("{} invariant violations".format(len(errors)))
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
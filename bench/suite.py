@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+suite -- Benchmark suite of the rms subcommands on synthetic repositories
+
+Generates repositories with a given number of files, a mix of text and binary files, a file size distribution and
+additional tags per file, then times the subcommands add, get, cat, tag, rm, desc and list against each of them as
+a fresh process, like a user calls them. The results are written as JSON and can be compared with the results of
+another commit to catch regressions of the lookup paths that grow with the size of the repository:
+
+    bench/suite.py -o before.json
+    git checkout other-commit
+    bench/suite.py -o after.json --compare before.json
+
+Set TMPDIR to a directory on the file system of interest.
+"""
+
+import sys
+import os
+import json
+import math
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+RMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "rms")
+
+sys.path.insert(0, os.path.dirname(RMS))
+
+import rms
+
+# Subcommand arguments. {tag} is an existing tag, {n} the number of the run, {tmp} the temporary directory.
+COMMANDS = [
+    ('add', ['add', '{tmp}/new{n}.txt', 'Benchmark file']),
+    ('get', ['get', '{tag}', '{tmp}/out{n}']),
+    ('cat', ['cat', '{tag}', '-l', '4096']),
+    ('tag', ['tag', '{tag}', '-n', 'alias{n}']),
+    ('rm', ['rm', 'alias{n}']),
+    ('desc', ['desc', '{tag}', '-f', 'json']),
+    ('desc_set', ['desc', '{tag}', '-s', '{{"Benchmark": "{n}"}}']),
+    ('list', ['list']),
+]
+
+
+def _sizes(rnd, n, median, sigma, limit):
+    """
+    Draw file sizes from a log-normal distribution
+    :param rnd: random.Random
+    :param n: int
+    :param median: int
+    :param sigma: float spread of the distribution, 0 for a fixed size
+    :param limit: int largest size
+    :return: list of int
+    """
+    return [max(1, min(limit, int(rnd.lognormvariate(math.log(median), sigma)))) for _ in range(n)]
+
+
+def generate(parent, files, text=0.5, median=4096, sigma=1.0, limit=16 << 20, tags=1.0, sharded=False, seed=0):
+    """
+    Create a synthetic repository
+    :param parent: str directory of the new repository
+    :param files: int number of distinct files
+    :param text: float share of text files, the others are incompressible binary files
+    :param median: int median file size
+    :param sigma: float spread of the log-normal file size distribution
+    :param limit: int largest file size
+    :param tags: float average number of tags per file, at least 1
+    :param sharded: bool use the sharded layout
+    :param seed: int
+    :return: (rms.Repository, list) repository and its tags
+    """
+    rnd = random.Random(seed)
+    repo = rms.Repository.create(parent, sharded=sharded)
+    src = os.path.join(parent, "files")
+    os.makedirs(src)
+
+    pool = os.urandom(limit + 4096)
+    words = ["alpha", "beta", "gamma", "delta", "sequence", "sample", "protein", "value", "result"]
+    lines = "".join("{} {} {}\n".format(rnd.choice(words), i, rnd.choice(words)) for i in range(4096)).encode('utf-8')
+
+    paths = []
+    for i, size in enumerate(_sizes(rnd, files, median, sigma, limit)):
+        if rnd.random() < text:
+            path = os.path.join(src, "file{}.txt".format(i))
+            header = "file {}\n".format(i).encode('utf-8')
+            data = header + (lines * (size // len(lines) + 1))[:size]
+        else:
+            path = os.path.join(src, "file{}.bin".format(i))
+            offset = rnd.randrange(4096)
+            data = pool[offset:offset + size] + i.to_bytes(8, 'little')
+        with open(path, 'wb') as f_w:
+            f_w.write(data)
+        paths.append((path, "Synthetic file {}".format(i)))
+
+    results = repo.add(paths, jobs=os.cpu_count() or 1)
+    shutil.rmtree(src)
+
+    names = [r.tag for r in results]
+    for i in range(int(files * (max(tags, 1) - 1))):
+        names.append("extra{}".format(i))
+        repo.add_tag(rnd.choice(names[:files]), names[-1])
+
+    return repo, names
+
+
+def _time(argv, env):
+    """
+    Run rms once
+    :param argv: list
+    :param env: dict
+    :return: float wall time in ms
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, RMS] + argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    wall = (time.perf_counter() - start) * 1000
+
+    if proc.returncode != 0:
+        sys.exit("rms {} failed:\n{}".format(" ".join(argv), proc.stderr))
+
+    return wall
+
+
+def run(scale, args):
+    """
+    Generate a repository of one scale and time the subcommands
+    :param scale: int
+    :param args: argparse.Namespace
+    :return: list of result dicts
+    """
+    tmp = tempfile.mkdtemp(prefix="rms-suite-")
+    rnd = random.Random(scale)
+    repo = None
+
+    try:
+        start = time.perf_counter()
+        repo, tags = generate(tmp, scale, args.text, args.median, args.sigma, args.limit, args.tags,
+                              args.layout == 'sharded')
+        generated = time.perf_counter() - start
+        env = dict(os.environ, RMS=repo.path)
+        results = []
+
+        for name, argv in COMMANDS:
+            if args.command and name not in args.command:
+                continue
+
+            times = []
+            for n in range(args.repeat):
+                if name == 'add':
+                    with open(os.path.join(tmp, "new{}.txt".format(n)), 'w') as f_w:
+                        f_w.write("new file {} {}\n".format(n, time.time()))
+                if name == 'rm' and not os.path.lexists(os.path.join(repo.path, "tags", "alias{}".format(n))):
+                    repo.add_tag(rnd.choice(tags), "alias{}".format(n))
+                values = {'tag': rnd.choice(tags), 'n': n, 'tmp': tmp}
+                times.append(_time([a.format(**values) for a in argv], env))
+
+            times.sort()
+            results.append({'scale': scale, 'command': name, 'min_ms': round(times[0], 1),
+                            'median_ms': round(times[len(times) // 2], 1)})
+
+        print("{} files generated in {:.1f} s".format(scale, generated), file=sys.stderr)
+        return results
+    finally:
+        if repo is not None:
+            repo.close()
+        shutil.rmtree(tmp)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with the results of another run
+    :param results: list of result dicts
+    :param baseline: list of result dicts
+    :param threshold: float ratio of the median times above which a command counts as regressed
+    :return: list of (result, baseline result, ratio) tuples of the regressed commands
+    """
+    base = {(r['scale'], r['command']): r for r in baseline}
+    regressed = []
+
+    for r in results:
+        b = base.get((r['scale'], r['command']))
+        if b is not None and r['median_ms'] / max(b['median_ms'], 1e-6) > threshold:
+            regressed.append((r, b, r['median_ms'] / b['median_ms']))
+
+    return regressed
+
+
+def _commit():
+    """
+    Returns the commit of the working tree of rms.py
+    :return: str or None
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(RMS),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark suite of the rms subcommands on synthetic repositories")
+    parser.add_argument('-s', '--scale', type=int, action='append',
+                        help='Number of files of a generated repository. Can be repeated. Default = 1000, 10000 '
+                             'and 100000')
+    parser.add_argument('-c', '--command', choices=[c[0] for c in COMMANDS], action='append',
+                        help='Only time this subcommand. Can be repeated')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per subcommand. Default = 5')
+    parser.add_argument('--text', type=float, default=0.5, help='Share of text files. Default = 0.5')
+    parser.add_argument('--median', type=int, default=4096, help='Median file size in bytes. Default = 4096')
+    parser.add_argument('--sigma', type=float, default=1.0,
+                        help='Spread of the log-normal file size distribution, 0 for equal sizes. Default = 1.0')
+    parser.add_argument('--limit', type=int, default=16 << 20, help='Largest file size in bytes. Default = 16 MiB')
+    parser.add_argument('--tags', type=float, default=1.2, help='Average number of tags per file. Default = 1.2')
+    parser.add_argument('--layout', choices=['flat', 'sharded'], default='flat', help="Default = 'flat'")
+    parser.add_argument('-o', '--output', type=str, help='Write the results as JSON to this file')
+    parser.add_argument('--compare', type=str, help='JSON results of another run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Fail if a median time grew by more than this factor. Default = 1.25')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scale or [1000, 10000, 100000]:
+        results += run(scale, args)
+
+    report = {'commit': _commit(), 'python': sys.version.split()[0], 'layout': args.layout, 'repeat': args.repeat,
+              'text': args.text, 'median': args.median, 'sigma': args.sigma, 'tags': args.tags, 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f_w:
+            json.dump(report, f_w, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r') as f_r:
+            regressed = compare(results, json.load(f_r)['results'], args.threshold)
+        for r, b, ratio in regressed:
+            print("{} at {} files: {:.1f} ms instead of {:.1f} ms ({:.2f}x)".format(
+                r['command'], r['scale'], r['median_ms'], b['median_ms'], ratio), file=sys.stderr)
+        return 1 if regressed else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
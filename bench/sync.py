@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+sync -- Benchmark and resume test of rms sync
+
+Generates a synthetic source repository (see suite.py) and copies it into empty repositories with 'rms sync' over
+the exec: transport, where a local 'rms sync-serve' process stands in for ssh:
+
+- a full copy, timed for each number of parallel streams
+- a copy whose source stream is cut after a number of bytes, followed by a second sync which has to resume it
+- a second sync of an up to date target, which has to copy nothing
+
+Every target is checked with the invariants of stress.py and against the tags of the source. Exits with 1 if a
+check failed. Set TMPDIR to a directory on the file system of interest.
+"""
+
+import sys
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+RMS = os.path.join(BENCH, os.pardir, "src", "rms")
+
+sys.path.insert(0, os.path.dirname(RMS))
+sys.path.insert(0, BENCH)
+
+import rms
+import stress
+import suite
+
+# Copies at most n bytes from stdin to stdout unbuffered, then exits and so cuts the stream
+CUT = "import os, sys\nn = int(sys.argv[1])\nwhile n > 0:\n    d = os.read(0, min(n, 65536))\n    if not d:\n" \
+      "        break\n    os.write(1, d)\n    n -= len(d)\n"
+
+
+def _sync(source, target, *options):
+    """
+    Run rms sync
+    :param source: str location
+    :param target: str location
+    :return: (int, str, float) exit code, output and wall time in s
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, RMS, "sync", source, target] + list(options), stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
+
+    return proc.returncode, proc.stdout.strip(), time.perf_counter() - start
+
+
+def _serve(path):
+    """
+    Returns the exec: location of a repository served by a local process
+    :param path: str
+    :return: str
+    """
+    return "exec:{} {} sync-serve {}".format(sys.executable, RMS, path)
+
+
+def _check(source, path):
+    """
+    Check a target repository
+    :param source: rms.Repository
+    :param path: str
+    :return: list of str violations
+    """
+    errors = stress.check(path)
+    target = rms.Repository(path)
+
+    if sorted(target.list_tags()) != sorted(source.list_tags()):
+        errors.append("the tags of {} differ from the source".format(path))
+
+    return errors
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark and resume test of rms sync")
+    parser.add_argument('-n', '--files', type=int, default=1000, help='Files of the source. Default = 1000')
+    parser.add_argument('--median', type=int, default=64 * 1024, help='Median file size in bytes. Default = 64 KiB')
+    parser.add_argument('-j', '--jobs', type=int, action='append',
+                        help='Parallel streams to time. Can be repeated. Default = 1 and 4')
+    parser.add_argument('--cut', type=float, default=0.5,
+                        help='Cut the stream of the resume test after this share of the bytes. Default = 0.5')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="rms-sync-")
+    results = []
+    errors = []
+
+    try:
+        source, _ = suite.generate(os.path.join(tmp, "source"), args.files, median=args.median)
+        size = sum(entry.stat().st_size for entry in source._scan("data"))
+
+        def target(name):
+            return rms.Repository.create(os.path.join(tmp, name)).path
+
+        for jobs in args.jobs or [1, 4]:
+            path = target("full{}".format(jobs))
+            code, out, wall = _sync(_serve(source.path), path, "-j", str(jobs))
+            results.append({'test': 'full', 'jobs': jobs, 'seconds': round(wall, 3),
+                            'mb_per_s': round(size / 1e6 / wall, 1), 'output': out})
+            errors += ["full -j {}: {}".format(jobs, out)] if code else _check(source, path)
+
+        path = target("resume")
+        with open(os.path.join(tmp, "cut.py"), 'w') as f_w:
+            f_w.write(CUT)
+        cut = "{} | {} {} {}".format(_serve(source.path), sys.executable, os.path.join(tmp, "cut.py"),
+                                     int(size * args.cut))
+        code, out, wall = _sync(cut, path)
+        results.append({'test': 'cut', 'jobs': 1, 'seconds': round(wall, 3), 'output': out})
+        if code == 0:
+            errors.append("the cut sync did not fail")
+
+        code, out, wall = _sync(_serve(source.path), path)
+        results.append({'test': 'resume', 'jobs': 1, 'seconds': round(wall, 3), 'output': out})
+        errors += ["resume: {}".format(out)] if code else _check(source, path)
+
+        code, out, wall = _sync(_serve(source.path), path)
+        results.append({'test': 'noop', 'jobs': 1, 'seconds': round(wall, 3), 'output': out})
+        if code or not out.startswith("Copied 0 files"):
+            errors.append("the up to date target was not left alone: {}".format(out))
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        json.dump({'files': args.files, 'bytes': size, 'results': results, 'errors': errors}, sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            print("{:<7} -j {:<3} {:>8.3f} s  {}".format(r['test'], r['jobs'], r['seconds'], r['output']))
+        for error in errors:
+            print(error)
+        print("{} errors".format(len(errors)))
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+"""
+writes -- Benchmark of the mutating rms subcommands
+
+Times a batch add of many small files and single tag, desc --set and rm commands against a temporary repository.
+Give another rms.py with --baseline to compare, e.g. the version before the journal:
+
+    git show <commit>:src/rms.py > /tmp/rms_old.py
+    bench/writes.py --baseline /tmp/rms_old.py
+
+Set TMPDIR to a directory on the file system of interest. The fsyncs cost almost nothing on tmpfs.
+"""
+
+import sys
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+RMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src", "rms.py")
+
+
+def _rms(rms, env, *argv):
+    """
+    Run rms and return its wall time in ms
+    :param rms: str path of rms.py
+    :param env: dict
+    :param argv: str
+    :return: float
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, rms] + list(argv), env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    wall = (time.perf_counter() - start) * 1000
+
+    if proc.returncode != 0:
+        sys.exit("{} {} failed:\n{}".format(rms, " ".join(argv), proc.stderr))
+
+    return wall
+
+
+def _bench(rms, files, ops):
+    """
+    Run the benchmark with one rms.py in a new repository
+    :param rms: str path of rms.py
+    :param files: int number of files of the batch add
+    :param ops: int number of tag, desc and rm commands each
+    :return: dict wall times in ms
+    """
+    tmp = tempfile.mkdtemp(prefix="rms-writes-")
+    env = dict(os.environ, RMS=os.path.join(tmp, ".rms"))
+
+    try:
+        src = os.path.join(tmp, "files")
+        os.makedirs(src)
+        for i in range(files):
+            with open(os.path.join(src, "f{}.bin".format(i)), 'wb') as f_w:
+                f_w.write(os.urandom(4096))
+
+        subprocess.check_call([sys.executable, rms, "init", tmp], env=env, stdout=subprocess.DEVNULL)
+
+        result = {'add_batch': _rms(rms, env, "add", "-j", "1", src, "Benchmark files")}
+
+        for name, argv in [('tag', ["tag", "f{}.bin", "-n", "t{}.bin"]),
+                           ('desc_set', ["desc", "f{}.bin", "-s", json.dumps({"Benchmark": "value"})]),
+                           ('rm', ["rm", "t{}.bin"])]:
+            result[name] = sum(_rms(rms, env, *[a.replace("{}", str(i)) for a in argv]) for i in range(ops)) / ops
+
+        return result
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of the mutating rms subcommands")
+    parser.add_argument('-b', '--baseline', type=str, help='Another rms.py to compare with')
+    parser.add_argument('-n', '--files', type=int, default=500, help='Files of the batch add. Default = 500')
+    parser.add_argument('-r', '--ops', type=int, default=20,
+                        help='Number of tag, desc and rm commands each. Default = 20')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = {'current': _bench(RMS, args.files, args.ops)}
+    if args.baseline:
+        results['baseline'] = _bench(args.baseline, args.files, args.ops)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return 0
+
+    print("{:<10} {:>12}{}".format("", "current ms", "  baseline ms    overhead" if args.baseline else ""))
+    for key, label in [('add_batch', "add {}".format(args.files)), ('tag', 'tag'), ('desc_set', 'desc --set'),
+                       ('rm', 'rm')]:
+        line = "{:<10} {:>12.1f}".format(label, results['current'][key])
+        if args.baseline:
+            base = results['baseline'][key]
+            line += "  {:>11.1f}  {:>+9.1%}".format(base, results['current'][key] / base - 1)
+        print(line)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
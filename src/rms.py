@@ -13,38 +13,99 @@ RMA -- Ressource Management System
 @deffield    updated: Updated
 """
 
+# Only modules needed by every subcommand are imported here. Everything else (magic, pdfkit, markdown, the
+# compression and hash modules, sqlite3, ...) is imported by the functions using it to keep the startup fast.
 import sys
 import os
-import magic
-import zlib # gzip gives different checksums repeating compression. Use zlib instead - gzip header is missing see http://unix.stackexchange.com/questions/22834/how-to-uncompress-zlib-data-in-unix
-import hashlib
-import shutil
 import json
-import pdfkit
 import collections
+import collections.abc
+import fnmatch
+import time
+import fcntl
+import errno
+import struct
 
-from datetime import date
 from argparse import ArgumentParser
 from argparse import Action
 from argparse import RawDescriptionHelpFormatter
 from enum import Enum
-from markdown import markdown
 from argparse import FileType
+from functools import partial
 
-__all__ = []
+__all__ = ['Repository', 'RepositoryError', 'AddResult', 'VerifyResult', 'RenderResult', 'GCResult', 'Usage',
+           'RepackResult', 'SyncResult', 'UpdateResult', 'sync_repositories']
 __version__ = '0.5'
 __date__ = '2016-06-23'
 __updated__ = '2016-04-18'
 
-DEBUG = 0
-TESTRUN = 0
-PROFILE = 0
+CHUNK_SIZE = 1024 * 1024  # Read, hash and compress files in chunks of this size
+MMAP_WINDOW = 64 * 1024 * 1024 # Uncompressed files are hashed and copied through memory mapped windows of this size
+TMP_PREFIX = '.tmp-'      # Prefix of partially written files in the repository
+SYNC_PREFIX = TMP_PREFIX + 'sync-'  # Prefix of hash files partially received by rms sync, continued by the next sync
+SSH_ENV = 'RMS_SSH'       # Environment variable with the ssh command of rms sync. Default = "ssh"
+SYNC_BATCH = 256          # rms sync stores received hash files in batches of this size with one journal
+BLOCK_SIZE = 256 * 1024   # Size of the independently compressed blocks of seekable files
+BLOCK_SUFFIX = '.idx'     # Suffix of the block offset index stored next to seekable files
+INDEX_FILE = 'index.db'   # SQLite database in the repository mapping tags to their hash files
+INDEX_VERSION = 2         # Schema version of the index. Older indexes are rebuilt on first use.
+CONFIG_FILE = 'config'    # JSON repository configuration
+RENDER_DIR = 'render'     # Directory in the repository caching rendered descriptions
+TRACE_ENV = 'RMS_TRACE'   # Environment variable naming the trace file if --trace is not given
+LOCK_FILE = 'lock'        # File in the repository holding the record locks of tags, hash files and the chunk store
+FICLONE = 0x40049409      # ioctl to share the data blocks of two files on copy on write file systems (Linux)
+DEFAULT_CODEC = 'zlib:9'  # Compression codec of text files if not configured otherwise
+SHARD_LEVELS = 2          # Directory levels of the sharded layout of data and desc, e.g. data/ab/cd/abcd...
+GC_MIN_AGE = 3600         # gc keeps files younger than this many seconds, they may belong to a running add
+
+# Small hash files are moved by repack into pack files in PACK_DIR. Their descriptions and tags are kept in the
+# SQLite database PACK_INDEX next to the packs, which is no cache like the index but the only copy of them.
+PACK_DIR = 'packs'
+PACK_INDEX = 'packs.db'
+PACK_SUFFIX = '.pack'
+PACK_MAX_BLOB = 64 * 1024         # repack moves hash files up to this size into packs
+PACK_SIZE = 256 * 1024 * 1024     # Pack files are filled up to this size
+PACK_MIN_LIVE = 0.5               # repack rewrites packs with less than this share of bytes still referenced
+PACK_RECORD = struct.Struct('<20sQ')  # Header of each hash file in a pack: binary sha1 and length of the data
+
+# Source files known to add are confirmed by hashing this many blocks of this size spread over the file
+SAMPLE_BLOCKS = 8
+SAMPLE_SIZE = 64 * 1024
+
+# Content defined chunking of the chunk store. Chunk boundaries are placed after a newline when the checksum of
+# the CDC_WINDOW bytes before it has its CDC_MASK bits unset, but never before CDC_MIN_SIZE or after CDC_MAX_SIZE.
+# In binary data, i.e. with NUL bytes, and in text with lines longer than CDC_MAX_LINE on average, any byte of
+# CDC_ANCHORS stands in for the newline.
+CDC_MIN_SIZE = 256 * 1024
+CDC_MAX_SIZE = 4 * 1024 * 1024
+CDC_WINDOW = 48
+CDC_MASK = (1 << 14) - 1
+CDC_MAX_LINE = 1024
+CDC_ANCHORS = bytes(range(0x08, 0x100, 0x10))
+
+# Versions of update are stored as deltas against the previous version. After VERSION_SNAPSHOT deltas in a row, or
+# if more than DELTA_MAX_NEW of a version is not found in the previous one, the version is stored in full. A delta
+# starts with the binary sha1sum of the previous version, followed by a stream of DELTA_OP operations compressed as
+# a whole: b'C', offset and length of a copy from the previous version or b'I', length and 0 of literal data
+# following the operation. Like a compressed file it is named by the sha1sum of the stored bytes. The versions are
+# matched in content defined chunks of DELTA_MIN_SIZE to DELTA_MAX_SIZE bytes, about 1-4 KiB with DELTA_MASK, so a
+# version differing in a few records costs a few KiB. The chunks of the previous version are indexed in memory, at
+# most DELTA_MAX_INDEX of them, about 27 MB. Contents of more than DELTA_MAX_INDEX * DELTA_MIN_SIZE bytes are matched
+# in proportionally larger chunks, see _delta_chunking.
+VERSION_SNAPSHOT = 8
+DELTA_MAX_NEW = 0.5
+DELTA_OP = struct.Struct('<cQQ')
+DELTA_MIN_SIZE = 512
+DELTA_MAX_SIZE = 64 * 1024
+DELTA_MASK = (1 << 6) - 1
+DELTA_MAX_INDEX = 1 << 17
+
 
 program_name = os.path.basename(sys.argv[0])
 program_version = "v{}".format(__version__)
 program_build_date = str(__updated__)
 program_version_message = '{} {} ({})'.format(os.path.basename(__file__), program_version, program_build_date)
-program_shortdesc = __import__('__main__').__doc__.split("\n")[1]
+program_shortdesc = __doc__.split("\n")[1]
 program_license = '''{}
 
   Created by Norbert Auer on {}.
@@ -66,6 +127,10 @@ class Format(Enum):
     json = 4
 
 
+# File extensions of the rendered descriptions
+FORMAT_EXTENSIONS = {'markdown': '.md', 'html5': '.html', 'pdf': '.pdf', 'json': '.json'}
+
+
 class EnvDefault(Action):
     def __init__(self, envvar, required=True, default=None, **kwargs):
         if not default and envvar:
@@ -94,6 +159,376 @@ class CLIError(Exception):
         return self.msg
 
 
+class RepositoryError(Exception):
+    """Error of a repository operation. The message is meant for the user."""
+
+
+class _Locks(object):
+    """
+    Exclusive or shared fcntl record locks of a repository. Each lock key is a byte of the lock file given by the
+    crc32 of the key. Locks the repository object holds already are neither taken again nor released on exit.
+
+    Writers have to take their locks in the order packs ('packs'), chunk store ('chunks'), tags ('tag:<name>') and
+    hash files ('hash:<sha1>'), all keys of one kind at once, to avoid deadlocks.
+    """
+
+    def __init__(self, repo, keys, shared=False):
+        self._repo = repo
+        self._keys = keys
+        self._shared = shared
+        self._acquired = []
+
+    def __enter__(self):
+        import zlib
+
+        fd = self._repo._get_lock_fd()
+        try:
+            for offset in sorted(set(zlib.crc32(key.encode('utf-8')) for key in self._keys)):
+                if offset not in self._repo._held_locks:
+                    fcntl.lockf(fd, fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX, 1, offset)
+                    self._repo._held_locks.add(offset)
+                    self._acquired.append(offset)
+        except:
+            self.__exit__()
+            raise
+
+        return self
+
+    def __exit__(self, *exc):
+        for offset in self._acquired:
+            fcntl.lockf(self._repo._get_lock_fd(), fcntl.LOCK_UN, 1, offset)
+            self._repo._held_locks.discard(offset)
+        self._acquired = []
+
+
+# Tracing. Phases are wrapped in 'with _trace(name, cat) as span:'. Without a trace _trace returns the shared
+# _NO_SPAN doing nothing, so an untraced run pays one function call per phase.
+
+_tracer = None
+
+
+class _Tracer(object):
+    """
+    Writes the spans of a trace as JSON lines to a file. The file is opened for appending with one write per span,
+    so the worker processes of add and verify can write their spans to the same file.
+    """
+
+    def __init__(self, path, truncate=False):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | (os.O_TRUNC if truncate else 0), 0o666)
+
+    def write(self, event):
+        os.write(self.fd, (json.dumps(event) + "\n").encode('utf-8'))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Span(object):
+    """
+    A traced phase. Records its wall time, the CPU time of the thread in user and kernel mode, the blocks the
+    thread read from and wrote to disk, how often it waited (voluntary context switches, mostly blocking system
+    calls) and the bytes processed as counted with add. The times are in µs of the monotonic clock.
+    """
+
+    __slots__ = ('name', 'cat', 'args', 'bytes', 'start', 'usage')
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.bytes = 0
+
+    def add(self, n):
+        self.bytes += n
+
+    def __enter__(self):
+        self.usage = _thread_usage()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        import threading
+
+        end = time.perf_counter()
+        usage = _thread_usage()
+        event = {'name': self.name, 'cat': self.cat, 'ts': int(self.start * 1e6), 'dur': int((end - self.start) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.get_native_id(), 'bytes': self.bytes,
+                 'user_ms': round((usage.ru_utime - self.usage.ru_utime) * 1000, 3),
+                 'sys_ms': round((usage.ru_stime - self.usage.ru_stime) * 1000, 3),
+                 'in_blocks': usage.ru_inblock - self.usage.ru_inblock,
+                 'out_blocks': usage.ru_oublock - self.usage.ru_oublock,
+                 'waits': usage.ru_nvcsw - self.usage.ru_nvcsw}
+        if self.args:
+            event['args'] = self.args
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+
+        if _tracer is not None:
+            _tracer.write(event)
+
+
+class _NoSpan(object):
+    """Span of untraced runs"""
+
+    __slots__ = ()
+
+    def add(self, n):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _thread_usage():
+    """
+    Returns the resource usage of the calling thread, or of the process where threads are not accounted alone
+    :return: resource.struct_rusage
+    """
+    import resource
+
+    return resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+
+
+def _trace(name, cat='cpu', **args):
+    """
+    Returns a span timing a phase if a trace is written
+    :param name: str
+    :param cat: str 'cpu' for computing phases, 'io' for phases spent in system calls, 'cmd' for subcommands
+    :param args: details shown with the span
+    :return: _Span or _NoSpan
+    """
+    if _tracer is None:
+        return _NO_SPAN
+
+    return _Span(name, cat, args)
+
+
+class _TimedCompressor(object):
+    """Compressor adding the time it spends compressing to 'compress_ms' of a span"""
+
+    def __init__(self, compressor, span):
+        self._compressor = compressor
+        self._span = span
+
+    def _timed(self, method, *data):
+        start = time.perf_counter()
+        try:
+            return method(*data)
+        finally:
+            self._span.args['compress_ms'] = round(self._span.args.get('compress_ms', 0) +
+                                                   (time.perf_counter() - start) * 1000, 3)
+
+    def compress(self, data):
+        return self._timed(self._compressor.compress, data)
+
+    def flush(self):
+        return self._timed(self._compressor.flush)
+
+
+def _timed_compressor(compressor, span):
+    """
+    Returns the compressor counting its time in span if the span is traced
+    :param compressor: compressor object or None
+    :param span: _Span or _NoSpan
+    :return: compressor object or None
+    """
+    if compressor is None or span is _NO_SPAN:
+        return compressor
+
+    return _TimedCompressor(compressor, span)
+
+
+def _start_trace(path, truncate=False):
+    """
+    Write the spans of this process to a JSON lines file. Also the initializer of the worker processes.
+    :param path: str or None
+    :param truncate: bool start a new file
+    :return: None
+    """
+    global _tracer
+
+    if path is not None and (_tracer is None or _tracer.path != path):
+        _tracer = _Tracer(path, truncate)
+
+
+# Repository of a worker process of add and verify, opened once by _start_worker for all files of the worker
+_worker_repo = None
+
+
+def _start_worker(path, trace):
+    """
+    Open the repository at path for all files handled by this worker process of add or verify. The initializer of
+    the worker processes.
+    :param path: str
+    :param trace: str or None file of the spans, see _start_trace
+    :return: None
+    """
+    global _worker_repo
+
+    _start_trace(trace)
+    _worker_repo = Repository(path)
+
+
+def _trace_path():
+    """
+    Returns the file the spans are written to or None if no trace is written
+    :return: str
+    """
+    return _tracer.path if _tracer is not None else None
+
+
+def _stop_trace(target=None):
+    """
+    Stop tracing. With target the spans are converted to a Chrome trace (chrome://tracing, Perfetto) written to
+    target and the JSON lines file is removed.
+    :param target: str
+    :return: None
+    """
+    global _tracer
+
+    tracer, _tracer = _tracer, None
+
+    if tracer is None:
+        return
+
+    tracer.close()
+
+    if target is None:
+        return
+
+    events = []
+    with open(tracer.path, 'r') as f_r:
+        for line in f_r:
+            span = json.loads(line)
+            events.append({'name': span.pop('name'), 'cat': span.pop('cat'), 'ph': 'X', 'ts': span.pop('ts'),
+                           'dur': span.pop('dur'), 'pid': span.pop('pid'), 'tid': span.pop('tid'),
+                           'args': dict(span.pop('args', {}), **span)})
+
+    _write_file(target, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}).encode('utf-8'))
+    os.remove(tracer.path)
+
+
+class _LZ4Compressor(object):
+    """LZ4 frame compressor with the compress/flush interface of the zlib compressor objects."""
+
+    def __init__(self, level):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, b''
+        return header + self._compressor.flush()
+
+
+def _zlib_compressor(level):
+    import zlib # gzip gives different checksums repeating compression. Use zlib instead - gzip header is missing see http://unix.stackexchange.com/questions/22834/how-to-uncompress-zlib-data-in-unix
+    return zlib.compressobj(level)
+
+
+def _zlib_decompressor():
+    import zlib
+    return zlib.decompressobj()
+
+
+def _lzma_compressor(level):
+    import lzma
+    return lzma.LZMACompressor(preset=level)
+
+
+def _lzma_decompressor():
+    import lzma
+    return lzma.LZMADecompressor()
+
+
+def _bz2_compressor(level):
+    import bz2
+    return bz2.BZ2Compressor(level)
+
+
+def _bz2_decompressor():
+    import bz2
+    return bz2.BZ2Decompressor()
+
+
+def _zstd_compressor(level):
+    import zstandard
+    return zstandard.ZstdCompressor(level=level, threads=-1).compressobj()
+
+
+def _zstd_decompressor():
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _lz4_decompressor():
+    import lz4.frame
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+# Result of adding a file. sha1 is None if the file could not be found, tagged is False if the tag already existed.
+AddResult = collections.namedtuple('AddResult', ['file', 'tag', 'sha1', 'new', 'tagged', 'mime', 'size', 'blob',
+                                                 'chunks', 'description'])
+
+# Result of verify. corrupt, untagged: hash file names. dangling_tags: tags without hash file. orphan_descs:
+# descriptions without hash file. out_of_sync: (sha1, tags listed in the description or None, linked tags) tuples.
+VerifyResult = collections.namedtuple('VerifyResult', ['checked', 'cached', 'corrupt', 'dangling_tags',
+                                                       'orphan_descs', 'untagged', 'out_of_sync'])
+
+# Result of render_all. tags: all rendered tags. converted: tags not taken from the render cache. written: tags whose
+# output file was (re)written, the output files of the other tags were up to date.
+RenderResult = collections.namedtuple('RenderResult', ['tags', 'converted', 'written'])
+
+# Result of gc. blobs: hash files without tags. descs: descriptions without hash file. chunks: chunks no manifest
+# refers to. stray: paths of temporary files and block indexes without hash file. renders: paths of cached
+# renderings of outdated descriptions. size: bytes freed.
+GCResult = collections.namedtuple('GCResult', ['blobs', 'descs', 'chunks', 'stray', 'renders', 'size'])
+
+# Result of repack. packed: hash files moved into packs. tags: their tags. repacked: hash files copied out of sparse
+# packs. removed: names of the removed packs. freed: bytes of removed records in them.
+RepackResult = collections.namedtuple('RepackResult', ['packed', 'tags', 'repacked', 'removed', 'freed'])
+
+# Result of sync_repositories. files, chunks: number of hash files and chunks copied. bytes: bytes received for them.
+# tags: the new tags of the target. conflicts: tags of the source which exist in the target with another file.
+SyncResult = collections.namedtuple('SyncResult', ['files', 'chunks', 'bytes', 'tags', 'conflicts'])
+
+# Result of update. updated is False if the content did not change. version: number of the current version. new:
+# whether its hash file was stored. delta: whether it is stored as delta. size: size of its content. stored: bytes of
+# its new hash file.
+UpdateResult = collections.namedtuple('UpdateResult', ['tag', 'updated', 'version', 'sha1', 'new', 'delta', 'size',
+                                                       'stored'])
+
+# Result of usage. files: hash files. logical: size of their original contents. stored: bytes of all files of the
+# repository. tagged: size of the contents of all tags, counting shared contents once per tag. saved: bytes not
+# stored because tags share their content. by_codec, by_mime:
+# {name: [files, logical bytes, stored bytes]}. chunks: see chunk_stats. overhead: bytes of the descriptions,
+# block indexes, index, render cache, temporary files, pack database and pack record headers.
+Usage = collections.namedtuple('Usage', ['files', 'logical', 'stored', 'tagged', 'saved', 'by_codec', 'by_mime',
+                                         'chunks', 'overhead'])
+
+Codec = collections.namedtuple('Codec', ['module', 'level', 'compressor', 'decompressor', 'magic'])
+
+# Codecs by name. magic holds the leading bytes of the compressed streams.
+CODECS = collections.OrderedDict([
+    ('zlib', Codec('zlib', 9, _zlib_compressor, _zlib_decompressor, b'\x78')),
+    ('lzma', Codec('lzma', 6, _lzma_compressor, _lzma_decompressor, b'\xfd7zXZ\x00')),
+    ('bz2', Codec('bz2', 9, _bz2_compressor, _bz2_decompressor, b'BZh')),
+    ('zstd', Codec('zstandard', 3, _zstd_compressor, _zstd_decompressor, b'\x28\xb5\x2f\xfd')),
+    ('lz4', Codec('lz4', 0, _LZ4Compressor, _lz4_decompressor, b'\x04\x22\x4d\x18')),
+])
+
+
 def main(argv=None): # IGNORE:C0111
     """Command line options."""
 
@@ -107,40 +542,95 @@ def main(argv=None): # IGNORE:C0111
     try:
         # Setup argument parser
         parser = ArgumentParser(description=program_license, formatter_class=RawDescriptionHelpFormatter)
-        subparsers = parser.add_subparsers(help='sub-command help')
+        subparsers = parser.add_subparsers(help='sub-command help', dest='command')
         parser_init         = subparsers.add_parser('init', help='Create a new repository')
         parser_add          = subparsers.add_parser('add', help='Add a new file to the repository')
         parser_rm           = subparsers.add_parser('rm', help='Remove a tags or files from the repository')
         parser_get          = subparsers.add_parser('get', help='Get file from repository')
+        parser_update       = subparsers.add_parser('update', help='Store a new version of a file')
+        parser_cat          = subparsers.add_parser('cat', help='Write file or a part of it to stdout')
         parser_tag          = subparsers.add_parser('tag', help='Get or set tags')
         parser_desc         = subparsers.add_parser('desc', help='Set and get description')
         parser_list         = subparsers.add_parser('list', help='Show repository content')
+        parser_search       = subparsers.add_parser('search', help='Search files by their descriptions')
+        parser_verify       = subparsers.add_parser('verify', aliases=['fsck'],
+                                                    help='Check the content, tags and descriptions of the repository')
+        parser_migrate      = subparsers.add_parser('migrate', help='Convert the repository to another directory layout')
+        parser_gc           = subparsers.add_parser('gc', help='Remove hash files without tags and other unreferenced files')
+        parser_du           = subparsers.add_parser('du', help='Show the space used by the repository')
+        parser_repack       = subparsers.add_parser('repack', help='Move small files with their descriptions and tags into pack files')
+        parser_serve        = subparsers.add_parser('serve', help='Serve the repository read only over HTTP')
+        parser_sync         = subparsers.add_parser('sync', help='Copy the files missing in a repository from another one')
+        parser_sync_serve   = subparsers.add_parser('sync-serve', help='Serve a repository to rms sync over stdin and stdout')
+        parser_reindex      = subparsers.add_parser('reindex', help='Rebuild the index from the tag and description files')
         parser_desc_group   = parser_desc.add_mutually_exclusive_group()
 
         parser_init.add_argument("path",action=EnvDefault, envvar='HOME',
                                  help='Path to the new repository parent. Default = "$HOME"')
+        parser_init.add_argument('--codec', type=str, default=DEFAULT_CODEC,
+                                 help='Compression codec of text files as "name[:level]" ({}). Default = "{}"'.format(", ".join(CODECS), DEFAULT_CODEC))
+        parser_init.add_argument('--layout', choices=['flat', 'sharded'], default='flat',
+                                 help="Store hash files and descriptions in one directory or in {} levels of subdirectories by hash (sharded). Default = 'flat'".format(SHARD_LEVELS))
         parser_init.set_defaults(func=init)
 
         parser.add_argument('-V', '--version', action='version', version=program_version_message)
+        parser.add_argument('--trace', type=str, default=os.environ.get(TRACE_ENV), metavar='FILE',
+                            help='Write the wall time, CPU time, disk blocks and bytes of each phase of the subcommand to this file. Default = ${}'.format(TRACE_ENV))
+        parser.add_argument('--trace-format', choices=['jsonl', 'chrome'],
+                            help="'jsonl' writes one JSON object per phase, 'chrome' a trace for chrome://tracing or Perfetto. Default is 'chrome' for files ending with .json, otherwise 'jsonl'")
         parser.set_defaults(func=empty)
 
-        parser_add.add_argument('file', type=str, help='Add file to the repository')
+        parser_add.add_argument('file', type=str, nargs='*',
+                                help='Add files to the repository. Directories are added recursively')
         parser_add.add_argument('description', type=str, help='File description')
+        parser_add.add_argument('--from-file', type=str,
+                                help='Add the files listed in this file. Each line holds a path optionally followed by a tab and its description')
+        parser_add.add_argument('-c', '--chunked', action='store_true',
+                                help='Store the files split into content defined chunks to share data between similar files')
+        parser_add.add_argument('-s', '--seekable', action='store_true',
+                                help='Compress text files in independent blocks to allow reading parts of them with cat')
+        parser_add.add_argument('--codec', type=str,
+                                help='Compression codec of text files as "name[:level]" ({}). Default is the repository codec'.format(", ".join(CODECS)))
+        parser_add.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                                help='Number of processes hashing and compressing files. Default is the number of cores')
         parser_add.add_argument('-n', '--no-tag', action='store_true', help='Do not add a tag if already in repository')
+        parser_add.add_argument('--rehash', action='store_true',
+                                help='Read all files again even if they did not change since they were added')
+        parser_add.add_argument('--confirm', action='store_true',
+                                help='Hash sampled blocks of unchanged files to confirm they were not modified in place')
         parser_add.set_defaults(func=add)
 
         parser_rm.add_argument('file', type=str, help='Remove tag from the repository. If the last tag of a file was removed also the file itself with its description file will be removed.')
         parser_rm.set_defaults(func=rm)
 
         parser_get.add_argument('file', type=str, help='Get file from the repository')
-        parser_get.add_argument('target', type=str, help='The target directory where the file should be copied to')
+        parser_get.add_argument('target', type=str,
+                                help="The target file or directory where the file should be copied to. Use '-' to write to stdout")
+        parser_get.add_argument('-l', '--link', action='store_true',
+                                help='Create a symbolic link to the repository file instead of a copy. Only for uncompressed files. The linked file is read only')
+        parser_get.add_argument('-v', '--version', type=int,
+                                help='Get this version of a file stored by update. Default is the current version')
         parser_get.set_defaults(func=get)
 
+        parser_update.add_argument('file', type=str, help='Tag of the file to update')
+        parser_update.add_argument('path', type=str, help='The new version of the file')
+        parser_update.add_argument('-d', '--description', type=str,
+                                   help='New description. Default is the description of the previous version')
+        parser_update.add_argument('--codec', type=str,
+                                   help='Compression codec of text files as "name[:level]" ({}). Default is the repository codec'.format(", ".join(CODECS)))
+        parser_update.set_defaults(func=update)
+
+        parser_cat.add_argument('file', type=str, help='File of interest')
+        parser_cat.add_argument('-o', '--offset', type=int, default=0, help='Start reading at this byte. Default = 0')
+        parser_cat.add_argument('-l', '--length', type=int, help='Number of bytes to read. Default is up to the end of the file')
+        parser_cat.set_defaults(func=cat)
+
         parser_tag.add_argument('file', type=str, help='File of interest.')
         parser_tag.add_argument('-n', '--new-tag', type=str, required=False, help='Add new tag for file')
         parser_tag.set_defaults(func=tag)
 
-        parser_desc.add_argument('file', type=str, help='File of interest')
+        parser_desc.add_argument('file', type=str, nargs='?',
+                                 help='File of interest. With --render-all a shell pattern of the tags to render')
         parser_desc.add_argument('-f', '--format', choices=[f.name for f in Format], type=str, default=Format(3).name,
                                  help="Set the output format. Default is 'pdf'")
         parser_desc.add_argument('-o', '--output', type=FileType('wb'),
@@ -150,31 +640,118 @@ def main(argv=None): # IGNORE:C0111
         parser_desc_group.add_argument('-k', '--keys', action='store_true', help='Set description by keys ("key:desc")')
         parser_desc_group.add_argument('-c', '--clear', action='store_true',
                                        help='Delete all sections from description file')
+        parser_desc_group.add_argument('--render-all', type=str, metavar='DIR',
+                                       help='Render the descriptions of all tags to files in this directory. Unchanged files are skipped')
+        parser_desc.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                                 help='Number of descriptions rendered at once with --render-all. Default is the number of cores')
         parser_desc.set_defaults(func=desc)
 
+        parser_list.add_argument('-f', '--format', choices=['text', 'json', 'tsv'], default='text',
+                                 help="Set the output format. Default is 'text'")
+        parser_list.add_argument('-g', '--glob', type=str, help='Only list tags matching this shell pattern')
         parser_list.set_defaults(func=show)
 
+        parser_search.add_argument('query', type=str, nargs='*',
+                                   help='Full text query over the description keys and values (SQLite FTS5 syntax)')
+        parser_search.add_argument('-w', '--where', type=str, action='append', metavar='KEY=VALUE',
+                                   help='Only files with this description value (case insensitive). Can be repeated')
+        parser_search.add_argument('--since', type=str, help='Only files added at or after this date (YYYY-MM-DD)')
+        parser_search.add_argument('--until', type=str, help='Only files added at or before this date (YYYY-MM-DD)')
+        parser_search.add_argument('-f', '--format', choices=['text', 'json', 'tsv'], default='text',
+                                   help="Set the output format. Default is 'text'")
+        parser_search.set_defaults(func=search)
+
+        parser_verify.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                                   help='Number of processes hashing files. Default is the number of cores')
+        parser_verify.add_argument('--full', action='store_true',
+                                   help='Hash all files, also the ones unchanged since the last run')
+        parser_verify.set_defaults(func=verify)
+
+        parser_reindex.set_defaults(func=reindex)
+
+        parser_migrate.add_argument('layout', choices=['flat', 'sharded'], help='The new layout')
+        parser_migrate.set_defaults(func=migrate)
+
+        parser_gc.add_argument('-n', '--dry-run', action='store_true', help='Only report what would be removed')
+        parser_gc.add_argument('--min-age', type=float, default=GC_MIN_AGE,
+                               help='Keep files changed less than this many seconds ago. Default = {}'.format(GC_MIN_AGE))
+        parser_gc.set_defaults(func=gc)
+
+        parser_du.add_argument('-f', '--format', choices=['text', 'json'], default='text',
+                               help="Set the output format. Default is 'text'")
+        parser_du.set_defaults(func=du)
+
+        parser_repack.add_argument('--max-size', type=int, default=PACK_MAX_BLOB,
+                                   help='Pack stored files up to this many bytes. Default = {}'.format(PACK_MAX_BLOB))
+        parser_repack.add_argument('--pack-size', type=int, default=PACK_SIZE,
+                                   help='Fill pack files up to this many bytes. Default = {}'.format(PACK_SIZE))
+        parser_repack.set_defaults(func=repack)
+
+        parser_serve.add_argument('--host', type=str, default='127.0.0.1', help="Address to listen on. Default = '127.0.0.1'")
+        parser_serve.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on. Default = 8080')
+        parser_serve.set_defaults(func=serve)
+
+        parser_sync.add_argument('source', type=str,
+                                 help='Repository to copy from: a path, ssh://[user@]host[:port]/path or exec:COMMAND running "rms sync-serve PATH" elsewhere')
+        parser_sync.add_argument('target', type=str, help='Repository to copy to, like source')
+        parser_sync.add_argument('-t', '--tag', type=str, action='append', metavar='PATTERN',
+                                 help='Only copy the files of tags matching this shell pattern. Can be repeated')
+        parser_sync.add_argument('-j', '--jobs', type=int, default=1,
+                                 help='Number of files transferred at once over separate connections. Default = 1')
+        parser_sync.add_argument('--remote-rms', type=str, default='rms',
+                                 help="Command running rms on ssh hosts. Default = 'rms'")
+        parser_sync.set_defaults(func=sync)
+
+        parser_sync_serve.add_argument('path', type=str, help='Path of the repository (the .rms directory)')
+        parser_sync_serve.set_defaults(func=sync_serve)
+
         # Process arguments
         args = parser.parse_args()
         args.p = parser
-        if DEBUG:
-            print(args)
 
-        args.func(args)
+        if not args.trace:
+            args.func(args)
+            return 0
+
+        chrome = (args.trace_format or ('chrome' if args.trace.endswith('.json') else 'jsonl')) == 'chrome'
+        if chrome:
+            import tempfile
+            fd, events = tempfile.mkstemp(prefix=TMP_PREFIX, dir=os.path.dirname(os.path.abspath(args.trace)))
+            os.close(fd)
+        else:
+            events = args.trace
+
+        _start_trace(events, truncate=True)
+        try:
+            with _trace(args.command or program_name, 'cmd'):
+                args.func(args)
+        finally:
+            _stop_trace(args.trace if chrome else None)
 
         return 0
     except KeyboardInterrupt:
         # handle keyboard interrupt Easy to use parsing tools.###
         return 0
+    except RepositoryError as e:
+        print(e, file=sys.stderr)
+        return 1
     except Exception as e:
-        if DEBUG or TESTRUN:
-            raise(e)
         indent = len(program_name) * " "
         sys.stderr.write(program_name + ": " + repr(e) + "\n")
         sys.stderr.write(indent + "  for help use --help\n")
         return 2
 
 
+def _is_reserved(key):
+    """
+    Whether a section of a description is kept by the repository itself: the tags and the sections starting with
+    'repo_', like the date, the storage layout and the versions
+    :param key: str
+    :return: bool
+    """
+    return key == 'tags' or key.startswith('repo_')
+
+
 # Solution for nested dict update
 # http://stackoverflow.com/questions/3232943/update-value-of-a-nested-dictionary-of-varying-depth/3233356#3233356
 def _dict_update(d, u):
@@ -185,8 +762,8 @@ def _dict_update(d, u):
     :return: dict
     """
     for k, v in u.items():
-        if isinstance(d, collections.Mapping):
-            if isinstance(v, collections.Mapping):
+        if isinstance(d, collections.abc.Mapping):
+            if isinstance(v, collections.abc.Mapping):
                 r = _dict_update(d.get(k, {}), v)
                 d[k] = r
             else:
@@ -205,197 +782,4724 @@ def _get_repo_path():
         return os.environ["RMS"]
 
 
-def _get_file_sha1(file):
+def _parse_codec(spec):
     """
-    Calculates and return the sha1sum from a file
-    :param file: str
-    :return: str
+    Split a codec specification "name[:level]" into codec name and level and check if the codec is usable
+    :param spec: str
+    :return: (str, int)
     """
-    with open(file, 'rb') as f:
-        return hashlib.sha1(f.read()).hexdigest()
+    name, _, level = spec.partition(':')
 
+    if name not in CODECS:
+        raise RepositoryError("Unknown codec '{}'. Choose one of {}".format(name, ", ".join(CODECS)))
 
-def _get_string_sha1(string):
+    try:
+        __import__(CODECS[name].module)
+    except ImportError:
+        raise RepositoryError("Codec '{}' needs the python module '{}'".format(name, CODECS[name].module))
+
+    try:
+        level = int(level) if level else CODECS[name].level
+    except ValueError:
+        raise RepositoryError("Codec level '{}' is not a number".format(level))
+
+    return name, level
+
+
+def _get_compressor(spec):
     """
-    Calculates and return the sha1sum from a string
-    :param string: str
+    Create a compressor object for a codec specification
+    :param spec: str
+    :return: object with compress and flush methods
+    """
+    name, level = _parse_codec(spec)
+
+    return CODECS[name].compressor(level)
+
+
+def _sniff_codec(head):
+    """
+    Returns the name of the codec which created a compressed stream starting with head
+    :param head: bytes
     :return: str
     """
-    return hashlib.sha1(string).hexdigest()
+    for name, codec in CODECS.items():
+        if head.startswith(codec.magic):
+            return name
 
 
-def _get_repo_hashes():
+def _decompress_stream(f_r, f_w, name):
     """
-    Returns a list of all hashed unique files in the repository
-    :return: list
+    Decompress an open file with a codec chunk by chunk into another open file
+    :param f_r: file
+    :param f_w: file
+    :param name: str
+    :return: int number of bytes written
     """
-    return os.listdir(os.path.join(_get_repo_path(), "data"))
+    decompressor = CODECS[name].decompressor()
+    written = 0
+
+    for chunk in iter(lambda: f_r.read(CHUNK_SIZE), b''):
+        chunk = decompressor.decompress(chunk)
+        f_w.write(chunk)
+        written += len(chunk)
 
+    if hasattr(decompressor, 'flush'):
+        chunk = decompressor.flush()
+        f_w.write(chunk)
+        written += len(chunk)
 
-def _get_repo_tags():
+    return written
+
+
+def _decompress(data, name):
     """
-    Returns a list of all tag files in the repository
-    :return: list
+    Decompress a complete compressed stream
+    :param data: bytes
+    :param name: str
+    :return: bytes
     """
-    return os.listdir(os.path.join(_get_repo_path(), "tags"))
+    decompressor = CODECS[name].decompressor()
+    data = decompressor.decompress(data)
 
+    if hasattr(decompressor, 'flush'):
+        data += decompressor.flush()
 
-def _get_markdown(data_json, tagname):
+    return data
+
+
+def _copy_file_data(f_r, f_w):
     """
-    Create markdown string from json object
-    :param data_json: dict
-    :param tagname: str
-    :return: str
+    Copy the content of an open file to another open file. The data is shared by a reflink or copied inside the
+    kernel with copy_file_range or sendfile if possible. Otherwise it is copied chunk by chunk, also if one of the
+    files has no file descriptor.
+    :param f_r: file
+    :param f_w: file
+    :return: int number of bytes copied
     """
-    aliases = ''
+    import io
+    import shutil
 
-    if len(data_json['tags']) > 1:
-        aliases = '## Aliases:\n'
+    f_w.flush()
 
-        for alias in data_json['tags']:
-            if alias != tagname:
-                aliases += "+ {}\n".format(alias)
+    try:
+        src = f_r.fileno()
+        dst = f_w.fileno()
+    except io.UnsupportedOperation:
+        start = f_r.tell()
+        shutil.copyfileobj(f_r, f_w, CHUNK_SIZE)
+        return f_r.tell() - start
 
-    markd = '''# Description File for *{tag}*
+    size = os.fstat(src).st_size
+    offset = 0
 
-## In repository since *{date}*
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return size
+    except OSError:
+        pass
 
-{aliases}
-'''.format(tag=tagname, date=data_json['repo_date'], aliases=aliases, description=data_json['Description'])
+    def copy_file_range(n):
+        return os.copy_file_range(src, dst, n, offset)
 
-    for key in data_json:
-        if key == 'tags' or key == 'repo_date':
-            continue
-        if isinstance(data_json[key], list):
-            section = "##{key}\n\n".format(key=key)
+    def sendfile(n):
+        return os.sendfile(dst, src, offset, n)
 
-            for l in data_json[key]:
-                section += "+ {val}\n".format(val=l)
+    for copy in (copy_file_range, sendfile):
+        try:
+            while offset < size:
+                n = copy(min(size - offset, 1 << 30))
+                if n == 0:
+                    break
+                offset += n
+            return offset
+        except (OSError, AttributeError) as e:
+            # Not supported for this kind of files. Try the next method from where the last one stopped.
+            if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+                                                          errno.EOPNOTSUPP):
+                raise
 
-            markd += section + "\n"
-        elif isinstance(data_json[key], dict):
-            pass
-        else:
-           markd += "##{key}\n{val}\n\n".format(key=key, val=data_json[key])
+    f_r.seek(offset)
+    shutil.copyfileobj(f_r, f_w, CHUNK_SIZE)
 
-    return markd
+    return f_r.tell()
 
 
-def _get_tags_inodes():
+def _hash_mapped(f_r, sha1, f_w=None):
     """
-    Creates a dictionary with inode ids associated with their tag file names
-    :return: dict
+    Hash an open file and optionally copy it to another open file in one pass through memory mapped windows of
+    the file. The data is not copied into Python objects. Returns False before reading anything if the file can
+    not be mapped (empty files, pipes, some network file systems).
+    :param f_r: file
+    :param sha1: hashlib hash object updated with the content
+    :param f_w: file
+    :return: bool
     """
-    repo = _get_repo_path()
-    tags = _get_repo_tags()
-    inodes = dict()
+    import mmap
 
-    for tag in tags:
-        if os.lstat(os.path.join(repo, "tags", tag)).st_ino in inodes.keys():
-            inodes[os.lstat(os.path.join(repo, "tags", tag)).st_ino].append(tag)
-        else:
-            inodes[os.lstat(os.path.join(repo, "tags", tag)).st_ino] = [tag]
+    stat = os.fstat(f_r.fileno())
+    offset = 0
+
+    if stat.st_size == 0:
+        return False
+
+    while offset < stat.st_size:
+        length = min(MMAP_WINDOW, stat.st_size - offset)
 
-    return inodes
+        try:
+            mapped = mmap.mmap(f_r.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+        except (OSError, ValueError):
+            if offset == 0:
+                return False
+            raise
+
+        with mapped, memoryview(mapped) as view:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for pos in range(0, length, CHUNK_SIZE):
+                with view[pos:pos + CHUNK_SIZE] as piece:
+                    sha1.update(piece)
+                    if f_w is not None:
+                        f_w.write(piece)
+
+        offset += length
 
+    # The mapping shows changes of the file while it is read. Do not store a content not matching its hash.
+    after = os.fstat(f_r.fileno())
+    if (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+        raise RepositoryError("'{}' was changed while it was read".format(f_r.name))
 
-def _get_data_tag(tagname):
+    return True
+
+
+def _get_file_sha1(file):
     """
-    Returns the associated hash file name of the tag file
-    :param tagname: str
+    Calculates and return the sha1sum from a file
+    :param file: str
     :return: str
     """
-    repo = _get_repo_path()
-    try:
-        # Get inode from tag file
-        inode = os.lstat(os.path.join(repo, "tags", tagname)).st_ino
-    except:
-        exit("Tag name '{}' does not exist".format(tagname))
+    import hashlib
 
-    data = _get_repo_hashes()
+    sha1 = hashlib.sha1()
 
-    #inodes = dict()
+    with open(file, 'rb') as f:
+        if not _hash_mapped(f, sha1):
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha1.update(chunk)
 
-    for d in data:
-        if os.lstat(os.path.join(repo, "data", d)).st_ino == inode:
-            return d
+    return sha1.hexdigest()
 
 
-def _get_json_by_tag(tagname):
+def _get_string_sha1(string):
     """
-    Return existing description file or create it and return the json object
-    :param tagname: str
-    :return: dict
+    Calculates and return the sha1sum from a string
+    :param string: str
+    :return: str
     """
-    repo = _get_repo_path()
-    sha1 = _get_data_tag(tagname)
-    json_data = ''
-    try:
-        f_r = open(os.path.join(repo, "desc", sha1), 'r+')
-
-        json_data = json.loads(f_r.read())
-    except:
-        json_data = {"repo_date": str(date.today()), "tags": []}
+    import hashlib
 
-    return json_data
+    return hashlib.sha1(string).hexdigest()
 
 
-def _get_json_by_sha1(sha1):
+def _is_hash_name(name):
     """
-    Return existing description file or create it and return the json object
-    :param tagname: str
-    :return: dict
+    Check if a file name in the data directory is a hash file name and not a temporary or index file
+    :param name: str
+    :return: bool
     """
-    repo = _get_repo_path()
-    json_data = ''
-    try:
-        f_r = open(os.path.join(repo, "desc", sha1), 'r+')
-
-        json_data = json.loads(f_r.read())
-    except:
-        print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
-        raise
+    return '.' not in name
 
-    return json_data
 
+def _read_umask():
+    """
+    Read the umask of the process. Reading the umask means setting it, which is not safe while other threads create
+    files, so it is read once at import before desc --render-all or serve start their threads.
+    :return: int
+    """
+    umask = os.umask(0)
+    os.umask(umask)
 
-def _checkRepo():
-    repo = _get_repo_path()
+    return umask
 
-    if repo is None:
-        sys.exit("RMS is not set! Run 'rms init' before to create a rms repository.")
 
-    return repo
+_UMASK = _read_umask()
 
 
-def empty(args):
+def _new_file_mode(mode):
     """
-    Print help lines if no arguments
-    :param args: dict
-    :return: None
+    Returns the permissions of a file created with mode under the umask of the process
+    :param mode: int
+    :return: int
     """
-    args.p.print_help()
+    return mode & ~_UMASK
 
 
-def init(args):
+def _write_file(path, data):
     """
-    Initiate a new repository
-    :param args: dict
+    Write data to a temporary file next to path and rename it to path afterwards. The data is on disk before
+    the rename so path holds either the old or the complete new data after a crash. Use _fsync_path on the
+    directory to make the rename itself durable.
+    :param path: str
+    :param data: bytes
+    :return: None
+    """
+    import tempfile
+
+    fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=os.path.dirname(path))
+
+    try:
+        with os.fdopen(fd, 'wb') as f_w:
+            f_w.write(data)
+            f_w.flush()
+            os.fsync(f_w.fileno())
+
+        os.chmod(tmp, _new_file_mode(0o666))
+
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _fsync_path(path):
+    """
+    Flush a file or the entries of a directory to disk
+    :param path: str
+    :return: None
+    """
+    with _trace('fsync', 'io'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _cdc_cut(buf, start=0, min_size=CDC_MIN_SIZE, max_size=CDC_MAX_SIZE, mask=CDC_MASK):
+    """
+    Return the end of the next content defined chunk starting at start in buf
+    :param buf: bytes
+    :param start: int
+    :param min_size: int at least CDC_WINDOW
+    :param max_size: int
+    :param mask: int bits of the window checksum which have to be unset at a boundary
+    :return: int
+    """
+    import re
+    import zlib
+
+    n = min(len(buf), start + max_size)
+    first = start + min_size
+
+    if n <= first:
+        return n
+
+    if buf.find(b'\0', first, n) == -1 and buf.count(b'\n', first, n) * CDC_MAX_LINE >= n - first:
+        pos = buf.find(b'\n', first, n)
+        while pos != -1:
+            pos += 1
+            if not zlib.crc32(buf[pos - CDC_WINDOW:pos]) & mask:
+                return pos
+            pos = buf.find(b'\n', pos, n)
+    else:
+        # The anchors are found in C, so the window checksum is computed for about every 16th byte of random data
+        for match in re.compile(b'[' + re.escape(CDC_ANCHORS) + b']').finditer(buf, first, n):
+            pos = match.end()
+            if not zlib.crc32(buf[pos - CDC_WINDOW:pos]) & mask:
+                return pos
+
+    return n
+
+
+def _iter_chunks(f, min_size=CDC_MIN_SIZE, max_size=CDC_MAX_SIZE, mask=CDC_MASK):
+    """
+    Split an open file into content defined chunks, see _cdc_cut
+    :param f: file
+    :param min_size: int
+    :param max_size: int
+    :param mask: int
+    :return: generator of bytes
+    """
+    buf = b''
+    start = 0
+    eof = False
+
+    while True:
+        if len(buf) - start < max_size and not eof:
+            # Keep the buffer at least max_size ahead without copying it for every small chunk
+            buf = buf[start:]
+            start = 0
+            while len(buf) < max_size and not eof:
+                data = f.read(CHUNK_SIZE)
+                eof = not data
+                buf += data
+
+        if start == len(buf):
+            return
+
+        cut = _cdc_cut(buf, start, min_size, max_size, mask)
+        yield buf[start:cut]
+        start = cut
+
+
+def _delta_chunking(size):
+    """
+    Returns the chunk sizes and the mask matching versions of about size bytes, scaled by a power of two so the
+    content has at most DELTA_MAX_INDEX chunks
+    :param size: int
+    :return: (int, int, int) min_size, max_size and mask for _iter_chunks
+    """
+    scale = 1
+    while size > DELTA_MAX_INDEX * DELTA_MIN_SIZE * scale:
+        scale *= 2
+
+    return DELTA_MIN_SIZE * scale, DELTA_MAX_SIZE * scale, (DELTA_MASK + 1) * scale - 1
+
+
+class _PiecesFile(object):
+    """
+    Read only file over a generator of bytes, e.g. of Repository._iter_range
+    """
+
+    def __init__(self, pieces):
+        self._pieces = iter(pieces)
+        self._buf = b''
+        self._pos = 0
+
+    def read(self, n):
+        parts = []
+
+        while n > 0:
+            if self._pos == len(self._buf):
+                piece = next(self._pieces, None)
+                if piece is None:
+                    break
+                self._buf = piece
+                self._pos = 0
+                continue
+            part = self._buf[self._pos:self._pos + n]
+            self._pos += len(part)
+            n -= len(part)
+            parts.append(part)
+
+        return b''.join(parts)
+
+
+class _RangeReader(object):
+    """
+    Read ranges of a content streamed piece by piece. A range behind the previous one continues the stream, a
+    range before it starts the stream again.
+    """
+
+    def __init__(self, stream):
+        """
+        :param stream: function returning a new generator of the content
+        """
+        self._stream = stream
+        self._file = None
+        self._pos = 0
+
+    def read(self, offset, length):
+        """
+        :param offset: int
+        :param length: int
+        :return: generator of bytes
+        """
+        if self._file is None or offset < self._pos:
+            self._file = _PiecesFile(self._stream())
+            self._pos = 0
+
+        while self._pos < offset or length:
+            skip = self._pos < offset
+            data = self._file.read(min(offset - self._pos if skip else length, CHUNK_SIZE))
+            if not data:
+                raise RepositoryError("Range {}+{} is beyond the end of the content".format(offset, length))
+            self._pos += len(data)
+            if not skip:
+                length -= len(data)
+                yield data
+
+
+def _same_content(file, pieces):
+    """
+    Compare the content of a file with a content given piece by piece
+    :param file: str
+    :param pieces: iterable of bytes
+    :return: bool
+    """
+    with open(file, 'rb') as f_r:
+        for data in pieces:
+            if f_r.read(len(data)) != data:
+                return False
+        return not f_r.read(1)
+
+
+def _iter_decompressed(f_r, name):
+    """
+    Decompress an open file with a codec piece by piece
+    :param f_r: file
+    :param name: str
+    :return: generator of bytes
+    """
+    if name == 'none':
+        yield from iter(lambda: f_r.read(CHUNK_SIZE), b'')
+        return
+
+    decompressor = CODECS[name].decompressor()
+
+    for chunk in iter(lambda: f_r.read(CHUNK_SIZE), b''):
+        yield decompressor.decompress(chunk)
+
+    if hasattr(decompressor, 'flush'):
+        yield decompressor.flush()
+
+
+def _copy_json(data):
+    """
+    Deep copy of a json object. Faster to load than the copy module.
+    :param data: dict, list or value
+    :return: dict, list or value
+    """
+    if isinstance(data, dict):
+        return {k: _copy_json(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_copy_json(v) for v in data]
+    return data
+
+
+def _flatten_desc(json_data, prefix=''):
+    """
+    Yield the keys and values of a description for the description index. Every list item is a value of its own
+    and the keys of nested sections are joined with dots. The sections of the repository starting with 'repo_'
+    are left out, so only the tags and the sections of the users are found.
+    :param json_data: dict
+    :param prefix: str
+    :return: generator of (str, str) tuples
+    """
+    for key, value in json_data.items():
+        if not prefix and _is_reserved(key) and key != 'tags':
+            continue
+        if isinstance(value, dict):
+            yield from _flatten_desc(value, prefix + key + '.')
+        elif isinstance(value, list):
+            for item in value:
+                yield prefix + key, str(item)
+        elif value is not None:
+            yield prefix + key, str(value)
+
+
+def _is_chunked(json_data):
+    """
+    Check in a description whether its data file is a chunk manifest
+    :param json_data: dict
+    :return: bool
+    """
+    return json_data.get('repo_blob', {}).get('layout') == 'chunked'
+
+
+def _older_versions(json_data, sha1):
+    """
+    Returns the hash files of the older versions of a file updated by update, see Repository.update
+    :param json_data: dict description of the file
+    :param sha1: str
+    :return: list of str, empty if the file has no versions
+    """
+    return sorted(set(v['sha1'] for v in json_data.get('repo_versions') or ()) - {sha1})
+
+
+def _get_markdown(data_json, tagname):
+    """
+    Create markdown string from json object
+    :param data_json: dict
+    :param tagname: str
+    :return: str
+    """
+    aliases = ''
+
+    if len(data_json['tags']) > 1:
+        aliases = '## Aliases:\n'
+
+        for alias in data_json['tags']:
+            if alias != tagname:
+                aliases += "+ {}\n".format(alias)
+
+    markd = '''# Description File for *{tag}*
+
+## In repository since *{date}*
+
+{aliases}
+'''.format(tag=tagname, date=data_json['repo_date'], aliases=aliases, description=data_json.get('Description'))
+
+    if data_json.get('repo_versions'):
+        markd += "## Versions:\n"
+
+        for version in reversed(data_json['repo_versions']):
+            markd += "+ {} of *{}*, {} bytes\n".format(version['version'], version['date'], version['size'])
+
+        markd += "\n"
+
+    for key in data_json:
+        if _is_reserved(key):
+            continue
+        if isinstance(data_json[key], list):
+            section = "##{key}\n\n".format(key=key)
+
+            for l in data_json[key]:
+                section += "+ {val}\n".format(val=l)
+
+            markd += section + "\n"
+        elif isinstance(data_json[key], dict):
+            pass
+        else:
+           markd += "##{key}\n{val}\n\n".format(key=key, val=data_json[key])
+
+    return markd
+
+
+def _shard_dirs(name, levels):
+    """
+    Returns the shard directories of a file named after a hash, e.g. ['ab', 'cd'] for 'abcd...' and two levels
+    :param name: str
+    :param levels: int
+    :return: list
+    """
+    return [name[2 * i:2 * i + 2] for i in range(levels)]
+
+
+def _render_key(json_data, tagname, format):
+    """
+    Returns the render cache key of a description. It changes with the content of the description, the tag it is
+    rendered for, the format and the rms version.
+    :param json_data: dict
+    :param tagname: str
+    :param format: str name of a Format
+    :return: str
+    """
+    import hashlib
+
+    digest = hashlib.sha1(json.dumps(json_data, sort_keys=True).encode('utf-8'))
+    digest.update("\0{}\0{}\0{}".format(tagname, format, __version__).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+class _Renderer(object):
+    """
+    Converts descriptions to the output formats. The markdown converters and the location of wkhtmltopdf are set
+    up once and reused for all descriptions rendered by the same renderer. A renderer must not be shared between
+    threads.
+    """
+
+    def __init__(self):
+        self._markdown = {}
+        self._pdfkit = None
+
+    def _html(self, text, output_format):
+        if output_format not in self._markdown:
+            from markdown import Markdown
+            self._markdown[output_format] = Markdown(output_format=output_format)
+
+        return self._markdown[output_format].reset().convert(text)
+
+    def render(self, json_data, tagname, format):
+        """
+        Render a description
+        :param json_data: dict
+        :param tagname: str
+        :param format: str name of a Format
+        :return: bytes
+        """
+        if format == Format(1).name: # markdown
+            return _get_markdown(json_data, tagname).encode('utf-8')
+        elif format == Format(2).name: # html5
+            header = '<!DOCTYPE html><html><head><meta charset="UTF-8"><title>{}</title></head><body>'.format(tagname)
+            footer = '</body></html>'
+            return (header + self._html(_get_markdown(json_data, tagname), 'html5') + footer).encode('utf-8')
+        elif format == Format(3).name: # pdf
+            import pdfkit
+            if self._pdfkit is None:
+                self._pdfkit = pdfkit.configuration()
+            options = {
+                'page-size': 'A4',
+                'encoding': "UTF-8"
+            }
+            return pdfkit.from_string(self._html(_get_markdown(json_data, tagname), 'html4'), False, options=options,
+                                      configuration=self._pdfkit)
+        elif format == Format(4).name: # json
+            return json.dumps(json_data,sort_keys=True, indent=2).encode('utf-8')
+
+        raise RepositoryError("Unknown output format: {}".format(format))
+
+
+class _PackWriter(object):
+    """
+    Appends hash files to the pack files of a repository. A new pack named by the next number is started when the
+    current pack reached pack_size.
+    """
+
+    def __init__(self, pack_dir, pack_size, current=None):
+        """
+        :param pack_dir: str
+        :param pack_size: int
+        :param current: str name of a pack to continue
+        """
+        self._dir = pack_dir
+        self._size = pack_size
+        self._f = None
+        self.name = current
+
+    def append(self, sha1, data):
+        """
+        Append a hash file
+        :param sha1: str
+        :param data: bytes
+        :return: (str, int) name of the pack and offset of the record
+        """
+        if self._f is None or self._f.tell() >= self._size:
+            self.close()
+            if self.name is None or os.path.getsize(os.path.join(self._dir, self.name)) >= self._size:
+                numbers = [int(n[:-len(PACK_SUFFIX)]) for n in os.listdir(self._dir) if n.endswith(PACK_SUFFIX)]
+                self.name = "{:08d}{}".format(max(numbers, default=0) + 1, PACK_SUFFIX)
+            self._f = open(os.path.join(self._dir, self.name), 'ab')
+
+        offset = self._f.tell()
+        self._f.write(PACK_RECORD.pack(bytes.fromhex(sha1), len(data)))
+        self._f.write(data)
+
+        return self.name, offset
+
+    def flush(self):
+        """
+        Flush the appended hash files to disk
+        :return: None
+        """
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            _fsync_path(self._dir)
+
+    def close(self):
+        if self._f is not None:
+            self.flush()
+            self._f.close()
+            self._f = None
+
+
+def _collect_files(paths, manifest, description):
+    """
+    Expand files, directory trees and manifest files to a list of files with their descriptions. Each line of
+    a manifest holds a path optionally followed by a tab and a description for this path.
+    :param paths: list of paths or (path, description) tuples
+    :param manifest: str
+    :param description: str
+    :return: list of (file, description) tuples
+    """
+    files = []
+
+    def expand(path, desc):
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    files.append((os.path.join(root, name), desc))
+        else:
+            files.append((path, desc))
+
+    for path in paths:
+        if isinstance(path, tuple):
+            expand(*path)
+        else:
+            expand(path, description)
+
+    if manifest:
+        with open(os.path.expanduser(manifest), 'r') as f_r:
+            for line in f_r:
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                path, _, desc = line.partition('\t')
+                expand(path, desc or description)
+
+    return files
+
+
+def _file_key(file):
+    """
+    Returns the stat fingerprint of a source file for the known files cache of add
+    :param file: str
+    :return: (dev, inode, size, mtime_ns) tuple or None if the file does not exist
+    """
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _sample_digest(file, size):
+    """
+    Hash SAMPLE_BLOCKS blocks of SAMPLE_SIZE bytes evenly spread over a file. Small files are hashed completely.
+    :param file: str
+    :param size: int
+    :return: str
+    """
+    import hashlib
+
+    digest = hashlib.sha1(str(size).encode('utf-8'))
+
+    with open(file, 'rb') as f_r:
+        if size <= SAMPLE_BLOCKS * SAMPLE_SIZE:
+            digest.update(f_r.read())
+        else:
+            for i in range(SAMPLE_BLOCKS):
+                f_r.seek((size - SAMPLE_SIZE) * i // (SAMPLE_BLOCKS - 1))
+                digest.update(f_r.read(SAMPLE_SIZE))
+
+    return digest.hexdigest()
+
+
+def _ingest_file(file, codec, chunked=False, seekable=False, remember=False, repo=None):
+    """
+    Store a file in the repository. This is the work done for each file by the worker processes of add.
+    :param file: str
+    :param codec: str
+    :param chunked: bool
+    :param seekable: bool
+    :param remember: bool also return the stat fingerprint and sample digest of the file for the known files cache
+    :param repo: Repository. Default is the repository of the worker process.
+    :return: (tuple see Repository._ingest, fingerprint, sample digest) tuple
+    """
+    key = _file_key(file) if remember else None
+    ingested = (repo or _worker_repo)._ingest(file, codec, chunked, seekable)
+    sample = None
+
+    if key is not None and ingested[1] is not None:
+        try:
+            sample = _sample_digest(file, key[2])
+        except FileNotFoundError:
+            key = None
+
+    return ingested, key, sample
+
+
+def _verify_file(sha1, chunked=False, repo=None):
+    """
+    Hash a hash file of the repository again. This is the work done for each file by the worker processes of
+    verify. Chunk manifests are checked by hashing the content of their chunks.
+    :param sha1: str
+    :param chunked: bool
+    :param repo: Repository. Default is the repository of the worker process.
+    :return: (str, bool) sha1 and whether the content matches it
+    """
+    import hashlib
+
+    repo = repo or _worker_repo
+
+    with _trace('hash', chunked=chunked) as span:
+        if not chunked:
+            data = repo._data_path(sha1)
+            span.add(os.path.getsize(data))
+            return sha1, _get_file_sha1(data) == sha1
+
+        digest = hashlib.sha1()
+
+        try:
+            for data in repo._iter_range(sha1, {'layout': 'chunked'}):
+                digest.update(data)
+                span.add(len(data))
+        except Exception:
+            # Missing or broken chunks or manifest
+            return sha1, False
+
+        return sha1, digest.hexdigest() == sha1
+
+
+class Repository(object):
+    """
+    A rms repository. All operations of the command line interface are available as methods which return their
+    results instead of printing them and raise RepositoryError instead of exiting.
+
+    Writers in several processes are synchronized by locks on the tags and hash files they touch. Use one
+    Repository object per process and repository, the locks of a process are released with any of its
+    descriptors of the lock file. Repository objects are not thread safe.
+
+    The object is meant to be kept alive by programs working with the repository. The inodes of the hash files,
+    the resolved tags and the parsed descriptions are cached in memory. The caches are checked against the
+    modification times of the data directory, the tag files and the description files, so changes made by other
+    processes are noticed.
+    """
+
+    def __init__(self, path=None):
+        """
+        Open the repository at path (the .rms directory). Default is the RMS environment variable.
+        :param path: str
+        """
+        if path is None:
+            path = _get_repo_path()
+
+        if path is None:
+            raise RepositoryError("RMS is not set! Run 'rms init' before to create a rms repository.")
+
+        if not os.path.isdir(os.path.join(path, "data")):
+            raise RepositoryError("There is no repository at '{}'".format(path))
+
+        self.path = path
+        self._index = None
+        self._packs = None
+        self._fts = False
+        self._lock_fd = None
+        self._held_locks = set()
+        self._config = None
+        self._inodes_cache = None  # (mtime of the data directory, {inode: sha1})
+        self._tags_cache = dict()  # tag: (inode, size, sha1)
+        self._descs_cache = dict() # sha1: (mtime, size, json object)
+
+    def close(self):
+        """
+        Close the lock file and the databases of the repository. All locks of the process on the repository are
+        released with the lock file. The databases and the lock file are opened again when needed.
+        :return: None
+        """
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            self._held_locks.clear()
+
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+        if self._packs is not None:
+            self._packs.close()
+            self._packs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def create(cls, parent, codec=DEFAULT_CODEC, sharded=False):
+        """
+        Create a new repository in the directory .rms of parent
+        :param parent: str
+        :param codec: str default compression codec of text files
+        :param sharded: bool store hash files and descriptions in SHARD_LEVELS levels of subdirectories named after
+                        the first characters of their hash to keep the directories small
+        :return: Repository
+        :raise FileExistsError: if the repository already exists
+        """
+        _parse_codec(codec)
+
+        path = os.path.join(parent, ".rms")
+
+        os.makedirs(os.path.join(path, "data"))
+        os.makedirs(os.path.join(path, "tags"))
+        os.makedirs(os.path.join(path, "desc"))
+        os.makedirs(os.path.join(path, "chunks"))
+        with open(os.path.join(path, CONFIG_FILE), 'w') as f_w:
+            json.dump({'codec': codec, 'shards': SHARD_LEVELS if sharded else 0}, f_w, indent=2)
+
+        return cls(path)
+
+    def config(self):
+        """
+        Read the repository configuration
+        :return: dict
+        """
+        if self._config is None:
+            self._config = {'codec': DEFAULT_CODEC}
+
+            try:
+                with open(os.path.join(self.path, CONFIG_FILE), 'r') as f_r:
+                    self._config.update(json.loads(f_r.read()))
+            except FileNotFoundError:
+                pass
+
+        return self._config
+
+    # Layout
+
+    def _hash_path(self, kind, name):
+        """
+        Returns the path of a file named after a hash in the data or desc directory. While the repository is
+        migrated to another layout, files not moved yet are found at their old path.
+        :param kind: str "data" or "desc"
+        :param name: str hash or hash with suffix
+        :return: str
+        """
+        config = self.config()
+        path = os.path.join(self.path, kind, *_shard_dirs(name, config.get('shards', 0)), name)
+
+        if 'migrate_from' in config and not os.path.lexists(path):
+            old = os.path.join(self.path, kind, *_shard_dirs(name, config['migrate_from']), name)
+            if os.path.lexists(old):
+                return old
+
+        return path
+
+    def _data_path(self, sha1):
+        """
+        Returns the path of a hash file
+        :param sha1: str
+        :return: str
+        """
+        return self._hash_path("data", sha1)
+
+    def _desc_path(self, sha1):
+        """
+        Returns the path of a description file
+        :param sha1: str
+        :return: str
+        """
+        return self._hash_path("desc", sha1)
+
+    def _make_dirs(self, path):
+        """
+        Create the missing shard directories of a path durably
+        :param path: str
+        :return: None
+        """
+        parent = os.path.dirname(path)
+
+        if not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+            while os.path.dirname(parent) != self.path:
+                _fsync_path(os.path.dirname(parent))
+                parent = os.path.dirname(parent)
+
+    def _scan(self, kind):
+        """
+        Iterate over the directory entries of the files in the data or desc directory including the shard
+        directories
+        :param kind: str "data" or "desc"
+        :return: generator of os.DirEntry
+        """
+        config = self.config()
+        levels = max(config.get('shards', 0), config.get('migrate_from', 0))
+
+        def scan(path, level):
+            with os.scandir(path) as it:
+                entries = list(it)
+            for entry in entries:
+                if level < levels and len(entry.name) == 2 and entry.is_dir(follow_symlinks=False):
+                    yield from scan(entry.path, level + 1)
+                else:
+                    yield entry
+
+        return scan(os.path.join(self.path, kind), 0)
+
+    def migrate(self, sharded, progress=None):
+        """
+        Move the hash files and descriptions of the repository to the flat or the sharded layout. The files are
+        moved one by one under the lock of their hash. An interrupted migration is completed by running it again,
+        meanwhile files are looked up at both paths. Other processes using the repository have to be restarted.
+        :param sharded: bool
+        :param progress: function called with the number of moved files and the number of all files
+        :return: int number of moved files
+        """
+        config = self.config()
+        levels = SHARD_LEVELS if sharded else 0
+
+        if config.get('shards', 0) == levels and 'migrate_from' not in config:
+            return 0
+
+        if 'migrate_from' not in config:
+            config['migrate_from'] = config.get('shards', 0)
+        config['shards'] = levels
+        self._write_config()
+
+        moves = []
+        for kind in ("data", "desc"):
+            for entry in self._scan(kind):
+                sha1 = entry.name[:40]
+                if _is_hash_name(sha1) and entry.name in (sha1, sha1 + BLOCK_SUFFIX):
+                    path = os.path.join(self.path, kind, *_shard_dirs(entry.name, levels), entry.name)
+                    if entry.path != path:
+                        moves.append((sha1, entry.path, path))
+
+        touched = set()
+
+        for i, (sha1, src, dst) in enumerate(moves, 1):
+            with self._locked(['hash:' + sha1]):
+                self._make_dirs(dst)
+                try:
+                    os.rename(src, dst)
+                except FileNotFoundError:
+                    pass  # Removed meanwhile
+            touched.update((os.path.dirname(src), os.path.dirname(dst)))
+            if progress is not None:
+                progress(i, len(moves))
+
+        # The old paths are not searched anymore after the migration. The renames have to be on disk before.
+        for kind in ("data", "desc"):
+            for root, dirs, files in os.walk(os.path.join(self.path, kind), topdown=False):
+                if root != os.path.join(self.path, kind) and not os.listdir(root):
+                    os.rmdir(root)
+                    touched.discard(root)
+                    touched.add(os.path.dirname(root))
+        for path in touched:
+            _fsync_path(path)
+
+        del config['migrate_from']
+        self._write_config()
+        self._inodes_cache = None
+
+        return len(moves)
+
+    def _write_config(self):
+        """
+        Write the repository configuration
+        :return: None
+        """
+        _write_file(os.path.join(self.path, CONFIG_FILE), json.dumps(self.config(), indent=2).encode('utf-8'))
+        _fsync_path(self.path)
+
+    # Tag index
+
+    def _get_index(self):
+        """
+        Open the index of the repository. The index holds the tags, the chunk references, the references to older
+        versions and the descriptions for searching. It is created or rebuilt on first use.
+        :return: sqlite3.Connection
+        """
+        import sqlite3
+
+        if self._index is None:
+            with _trace('open index', 'io'):
+                self._index = sqlite3.connect(os.path.join(self.path, INDEX_FILE), timeout=600)
+                version = self._index.execute("PRAGMA user_version").fetchone()[0]
+                with self._index:
+                    self._index.execute("CREATE TABLE IF NOT EXISTS tags (tag TEXT PRIMARY KEY, sha1 TEXT NOT NULL, "
+                                        "inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL)")
+                    self._index.execute("CREATE INDEX IF NOT EXISTS tags_sha1 ON tags (sha1)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS manifests (sha1 TEXT PRIMARY KEY, "
+                                        "size INTEGER NOT NULL)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS chunks (sha1 TEXT PRIMARY KEY, "
+                                        "size INTEGER NOT NULL, stored INTEGER NOT NULL, refs INTEGER NOT NULL)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS chains (sha1 TEXT PRIMARY KEY, "
+                                        "versions TEXT NOT NULL)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS versions (sha1 TEXT PRIMARY KEY, "
+                                        "refs INTEGER NOT NULL)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS descs (sha1 TEXT PRIMARY KEY, repo_date TEXT)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS verified (sha1 TEXT PRIMARY KEY, "
+                                        "inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS known_files (dev INTEGER NOT NULL, "
+                                        "inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+                                        "options TEXT NOT NULL, sha1 TEXT NOT NULL, mime BLOB, blob TEXT NOT NULL, "
+                                        "sample TEXT, PRIMARY KEY (dev, inode, options))")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS blobs (sha1 TEXT PRIMARY KEY, "
+                                        "size INTEGER NOT NULL, mime TEXT, codec TEXT NOT NULL, layout TEXT)")
+                    self._index.execute("CREATE INDEX IF NOT EXISTS descs_date ON descs (repo_date)")
+                    self._index.execute("CREATE TABLE IF NOT EXISTS desc_values (sha1 TEXT NOT NULL, "
+                                        "key TEXT NOT NULL, value TEXT NOT NULL)")
+                    self._index.execute("CREATE INDEX IF NOT EXISTS desc_values_key ON desc_values "
+                                        "(key, value COLLATE NOCASE)")
+                    self._index.execute("CREATE INDEX IF NOT EXISTS desc_values_sha1 ON desc_values (sha1)")
+                    try:
+                        # Full text index of the descriptions. The rowid is the rowid of the descs table.
+                        self._index.execute("CREATE VIRTUAL TABLE IF NOT EXISTS desc_text USING fts5 (text)")
+                        self._fts = True
+                    except sqlite3.OperationalError:
+                        # SQLite without FTS5. Full text queries fall back to substring search.
+                        self._fts = False
+
+                if version < INDEX_VERSION:
+                    self.reindex()
+                    self._index.execute("PRAGMA user_version = {}".format(INDEX_VERSION))
+
+        return self._index
+
+    def _index_set_many(self, tags):
+        """
+        Add or update several tags in the tag index within one transaction
+        :param tags: list of (tagname, sha1) tuples
+        :return: None
+        """
+        rows = []
+
+        for tagname, sha1 in tags:
+            stat = os.lstat(os.path.join(self.path, "tags", tagname))
+            rows.append((tagname, sha1, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            self._tags_cache[tagname] = (stat.st_ino, stat.st_size, sha1)
+
+        with self._get_index() as index:
+            index.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _index_remove(self, tagname):
+        """
+        Remove a tag from the tag index
+        :param tagname: str
+        :return: None
+        """
+        self._tags_cache.pop(tagname, None)
+
+        with self._get_index() as index:
+            index.execute("DELETE FROM tags WHERE tag = ?", (tagname,))
+
+    def reindex(self):
+        """
+        Rebuild the tag index from the hardlinks in the tags directory. The tags of packed hash files are only
+        kept in the pack database. The references to older versions are rebuilt from the descriptions of the
+        updated files.
+        :return: int number of indexed tags
+        """
+        rows = []
+        tagged = set()
+        for sha1, tagname in self.list_tags():
+            if sha1 is not None:
+                tagged.add(sha1)
+                try:
+                    stat = os.lstat(os.path.join(self.path, "tags", tagname))
+                except FileNotFoundError:
+                    continue  # Packed
+                rows.append((tagname, sha1, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
+        self._tags_cache.clear()
+
+        with self._get_index() as index:
+            index.execute("DELETE FROM tags")
+            index.executemany("INSERT INTO tags VALUES (?, ?, ?, ?, ?)", rows)
+            index.execute("DELETE FROM manifests")
+            index.execute("DELETE FROM chunks")
+            index.execute("DELETE FROM chains")
+            index.execute("DELETE FROM versions")
+            index.execute("DELETE FROM descs")
+            index.execute("DELETE FROM desc_values")
+            if self._fts:
+                index.execute("DELETE FROM desc_text")
+
+        descs = []
+        for entry in self._scan("desc"):
+            if _is_hash_name(entry.name):
+                descs.append((entry.name, self._read_desc(entry.name)))
+        if self._get_packs() is not None:
+            descs += [(sha1, json.loads(desc)) for sha1, desc in self._get_packs().execute("SELECT sha1, desc "
+                                                                                            "FROM objects")]
+
+        # The files of the tags and the older versions of updated files keep their chunks
+        chains = [(sha1, _older_versions(json_data, sha1)) for sha1, json_data in descs
+                  if json_data is not None and json_data.get('repo_versions')]
+        self._index_set_chains(chains)
+
+        manifests = []
+        for sha1 in tagged.union(*(older for sha1, older in chains)):
+            json_data = self._read_desc(sha1)
+            if json_data is not None and _is_chunked(json_data):
+                manifest = self._get_manifest(sha1)
+                manifests.append((sha1, manifest['size'],
+                                  [[c, size, os.path.getsize(os.path.join(self.path, "chunks", c))]
+                                   for c, size in manifest['chunks']]))
+        self._index_add_manifests(manifests)
+
+        self._index_descs(descs)
+
+        return len(rows)
+
+    def _index_descs(self, descs):
+        """
+        Add or update descriptions in the description index within one transaction
+        :param descs: list of (sha1, json_data) tuples
+        :return: None
+        """
+        with self._get_index() as index:
+            for sha1, json_data in descs:
+                self._unindex_desc(index, sha1)
+
+                rowid = index.execute("INSERT INTO descs VALUES (?, ?)",
+                                      (sha1, json_data.get('repo_date'))).lastrowid
+                values = list(_flatten_desc(json_data))
+                index.executemany("INSERT INTO desc_values VALUES (?, ?, ?)",
+                                  [(sha1, key, value) for key, value in values])
+                if self._fts:
+                    index.execute("INSERT INTO desc_text (rowid, text) VALUES (?, ?)",
+                                  (rowid, "\n".join("{} {}".format(key, value) for key, value in values)))
+
+    def _unindex_desc(self, index, sha1):
+        """
+        Remove a description from the description index
+        :param index: sqlite3.Connection
+        :param sha1: str
+        :return: None
+        """
+        row = index.execute("SELECT rowid FROM descs WHERE sha1 = ?", (sha1,)).fetchone()
+
+        if row is not None:
+            if self._fts:
+                index.execute("DELETE FROM desc_text WHERE rowid = ?", row)
+            index.execute("DELETE FROM desc_values WHERE sha1 = ?", (sha1,))
+            index.execute("DELETE FROM descs WHERE sha1 = ?", (sha1,))
+
+    def search(self, text=None, where=(), since=None, until=None):
+        """
+        Search files by their descriptions. All given conditions have to match.
+        :param text: str full text query over the keys and values of the descriptions (SQLite FTS5 syntax)
+        :param where: list of (key, value) tuples. The values are compared case insensitive.
+        :param since: str first repo_date (YYYY-MM-DD)
+        :param until: str last repo_date (YYYY-MM-DD)
+        :return: list of (sha1, tag) tuples
+        """
+        import sqlite3
+
+        index = self._get_index()
+        query = "SELECT d.sha1 FROM descs d WHERE 1"
+        params = []
+
+        for key, value in where:
+            query += " AND d.sha1 IN (SELECT sha1 FROM desc_values WHERE key = ? AND value = ? COLLATE NOCASE)"
+            params += [key, value]
+
+        if text and self._fts:
+            query += " AND d.rowid IN (SELECT rowid FROM desc_text WHERE desc_text MATCH ?)"
+            params.append(text)
+        elif text:
+            for word in text.split():
+                query += " AND d.sha1 IN (SELECT sha1 FROM desc_values WHERE key LIKE ? OR value LIKE ?)"
+                params += ["%{}%".format(word)] * 2
+
+        if since:
+            query += " AND d.repo_date >= ?"
+            params.append(since)
+
+        if until:
+            query += " AND d.repo_date <= ?"
+            params.append(until)
+
+        try:
+            found = index.execute("SELECT sha1, tag FROM tags WHERE sha1 IN ({})".format(query), params).fetchall()
+            packs = self._get_packs()
+            if packs is not None:
+                # The tags of packed hash files are in another database
+                sha1s = [r[0] for r in index.execute(query, params)]
+                for start in range(0, len(sha1s), 500):
+                    part = sha1s[start:start + 500]
+                    found += packs.execute("SELECT sha1, tag FROM tags WHERE sha1 IN ({})".format(
+                        ", ".join("?" * len(part))), part).fetchall()
+        except sqlite3.OperationalError as e:
+            raise RepositoryError("Invalid search query '{}': {}".format(text, e))
+
+        return sorted(found)
+
+    def verify(self, jobs=1, full=False, progress=None):
+        """
+        Check the repository. Every hash file is hashed again unless it did not change since it was verified the
+        last time, judged by its inode, size and modification time. Packed hash files are small and hashed on every
+        run. The tags and descriptions are checked against the hardlinks and the tags in the pack database.
+        :param jobs: int number of processes hashing files
+        :param full: bool hash all files regardless of earlier runs
+        :param progress: function called with the number of hashed files and the number of files to hash
+        :return: VerifyResult
+        """
+        import hashlib
+
+        hashes = sorted(self.hashes())
+
+        tags = collections.defaultdict(list)
+        dangling = []
+        for sha1, tagname in self.list_tags():
+            if sha1 is None:
+                dangling.append(tagname)
+            else:
+                tags[sha1].append(tagname)
+
+        index = self._get_index()
+        cache = {} if full else {r[0]: tuple(r[1:]) for r in
+                                 index.execute("SELECT sha1, inode, size, mtime FROM verified")}
+
+        # A chunked file added under a tag of another file has a manifest but no description
+        manifests = set(r[0] for r in index.execute("SELECT sha1 FROM manifests"))
+        stats = dict()
+        descs = dict()
+        todo = []
+        for sha1 in hashes:
+            stat = os.lstat(self._data_path(sha1))
+            stats[sha1] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            descs[sha1] = self._read_desc(sha1)
+            if cache.get(sha1) != stats[sha1]:
+                todo.append((sha1, _is_chunked(descs[sha1]) if descs[sha1] is not None else sha1 in manifests))
+
+        pool = None
+
+        if len(todo) > 1 and jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(jobs, initializer=_start_worker, initargs=(self.path, _trace_path()))
+            checked = pool.map(_verify_file, *zip(*todo), chunksize=max(1, len(todo) // (4 * jobs)))
+        else:
+            checked = (_verify_file(sha1, chunked, self) for sha1, chunked in todo)
+
+        corrupt = []
+        verified = []
+
+        try:
+            for i, (sha1, ok) in enumerate(checked, 1):
+                if ok:
+                    verified.append((sha1,) + stats[sha1])
+                else:
+                    corrupt.append(sha1)
+                if progress is not None:
+                    progress(i, len(todo))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        with index:
+            index.executemany("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)", verified)
+            index.executemany("DELETE FROM verified WHERE sha1 = ?",
+                              [(sha1,) for sha1 in set(cache) - set(stats)] + [(sha1,) for sha1 in corrupt])
+
+        orphan_descs = sorted(entry.name for entry in self._scan("desc")
+                              if _is_hash_name(entry.name) and entry.name not in stats)
+
+        out_of_sync = []
+        for sha1 in hashes:
+            if tags[sha1] and (descs[sha1] is None or sorted(descs[sha1]['tags']) != sorted(tags[sha1])):
+                out_of_sync.append((sha1, None if descs[sha1] is None else descs[sha1]['tags'], tags[sha1]))
+
+        # Older versions of updated files have no tags
+        versions = set(r[0] for r in index.execute("SELECT sha1 FROM versions WHERE refs > 0"))
+        untagged = [sha1 for sha1 in hashes if not tags[sha1] and sha1 not in versions]
+
+        packs = self._get_packs()
+        packed = packs.execute("SELECT sha1, desc FROM objects").fetchall() if packs is not None else []
+        for sha1, desc in packed:
+            try:
+                if hashlib.sha1(self._read_packed(sha1) or b'').hexdigest() != sha1:
+                    corrupt.append(sha1)
+            except (RepositoryError, FileNotFoundError):
+                corrupt.append(sha1)
+            listed = json.loads(desc)['tags']
+            if not tags[sha1]:
+                if sha1 not in versions:
+                    untagged.append(sha1)
+            elif sorted(listed) != sorted(tags[sha1]):
+                out_of_sync.append((sha1, listed, tags[sha1]))
+
+        return VerifyResult(len(todo) + len(packed), len(hashes) - len(todo), corrupt, dangling, orphan_descs,
+                            untagged, out_of_sync)
+
+    # Locks
+
+    def _get_lock_fd(self):
+        """
+        Open the lock file of the repository
+        :return: int
+        """
+        if self._lock_fd is None:
+            self._lock_fd = os.open(os.path.join(self.path, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o666)
+
+        return self._lock_fd
+
+    def _locked(self, keys, shared=False):
+        """
+        Lock keys for the time of a with statement, see _Locks
+        :param keys: list of str
+        :param shared: bool
+        :return: _Locks
+        """
+        return _Locks(self, keys, shared)
+
+    # Journal
+
+    def _commit(self, steps):
+        """
+        Apply the steps of a mutation touching several files. The steps are written to a journal file before and
+        the journal file is removed after all steps were applied. The journal of a crashed process is replayed by
+        recover. All steps are idempotent so replaying partly applied steps is safe.
+        :param steps: list of steps, see _apply
+        :return: None
+        """
+        import tempfile
+
+        if not steps:
+            return
+
+        journal_dir = os.path.join(self.path, "journal")
+        os.makedirs(journal_dir, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=journal_dir)
+        path = os.path.join(journal_dir, os.path.basename(tmp)[len(TMP_PREFIX):])
+
+        with os.fdopen(fd, 'w') as f_w:
+            with _trace('journal', 'io', steps=len(steps)):
+                # The lock tells recover that the mutation is still running
+                fcntl.flock(f_w, fcntl.LOCK_EX)
+                json.dump(steps, f_w)
+                f_w.flush()
+                os.fsync(f_w.fileno())
+                os.rename(tmp, path)
+                _fsync_path(journal_dir)
+
+            try:
+                with _trace('apply', 'io', steps=len(steps)):
+                    self._apply(steps)
+            except Exception:
+                # A failed step is no crash. Leave the repository as the step left it.
+                os.remove(path)
+                raise
+
+            os.remove(path)
+
+    def _apply(self, steps):
+        """
+        Apply the steps of a mutation. A step is a list starting with its name:
+        ['link', sha1, tag]         add a tag to a hash file
+        ['unlink', tag]             remove a tag
+        ['desc', sha1, json_data]   write the description of a hash file
+        ['manifests', manifests]    count the chunk references of new chunk manifests, see _index_add_manifests
+        ['versions', sha1, older]   set the older versions an updated file refers to, see _index_set_chains
+        ['drop', sha1]              remove a hash file without tags and its description
+        :param steps: list
+        :return: None
+        """
+        tags_dir = os.path.join(self.path, "tags")
+        links = []
+        packed_links = []
+        descs = []
+        manifests = []
+        chains = []
+        dropped = set()
+
+        for step in steps:
+            if step[0] == 'link':
+                sha1, tagname = step[1:]
+                data = self._data_path(sha1)
+                if not os.path.exists(data) and self._packed(sha1) is not None:
+                    if not os.path.lexists(os.path.join(tags_dir, tagname)):
+                        packed_links.append((tagname, sha1))
+                    continue
+                try:
+                    os.link(data, os.path.join(tags_dir, tagname))
+                except FileExistsError:
+                    # Already linked before a crash or meanwhile to another file
+                    if os.lstat(os.path.join(tags_dir, tagname)).st_ino != os.lstat(data).st_ino:
+                        continue
+                links.append((tagname, sha1))
+            elif step[0] == 'unlink':
+                try:
+                    os.remove(os.path.join(tags_dir, step[1]))
+                except FileNotFoundError:
+                    pass
+                self._index_remove(step[1])
+                if self._get_packs() is not None:
+                    with self._get_packs() as packs:
+                        packs.execute("DELETE FROM tags WHERE tag = ?", (step[1],))
+            elif step[0] == 'desc':
+                descs.append((step[1], step[2]))
+            elif step[0] == 'manifests':
+                manifests += step[1]
+            elif step[0] == 'versions':
+                chains.append((step[1], step[2]))
+            elif step[0] == 'drop':
+                dropped.add(os.path.dirname(self._data_path(step[1])))
+                self._drop(step[1])
+            else:
+                raise RepositoryError("Unknown journal step '{}'".format(step[0]))
+
+        if links or any(step[0] == 'unlink' for step in steps):
+            _fsync_path(tags_dir)
+        for path in dropped:
+            _fsync_path(path)
+
+        self._index_set_many(links)
+        if packed_links:
+            # Like a tag file already linked to another file, a tag taken meanwhile is not replaced
+            with self._get_packs() as packs:
+                packs.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?)", packed_links)
+        self._write_descs(descs)
+        self._index_add_manifests(manifests)
+        self._index_set_chains(chains)
+
+    def _drop(self, sha1):
+        """
+        Remove a hash file with its block index, chunk references, references to older versions and description if
+        it has no tags and is no older version of another file. Packed hash files are removed from the pack
+        database, their space is freed by repack.
+        :param sha1: str
+        :return: None
+        """
+        data = self._data_path(sha1)
+
+        if self._version_refs(sha1):
+            return  # An older version of an updated file
+
+        if os.path.exists(data):
+            if os.lstat(data).st_nlink > 1:
+                return  # Tagged again
+            json_data = self._read_desc(sha1)
+            if json_data is None or _is_chunked(json_data):
+                self._index_remove_manifest(sha1)
+        elif self._packed(sha1) is not None:
+            with self._get_packs() as packs:
+                if packs.execute("SELECT 1 FROM tags WHERE sha1 = ?", (sha1,)).fetchone() is not None:
+                    # Tagged again, or a description left behind by an interrupted repack
+                    try:
+                        os.remove(self._desc_path(sha1))
+                    except FileNotFoundError:
+                        pass
+                    self._descs_cache.pop(sha1, None)
+                    return
+                packs.execute("DELETE FROM objects WHERE sha1 = ?", (sha1,))
+
+        # The description goes last. It tells a replay how the data file was stored.
+        for path in (self._hash_path("data", sha1 + BLOCK_SUFFIX), data, self._desc_path(sha1)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        self._descs_cache.pop(sha1, None)
+        self._index_set_chains([(sha1, [])])
+        with self._get_index() as index:
+            self._unindex_desc(index, sha1)
+            index.execute("DELETE FROM blobs WHERE sha1 = ?", (sha1,))
+            index.execute("DELETE FROM versions WHERE sha1 = ? AND refs <= 0", (sha1,))
+
+    def recover(self):
+        """
+        Replay the journals of mutations interrupted by a crash. Journals still locked by a running process are
+        skipped. Journals which were not completely written are removed as none of their steps were applied.
+        :return: int number of replayed journals
+        """
+        journal_dir = os.path.join(self.path, "journal")
+        replayed = 0
+
+        try:
+            names = sorted(os.listdir(journal_dir))
+        except FileNotFoundError:
+            return 0
+
+        for name in names:
+            path = os.path.join(journal_dir, name)
+
+            try:
+                f_r = open(path, 'r')
+            except FileNotFoundError:
+                continue  # Finished meanwhile
+
+            with f_r:
+                try:
+                    fcntl.flock(f_r, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # Still running
+
+                if not os.path.exists(path):
+                    continue  # Finished between open and lock
+                if name.startswith(TMP_PREFIX):
+                    # An empty one may just have been created by a process not holding the lock yet
+                    if os.fstat(f_r.fileno()).st_size:
+                        os.remove(path)
+                    continue
+
+                steps = json.loads(f_r.read())
+                with self._locked(['tag:' + step[-1] for step in steps if step[0] in ('link', 'unlink')]):
+                    with self._locked(['hash:' + step[1] for step in steps
+                                       if step[0] in ('link', 'desc', 'versions', 'drop')]):
+                        self._apply(steps)
+                os.remove(path)
+                replayed += 1
+
+        if replayed:
+            self._sweep_versions()
+            self._sweep_chunks()
+
+        return replayed
+
+    # Hash files and tags
+
+    def _inodes(self):
+        """
+        Returns a dictionary of the inodes of all hash files. It is cached as long as the data directory does
+        not change.
+        :return: dict
+        """
+        config = self.config()
+
+        # The mtime of the data directory only tells about changes of the flat layout
+        if config.get('shards', 0) or 'migrate_from' in config:
+            with _trace('list data', 'io', sharded=True):
+                return {entry.inode(): entry.name for entry in self._scan("data") if _is_hash_name(entry.name)}
+
+        data_dir = os.path.join(self.path, "data")
+        mtime = os.stat(data_dir).st_mtime_ns
+
+        if self._inodes_cache is None or self._inodes_cache[0] != mtime:
+            inodes = dict()
+            with os.scandir(data_dir) as it, _trace('list data', 'io', sharded=False):
+                for entry in it:
+                    if _is_hash_name(entry.name):
+                        inodes[entry.inode()] = entry.name
+            self._inodes_cache = (mtime, inodes)
+
+        return self._inodes_cache[1]
+
+    def hashes(self):
+        """
+        Returns all hash file names in the repository
+        :return: set
+        """
+        return set(self._inodes().values())
+
+    def list_tags(self, pattern=None):
+        """
+        Join tag files with their hash files by inode. The inode numbers are taken from the directory entries so
+        no file has to be stat'ed. In the sharded layout the hash files of the tags are taken from the tag index
+        and confirmed by a stat of the hash file instead of listing all shard directories. The tags of packed hash
+        files are taken from the pack database.
+        :param pattern: str shell pattern the tags have to match
+        :return: list of (sha1, tag) tuples. sha1 is None for tags without hash file
+        """
+        sharded = self.config().get('shards', 0)
+        indexed = {r[0]: r[1:] for r in self._get_index().execute("SELECT tag, sha1, inode FROM tags")} \
+            if sharded else {}
+        hashes = None if sharded else self._inodes()
+
+        tags = []
+        with os.scandir(os.path.join(self.path, "tags")) as it, _trace('list tags', 'io'):
+            for entry in it:
+                if pattern is None or fnmatch.fnmatchcase(entry.name, pattern):
+                    sha1 = None
+                    row = indexed.get(entry.name)
+                    if row is not None and row[1] == entry.inode():
+                        try:
+                            if os.lstat(self._data_path(row[0])).st_ino == row[1]:
+                                sha1 = row[0]
+                        except FileNotFoundError:
+                            pass
+                    if sha1 is None:
+                        if hashes is None:
+                            hashes = self._inodes()
+                        sha1 = hashes.get(entry.inode())
+                    tags.append((sha1, entry.name))
+
+        packs = self._get_packs()
+        if packs is not None:
+            names = set(t for s, t in tags)
+            for tagname, sha1 in packs.execute("SELECT tag, sha1 FROM tags"):
+                if tagname not in names and (pattern is None or fnmatch.fnmatchcase(tagname, pattern)):
+                    tags.append((sha1, tagname))
+
+        return sorted(tags, key=lambda t: (t[0] or '', t[1]))
+
+    def resolve(self, tagname):
+        """
+        Returns the associated hash file name of the tag file. The cached tag or the tag index are used if they
+        are up to date with the tag file, otherwise the hash files are searched for the inode of the tag file.
+        Tags without tag file are looked up in the pack database.
+        :param tagname: str
+        :return: str
+        """
+        try:
+            stat = os.lstat(os.path.join(self.path, "tags", tagname))
+        except FileNotFoundError:
+            sha1 = self._packed_tag(tagname)
+            if sha1 is None:
+                raise RepositoryError("Tag name '{}' does not exist".format(tagname))
+            return sha1
+
+        cached = self._tags_cache.get(tagname)
+        if cached is not None and cached[:2] == (stat.st_ino, stat.st_size):
+            return cached[2]
+
+        row = self._get_index().execute("SELECT sha1, inode, size FROM tags WHERE tag = ?", (tagname,)).fetchone()
+
+        if row is not None and row[1] == stat.st_ino and row[2] == stat.st_size:
+            self._tags_cache[tagname] = (stat.st_ino, stat.st_size, row[0])
+            return row[0]
+
+        sha1 = self._inodes().get(stat.st_ino)
+
+        if sha1 is None:
+            raise RepositoryError("Tag name '{}' has no file in the repository".format(tagname))
+
+        self._index_set_many([(tagname, sha1)])
+        return sha1
+
+    def aliases(self, tagname):
+        """
+        Returns all tags of the file of a tag
+        :param tagname: str
+        :return: list
+        """
+        sha1 = self.resolve(tagname)
+
+        try:
+            inode = os.lstat(os.path.join(self.path, "tags", tagname)).st_ino
+        except FileNotFoundError:
+            return sorted(r[0] for r in self._get_packs().execute("SELECT tag FROM tags WHERE sha1 = ?", (sha1,)))
+
+        with os.scandir(os.path.join(self.path, "tags")) as it:
+            return sorted(entry.name for entry in it if entry.inode() == inode)
+
+    def add_tag(self, tagname, new_tag):
+        """
+        Add a new tag for the file of a tag
+        :param tagname: str
+        :param new_tag: str
+        :return: bool False if the new tag already exists
+        """
+        new_tag = os.path.basename(new_tag)
+
+        with self._locked(['tag:' + tagname, 'tag:' + new_tag]):
+            sha1 = self.resolve(tagname)
+
+            with self._locked(['hash:' + sha1]):
+                if self._tag_exists(new_tag):
+                    return False
+
+                json_data = self.get_desc(tagname)
+                json_data['tags'].append(new_tag)
+
+                self._commit([['link', sha1, new_tag], ['desc', sha1, json_data]])
+
+        return True
+
+    def remove(self, tagname):
+        """
+        Remove a tag. If the last tag of a file was removed also the file itself with its description file is
+        removed.
+        :param tagname: str
+        :return: list of the remaining tags of the file
+        """
+        with self._locked(['tag:' + tagname]):
+            sha1 = self.resolve(tagname)
+
+            with self._locked(['hash:' + sha1]):
+                json_data = self._read_desc(sha1)
+
+                # Get inode count. The data file and this tag are left for the last tag.
+                try:
+                    last = os.lstat(self._data_path(sha1)).st_nlink <= 2
+                except FileNotFoundError:
+                    last = self._get_packs().execute("SELECT count(*) FROM tags WHERE sha1 = ?",
+                                                     (sha1,)).fetchone()[0] <= 1
+
+                # Older versions of updated files stay without tags
+                if last and not self._version_refs(sha1):
+                    self._commit([['unlink', tagname], ['drop', sha1]])
+                    dropped = True
+                else:
+                    steps = [['unlink', tagname]]
+
+                    if json_data is not None and tagname in json_data['tags']:
+                        json_data['tags'].remove(tagname)
+                        steps.append(['desc', sha1, json_data])
+
+                    self._commit(steps)
+                    dropped = False
+
+        if dropped:
+            if json_data is not None and json_data.get('repo_versions'):
+                self._sweep_versions()
+            if json_data is not None and (_is_chunked(json_data) or json_data.get('repo_versions')):
+                self._sweep_chunks()
+            return []
+
+        if json_data is None:
+            return [t for s, t in self.list_tags() if s == sha1]
+
+        return json_data['tags']
+
+    # Descriptions
+
+    def _read_desc(self, sha1):
+        """
+        Returns a copy of the description of a hash file or None if there is none. Parsed descriptions are cached
+        as long as the description file does not change. The descriptions of packed hash files are read from the
+        pack database.
+        :param sha1: str
+        :return: dict
+        """
+        path = self._desc_path(sha1)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._descs_cache.pop(sha1, None)
+            packs = self._get_packs()
+            row = packs.execute("SELECT desc FROM objects WHERE sha1 = ?", (sha1,)).fetchone() if packs else None
+            return json.loads(row[0]) if row else None
+
+        cached = self._descs_cache.get(sha1)
+        if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(path, 'r') as f_r, _trace('read desc', 'io') as span:
+                cached = (stat.st_mtime_ns, stat.st_size, json.loads(f_r.read()))
+                span.add(stat.st_size)
+            self._descs_cache[sha1] = cached
+
+        return _copy_json(cached[2])
+
+    def _write_desc(self, sha1, json_data):
+        """
+        Write the description of a hash file
+        :param sha1: str
+        :param json_data: dict
+        :return: None
+        """
+        self._write_descs([(sha1, json_data)])
+
+    def _write_descs(self, descs):
+        """
+        Write descriptions of hash files and update the description index. The descriptions of packed hash files
+        are written to the pack database.
+        :param descs: list of (sha1, json_data) tuples
+        :return: None
+        """
+        dirs = set()
+        packed = []
+        packs = self._get_packs()
+
+        with _trace('write descs', 'io', descs=len(descs)) as span:
+            for sha1, json_data in descs:
+                path = self._desc_path(sha1)
+                data = json.dumps(json_data).encode('utf-8')
+
+                if packs is not None and not os.path.exists(self._data_path(sha1)) and self._packed(sha1):
+                    packed.append((data.decode('utf-8'), sha1))
+                    continue
+
+                self._make_dirs(path)
+                _write_file(path, data)
+                dirs.add(os.path.dirname(path))
+                span.add(len(data))
+
+                stat = os.stat(path)
+                self._descs_cache[sha1] = (stat.st_mtime_ns, stat.st_size, _copy_json(json_data))
+
+            for path in dirs:
+                _fsync_path(path)
+
+            if packed:
+                with packs:
+                    packs.executemany("UPDATE objects SET desc = ? WHERE sha1 = ?", packed)
+
+        with _trace('index descs', 'io', descs=len(descs)):
+            self._index_descs(descs)
+
+    def get_desc(self, tagname):
+        """
+        Returns the description of a tag. A new description is returned if the file has none.
+        :param tagname: str
+        :return: dict
+        """
+        json_data = self._read_desc(self.resolve(tagname))
+
+        if json_data is None:
+            from datetime import date
+            json_data = {"repo_date": str(date.today()), "tags": []}
+
+        return json_data
+
+    def set_desc(self, tagname, json_new):
+        """
+        Update the description of a tag with the sections of json_new. The sections kept by the repository itself
+        can not be set.
+        :param tagname: str
+        :param json_new: dict
+        :return: dict the updated description
+        """
+        reserved = sorted(key for key in json_new if _is_reserved(key))
+        if reserved:
+            raise RepositoryError("The sections {} are kept by the repository and can not be set".format(
+                ", ".join("'{}'".format(key) for key in reserved)))
+
+        with self._locked(['tag:' + tagname]):
+            sha1 = self.resolve(tagname)
+
+            with self._locked(['hash:' + sha1]):
+                json_data = self.get_desc(tagname)
+                _dict_update(json_data, json_new)
+                self._write_desc(sha1, json_data)
+
+        return json_data
+
+    def clear_desc(self, tagname):
+        """
+        Delete all sections from the description of a tag
+        :param tagname: str
+        :return: dict the cleared description
+        """
+        with self._locked(['tag:' + tagname]):
+            sha1 = self.resolve(tagname)
+
+            with self._locked(['hash:' + sha1]):
+                json_data = self.get_desc(tagname)
+
+                json_data_new = {'tags':[],'repo_date':json_data['repo_date']}
+                for key in ('repo_blob', 'repo_versions'):
+                    if key in json_data:
+                        json_data_new[key] = json_data[key]
+
+                self._write_desc(sha1, json_data_new)
+
+        return json_data_new
+
+    def render(self, tagname, format):
+        """
+        Render the description of a tag. HTML and PDF renderings are cached in the repository.
+        :param tagname: str
+        :param format: str name of a Format
+        :return: bytes
+        """
+        return self._render(tagname, format, _Renderer())[0]
+
+    def _render(self, tagname, format, renderer):
+        """
+        Render the description of a tag or take it from the render cache
+        :param tagname: str
+        :param format: str name of a Format
+        :param renderer: _Renderer
+        :return: (bytes, bool) tuple. The bool is True if the rendering was taken from the cache.
+        """
+        json_data = self.get_desc(tagname)
+
+        # Markdown and json are cheaper to build than to read from the cache
+        if format not in (Format(2).name, Format(3).name):
+            with _trace('render', format=format):
+                return renderer.render(json_data, tagname, format), False
+
+        path = os.path.join(self.path, RENDER_DIR, _render_key(json_data, tagname, format) + FORMAT_EXTENSIONS[format])
+
+        try:
+            with open(path, 'rb') as f_r:
+                return f_r.read(), True
+        except FileNotFoundError:
+            pass
+
+        with _trace('render', format=format) as span:
+            data = renderer.render(json_data, tagname, format)
+            span.add(len(data))
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_file(path, data)
+        except OSError:
+            pass # Read only repository. Render without cache.
+
+        return data, False
+
+    def render_all(self, directory, format, pattern=None, jobs=1, progress=None):
+        """
+        Render the descriptions of all tags to files named after the tags in directory. The descriptions are
+        rendered on jobs threads each with its own renderer. Output files already holding the current rendering
+        are not written again.
+        :param directory: str
+        :param format: str name of a Format
+        :param pattern: str shell pattern the tags have to match
+        :param jobs: int
+        :param progress: function called with the number of rendered tags and the number of all tags
+        :return: RenderResult
+        """
+        import threading
+
+        tags = [tag for sha1, tag in self.list_tags(pattern) if sha1 is not None]
+        local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+
+        def render(tagname):
+            # The index connection of a repository object must not be shared between threads
+            if not hasattr(local, 'renderer'):
+                local.repo = Repository(self.path) if pool is not None else self
+                local.renderer = _Renderer()
+
+            data, cached = local.repo._render(tagname, format, local.renderer)
+            path = os.path.join(directory, tagname + FORMAT_EXTENSIONS[format])
+
+            try:
+                with open(path, 'rb') as f_r:
+                    if f_r.read() == data:
+                        return tagname, cached, False
+            except FileNotFoundError:
+                pass
+
+            _write_file(path, data)
+            return tagname, cached, True
+
+        pool = None
+
+        if len(tags) > 1 and jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(jobs)
+            rendered = pool.map(render, tags)
+        else:
+            rendered = map(render, tags)
+
+        converted = []
+        written = []
+
+        try:
+            for i, (tagname, cached, wrote) in enumerate(rendered, 1):
+                if not cached:
+                    converted.append(tagname)
+                if wrote:
+                    written.append(tagname)
+                if progress is not None:
+                    progress(i, len(tags))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        return RenderResult(tags, converted, written)
+
+    # Storing files
+
+    def _store_file(self, file, codec, block_size=None):
+        """
+        Hash and optionally compress a file in one pass. The data is streamed chunk by chunk into a temporary file
+        in the data directory which is renamed to its sha1sum afterwards. Uncompressed files are read through a
+        memory mapping. Returns the sha1sum and whether the file
+        was new to the repository. With block_size the file is compressed in independent blocks of this size and
+        the offsets of the blocks are stored next to the file for random access.
+        :param file: str
+        :param codec: str codec specification or None to store the file uncompressed
+        :param block_size: int
+        :return: (str, bool)
+        """
+        import hashlib
+        import shutil
+        import tempfile
+
+        data_dir = os.path.join(self.path, "data")
+        fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=data_dir)
+
+        try:
+            sha1 = hashlib.sha1()
+            compressor = _get_compressor(codec) if codec and not block_size else None
+            offsets = [0]
+
+            with open(file, 'rb') as f_r, os.fdopen(fd, 'wb') as f_w, \
+                    _trace('store', codec=codec or 'none', blocks=bool(block_size)) as span:
+                compressor = _timed_compressor(compressor, span)
+
+                for block in iter(lambda: f_r.read(block_size), b'') if block_size else ():
+                    block_compressor = _timed_compressor(_get_compressor(codec), span)
+                    chunk = block_compressor.compress(block) + block_compressor.flush()
+                    sha1.update(chunk)
+                    f_w.write(chunk)
+                    offsets.append(offsets[-1] + len(chunk))
+
+                mapped = not block_size and not compressor and _hash_mapped(f_r, sha1, f_w)
+
+                for chunk in iter(lambda: f_r.read(CHUNK_SIZE), b'') if not mapped else ():
+                    if compressor:
+                        chunk = compressor.compress(chunk)
+                    sha1.update(chunk)
+                    f_w.write(chunk)
+
+                if compressor:
+                    chunk = compressor.flush()
+                    sha1.update(chunk)
+                    f_w.write(chunk)
+
+                span.add(f_r.tell() if not mapped else os.fstat(f_r.fileno()).st_size)
+
+            # Hash files are never written in place, also not through a link of get
+            if codec:
+                # mkstemp creates the file only readable by the owner
+                os.chmod(tmp, _new_file_mode(0o444))
+            else:
+                shutil.copystat(file, tmp)
+                os.chmod(tmp, os.stat(tmp).st_mode & 0o555)
+
+            sha1 = sha1.hexdigest()
+            dst = self._data_path(sha1)
+
+            if self._exists(sha1):
+                os.remove(tmp)
+                return sha1, False
+
+            # Never let a truncated file appear under its hash name
+            _fsync_path(tmp)
+
+            # Renaming over a hash file stored meanwhile would cut it off from its tags
+            with self._locked(['hash:' + sha1]):
+                if self._exists(sha1):
+                    os.remove(tmp)
+                    return sha1, False
+
+                self._make_dirs(dst)
+
+                if block_size:
+                    _write_file(self._hash_path("data", sha1 + BLOCK_SUFFIX),
+                                struct.pack('<QQ{}Q'.format(len(offsets)), block_size, os.path.getsize(file),
+                                            *offsets))
+
+                os.rename(tmp, dst)
+                return sha1, True
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _store_chunked(self, file, codec):
+        """
+        Split a file into content defined chunks and store the chunks not yet in the chunk store. A manifest
+        listing the chunks is stored as data file under the sha1sum of the file content. Returns the sha1sum,
+        whether the manifest was new to the repository and a list of [sha1, size, stored size] of the chunks.
+        Content already in the repository, chunked or not, is not split again.
+        :param file: str
+        :param codec: str codec specification of the chunks. Chunks are always compressed because their codec is
+                      recognized by the header of the compressed data.
+        :return: (str, bool, list) the list of chunks is None if the content was in the repository
+        """
+        import hashlib
+
+        sha1 = _get_file_sha1(file)
+        if self._exists(sha1):
+            return sha1, False, None
+
+        chunk_dir = os.path.join(self.path, "chunks")
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        sha1 = hashlib.sha1()
+        chunks = []
+        size = 0
+
+        with open(file, 'rb') as f_r, _trace('store chunked', codec=codec or 'none') as span:
+            for chunk in _iter_chunks(f_r):
+                sha1.update(chunk)
+                size += len(chunk)
+
+                chunk_sha1 = hashlib.sha1(chunk).hexdigest()
+                path = os.path.join(chunk_dir, chunk_sha1)
+
+                if not os.path.exists(path):
+                    compressor = _timed_compressor(_get_compressor(codec), span)
+                    _write_file(path, compressor.compress(chunk) + compressor.flush())
+
+                chunks.append([chunk_sha1, len(chunk), os.path.getsize(path)])
+
+            span.add(size)
+
+        sha1 = sha1.hexdigest()
+        dst = self._data_path(sha1)
+
+        with self._locked(['hash:' + sha1]):
+            if self._exists(sha1):
+                # Stored meanwhile by another add, which counts its references. The chunks written here are
+                # removed by gc if nothing refers to them.
+                return sha1, False, None
+
+            self._make_dirs(dst)
+            _write_file(dst, json.dumps({"size": size, "chunks": [c[:2] for c in chunks]}).encode('utf-8'))
+
+        return sha1, True, chunks
+
+    def _ingest(self, file, codec, chunked=False, seekable=False):
+        """
+        Detect the mime type of a file and store it in the repository. Text files are compressed with codec.
+        :param file: str
+        :param codec: str
+        :param chunked: bool
+        :param seekable: bool
+        :return: (file, sha1, new, mime, size, blob, chunks) tuple. sha1 is None if the file does not exist.
+                 blob is the 'repo_blob' description section of the stored data. chunks is None if the file was
+                 not stored in the chunk store or was in the repository already.
+        """
+        import magic
+
+        try:
+            with _trace('mime'):
+                mime = magic.from_file(file, mime=True)
+        except FileNotFoundError:
+            return file, None, False, None, 0, None, None
+
+        if b"text" not in mime:
+            # Binary chunks are hardly compressible so spend less time on them
+            codec = 'zlib:1' if chunked else None
+
+        blob = {'codec': _parse_codec(codec)[0] if codec else 'none'}
+        chunks = None
+
+        if chunked:
+            sha1, new, chunks = self._store_chunked(file, codec)
+            blob['layout'] = 'chunked'
+            if chunks is None:
+                # Stored before, maybe not in the chunk store
+                blob = dict((self._read_desc(sha1) or {}).get('repo_blob', blob))
+        elif seekable and codec:
+            sha1, new = self._store_file(file, codec, BLOCK_SIZE)
+            blob['layout'] = 'blocks'
+            blob['block_size'] = BLOCK_SIZE
+        else:
+            sha1, new = self._store_file(file, codec)
+
+        return file, sha1, new, mime, os.path.getsize(file), blob, chunks
+
+    def add(self, files, description=None, manifest=None, codec=None, chunked=False, seekable=False, jobs=1,
+            progress=None, known=True, confirm=False):
+        """
+        Add files to the repository. Each file gets its file name as tag. Directories are added recursively.
+        Mime detection, hashing and compression run on jobs processes. The tags and descriptions are written
+        at the end.
+
+        Added files are remembered by their device, inode, size and modification time. Files which did not change
+        since they were added with the same options are not read again.
+        :param files: list of paths or (path, description) tuples
+        :param description: str description of the files without own description
+        :param manifest: str file listing more files, see _collect_files
+        :param codec: str compression codec of text files. Default is the repository codec.
+        :param chunked: bool store the files in the chunk store
+        :param seekable: bool compress text files in independent blocks
+        :param jobs: int
+        :param progress: function called with the number of stored files and the number of all files
+        :param known: bool skip files known from earlier adds
+        :param confirm: bool hash sampled blocks of known files to confirm they did not change
+        :return: list of AddResult
+        """
+        files = _collect_files(files, manifest, description)
+
+        if not files:
+            raise RepositoryError("No files to add")
+
+        codec = codec or self.config()['codec']
+        _parse_codec(codec)
+
+        options = "{}:{:d}:{:d}".format(codec, chunked, seekable)
+
+        # New chunks are not referenced before the end. Keep them from being removed as unused meanwhile.
+        with self._locked(['chunks'] if chunked else [], shared=True):
+            results = [None] * len(files)
+            todo = []
+
+            with _trace('lookup known', 'io', files=len(files)):
+                for i, (file, desc) in enumerate(files):
+                    hit = self._lookup_known(file, options, confirm) if known else None
+                    if hit is None:
+                        todo.append(i)
+                    else:
+                        sha1, mime, size, blob = hit
+                        results[i] = AddResult(file, os.path.basename(file), sha1, False, False, mime, size, blob,
+                                               None, desc)
+                        if progress is not None:
+                            progress(len(files) - results.count(None), len(files))
+
+            ingest = partial(_ingest_file, codec=codec, chunked=chunked, seekable=seekable, remember=known)
+            pool = None
+
+            if len(todo) > 1 and jobs > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(jobs, initializer=_start_worker, initargs=(self.path, _trace_path()))
+                ingested = pool.map(ingest, [files[i][0] for i in todo], chunksize=max(1, len(todo) // (4 * jobs)))
+            else:
+                # The locks of this process are released when any of its descriptors of the lock file is closed,
+                # so the files are stored with this repository object and not with one of their own
+                ingested = map(partial(ingest, repo=self), [files[i][0] for i in todo])
+
+            remembered = []
+
+            try:
+                with _trace('ingest', files=len(todo), jobs=jobs if pool is not None else 1):
+                    for i, ((file, sha1, new, mime, size, blob, chunks), key, sample) in zip(todo, ingested):
+                        results[i] = AddResult(file, os.path.basename(file), sha1, new, False, mime, size, blob,
+                                               chunks, files[i][1])
+                        if key is not None:
+                            remembered.append(key + (options, sha1, mime, json.dumps(blob), sample))
+                        if progress is not None:
+                            progress(len(files) - results.count(None), len(files))
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+
+            with self._get_index() as index:
+                index.executemany("INSERT OR REPLACE INTO known_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", remembered)
+
+            found = [r for r in results if r.sha1 is not None]
+            with self._locked(['tag:' + r.tag for r in found]):
+                with self._locked(['hash:' + r.sha1 for r in found]), _trace('link', 'io', files=len(found)):
+                    self._link_results(results, codec, chunked, seekable)
+
+                    # Remember the sizes and types of the new contents for usage
+                    with self._get_index() as index:
+                        index.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)",
+                                          [(r.sha1, r.size, r.mime.decode('utf-8') if isinstance(r.mime, bytes)
+                                            else r.mime, r.blob['codec'], r.blob.get('layout'))
+                                           for r in results if r.new])
+
+        return results
+
+    def _lookup_known(self, file, options, confirm=False):
+        """
+        Look up a source file in the known files cache. The file is known if it was added before with the same
+        options and neither its inode, size nor modification time changed since.
+        :param file: str
+        :param options: str codec and layout of add
+        :param confirm: bool also compare the sampled blocks of the file
+        :return: (sha1, mime, size, blob) tuple or None if the file is not known
+        """
+        key = _file_key(file)
+
+        if key is None:
+            return None
+
+        row = self._get_index().execute("SELECT sha1, mime, blob, sample FROM known_files WHERE dev = ? AND "
+                                        "inode = ? AND size = ? AND mtime = ? AND options = ?",
+                                        key + (options,)).fetchone()
+
+        if row is None or not self._exists(row[0]):
+            return None
+
+        if confirm and _sample_digest(file, key[2]) != row[3]:
+            return None
+
+        return row[0], row[1], key[2], json.loads(row[2])
+
+    def _link_results(self, results, codec, chunked, seekable):
+        """
+        Tag the stored files of add with their file names and write their descriptions. The tags and hash files
+        of the results have to be locked.
+        :param results: list of AddResult. tagged is set for the new tags.
+        :param codec: str
+        :param chunked: bool
+        :param seekable: bool
+        :return: None
+        """
+        from datetime import date
+
+        for i, r in enumerate(results):
+            if r.sha1 is not None and not self._exists(r.sha1):
+                # The last tag of the file was removed since it was stored
+                results[i] = r._replace(new=True, chunks=self._ingest(r.file, codec, chunked, seekable)[6])
+
+        # add hardlinks for file names which are no tags yet
+        planned = set()
+        for i, r in enumerate(results):
+            if r.sha1 is not None and r.tag not in planned and not self._tag_exists(r.tag):
+                planned.add(r.tag)
+                results[i] = r._replace(tagged=True)
+
+        tagged = [r for r in results if r.tagged]
+
+        # update json_desc
+        descs = collections.OrderedDict()
+        for r in tagged:
+            if r.sha1 not in descs:
+                descs[r.sha1] = self._read_desc(r.sha1)
+                if descs[r.sha1] is None:
+                    descs[r.sha1] = {"repo_date": str(date.today()), "tags": [], "repo_blob": r.blob}
+            descs[r.sha1]['tags'].append(r.tag)
+            descs[r.sha1]['Description'] = r.description
+
+        steps = [['link', r.sha1, r.tag] for r in tagged]
+        steps += [['desc', sha1, json_data] for sha1, json_data in descs.items()]
+        manifests = [[r.sha1, r.size, r.chunks] for r in results if r.chunks is not None]
+        if manifests:
+            steps.append(['manifests', manifests])
+
+        # The new hash files have to be on disk before tags point to them
+        for path in set(os.path.dirname(self._data_path(r.sha1)) for r in results if r.new):
+            _fsync_path(path)
+        if chunked:
+            _fsync_path(os.path.join(self.path, "chunks"))
+
+        self._commit(steps)
+
+    # Chunk store
+
+    def _get_manifest(self, sha1):
+        """
+        Read the chunk manifest stored under sha1
+        :param sha1: str
+        :return: dict
+        """
+        with open(self._data_path(sha1), 'r') as f_r:
+            return json.loads(f_r.read())
+
+    def _index_add_manifests(self, manifests):
+        """
+        Count the references of new chunk manifests to their chunks
+        :param manifests: list of (sha1, size, chunks) tuples
+        :return: None
+        """
+        with self._get_index() as index:
+            for sha1, size, chunks in manifests:
+                if index.execute("INSERT OR IGNORE INTO manifests VALUES (?, ?)", (sha1, size)).rowcount == 0:
+                    continue
+                for chunk_sha1, chunk_size, stored in chunks:
+                    index.execute("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, 0)",
+                                  (chunk_sha1, chunk_size, stored))
+                    index.execute("UPDATE chunks SET refs = refs + 1 WHERE sha1 = ?", (chunk_sha1,))
+
+    def _index_remove_manifest(self, sha1):
+        """
+        Release the chunks referenced by a chunk manifest. Chunks without references are deleted by _sweep_chunks.
+        :param sha1: str
+        :return: None
+        """
+        if self._get_index().execute("SELECT 1 FROM manifests WHERE sha1 = ?", (sha1,)).fetchone() is None:
+            return
+
+        manifest = self._get_manifest(sha1)
+
+        with self._get_index() as index:
+            if index.execute("DELETE FROM manifests WHERE sha1 = ?", (sha1,)).rowcount == 0:
+                return
+            for chunk_sha1, size in manifest['chunks']:
+                index.execute("UPDATE chunks SET refs = refs - 1 WHERE sha1 = ?", (chunk_sha1,))
+
+    def _sweep_chunks(self):
+        """
+        Delete the chunks no chunk manifest refers to. Adds of chunked files hold a shared lock on the chunk store
+        as long as their new chunks are not referenced.
+        :return: None
+        """
+        with self._locked(['chunks']):
+            with self._get_index() as index:
+                unused = [r[0] for r in index.execute("SELECT sha1 FROM chunks WHERE refs <= 0")]
+                index.execute("DELETE FROM chunks WHERE refs <= 0")
+
+            for chunk_sha1 in unused:
+                try:
+                    os.remove(os.path.join(self.path, "chunks", chunk_sha1))
+                except FileNotFoundError:
+                    pass
+
+    def chunk_stats(self):
+        """
+        Returns the number of chunked files, their total size, the number and size of the unique chunks and the
+        size of the chunk store on disk
+        :return: (int, int, int, int, int)
+        """
+        # Do not open the index only to find an empty chunk store
+        try:
+            with os.scandir(os.path.join(self.path, "chunks")) as it:
+                empty = next(it, None) is None
+        except FileNotFoundError:
+            empty = True
+
+        if empty:
+            return 0, 0, 0, 0, 0
+
+        index = self._get_index()
+        files, logical = index.execute("SELECT count(*), coalesce(sum(size), 0) FROM manifests").fetchone()
+        chunks, unique, stored = index.execute("SELECT count(*), coalesce(sum(size), 0), coalesce(sum(stored), 0) "
+                                               "FROM chunks").fetchone()
+
+        return files, logical, chunks, unique, stored
+
+    # Versions
+
+    def _index_set_chains(self, chains):
+        """
+        Set the older versions files refer to and count the references of the older versions. A file updated by
+        update refers to all older versions listed in its description.
+        :param chains: list of (sha1, older) tuples. older is the sorted list of the hash files of the older
+                       versions, empty to release them.
+        :return: None
+        """
+        with self._get_index() as index:
+            for sha1, older in chains:
+                row = index.execute("SELECT versions FROM chains WHERE sha1 = ?", (sha1,)).fetchone()
+                before = json.loads(row[0]) if row is not None else []
+                if before == older:
+                    continue
+                for version in older:
+                    index.execute("INSERT OR IGNORE INTO versions VALUES (?, 0)", (version,))
+                    index.execute("UPDATE versions SET refs = refs + 1 WHERE sha1 = ?", (version,))
+                for version in before:
+                    index.execute("UPDATE versions SET refs = refs - 1 WHERE sha1 = ?", (version,))
+                if older:
+                    index.execute("INSERT OR REPLACE INTO chains VALUES (?, ?)", (sha1, json.dumps(older)))
+                else:
+                    index.execute("DELETE FROM chains WHERE sha1 = ?", (sha1,))
+
+    def _version_refs(self, sha1):
+        """
+        Returns the number of files referring to a hash file as older version
+        :param sha1: str
+        :return: int
+        """
+        row = self._get_index().execute("SELECT refs FROM versions WHERE sha1 = ?", (sha1,)).fetchone()
+
+        return row[0] if row is not None else 0
+
+    def _tagged(self, sha1):
+        """
+        Check whether a hash file has tags, also in the pack database
+        :param sha1: str
+        :return: bool
+        """
+        try:
+            return os.lstat(self._data_path(sha1)).st_nlink > 1
+        except FileNotFoundError:
+            packs = self._get_packs()
+            return packs is not None and \
+                packs.execute("SELECT 1 FROM tags WHERE sha1 = ?", (sha1,)).fetchone() is not None
+
+    def _unreachable_versions(self):
+        """
+        Returns the files with versions and older versions which can not be reached from a tagged file. Two
+        versions can refer to each other when a tag is updated back to an older content, so reference counts are
+        not enough to find them.
+        :return: set of str
+        """
+        index = self._get_index()
+        chains = {sha1: json.loads(older) for sha1, older in index.execute("SELECT sha1, versions FROM chains")}
+        known = set(chains).union(r[0] for r in index.execute("SELECT sha1 FROM versions"))
+
+        todo = [sha1 for sha1 in known if self._tagged(sha1)]
+        reachable = set(todo)
+        while todo:
+            for version in chains.get(todo.pop(), ()):
+                if version not in reachable:
+                    reachable.add(version)
+                    todo.append(version)
+
+        return known - reachable
+
+    def _sweep_versions(self):
+        """
+        Remove the files with versions and older versions which can not be reached from a tagged file any more
+        :return: dict {sha1: size} of the removed hash files. The size of packed ones is 0, their space is freed by
+                 repack.
+        """
+        unreachable = self._unreachable_versions()
+
+        if not unreachable:
+            return {}
+
+        with self._locked(['hash:' + sha1 for sha1 in unreachable]):
+            # Check again under the locks. An update may have tagged one of them meanwhile.
+            unreachable &= self._unreachable_versions()
+            sizes = {}
+            for sha1 in unreachable:
+                try:
+                    sizes[sha1] = os.path.getsize(self._data_path(sha1))
+                except FileNotFoundError:
+                    sizes[sha1] = 0
+            self._index_set_chains([(sha1, []) for sha1 in unreachable])
+            self._commit([['drop', sha1] for sha1 in sorted(unreachable)])
+
+        return sizes
+
+    def _store_delta(self, file, base, codec):
+        """
+        Store a file as delta against the content of the hash file base. Both contents are split into small content
+        defined chunks, see DELTA_MIN_SIZE. The chunks of the file found in base are copied from base, the others are
+        stored as literal data. At most DELTA_MAX_INDEX chunks of base are indexed, the size of the file sets the
+        size of the chunks.
+        :param file: str
+        :param base: str
+        :param codec: str codec specification of the delta or None to store it uncompressed
+        :return: (str, bool, int, int) sha1sum of the delta or None if the content is the content of base, whether
+                 the delta was new to the repository, the size of the content and the bytes of literal data. Nothing
+                 is stored if more than DELTA_MAX_NEW of the content are literal data.
+        """
+        import hashlib
+        import tempfile
+
+        # Both contents are split alike. A base much larger than the file is only indexed up to DELTA_MAX_INDEX chunks.
+        chunking = _delta_chunking(os.path.getsize(file))
+        offsets = dict()
+        pos = 0
+        with _trace('index base') as span:
+            pieces = _PiecesFile(self._iter_range(base, self._stored_blob(base)))
+            for chunk in _iter_chunks(pieces, *chunking):
+                if len(offsets) < DELTA_MAX_INDEX:
+                    offsets.setdefault(hashlib.sha1(chunk).digest(), (pos, len(chunk)))
+                pos += len(chunk)
+            span.add(pos)
+
+        fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=os.path.join(self.path, "data"))
+
+        try:
+            sha1 = hashlib.sha1()
+            size = literal = 0
+            ops = []
+            copy = None
+
+            with open(file, 'rb') as f_r, os.fdopen(fd, 'wb') as f_w, \
+                    _trace('store delta', codec=codec or 'none') as span:
+                compressor = _timed_compressor(_get_compressor(codec) if codec else None, span)
+
+                def stored(data):
+                    sha1.update(data)
+                    f_w.write(data)
+
+                def write(data):
+                    stored(compressor.compress(data) if compressor else data)
+
+                stored(bytes.fromhex(base))
+                for chunk in _iter_chunks(f_r, *chunking):
+                    size += len(chunk)
+                    match = offsets.get(hashlib.sha1(chunk).digest())
+
+                    if match is not None and copy is not None and copy[0] + copy[1] == match[0]:
+                        # Adjacent in base, extend the copy
+                        copy = (copy[0], copy[1] + match[1])
+                        continue
+                    if copy is not None:
+                        write(DELTA_OP.pack(b'C', *copy))
+                        ops.append(copy)
+                        copy = None
+                    if match is not None:
+                        copy = match
+                    else:
+                        write(DELTA_OP.pack(b'I', len(chunk), 0))
+                        write(chunk)
+                        ops.append(None)
+                        literal += len(chunk)
+
+                if copy is not None:
+                    write(DELTA_OP.pack(b'C', *copy))
+                    ops.append(copy)
+                if compressor:
+                    stored(compressor.flush())
+                span.add(size)
+
+            if ops == [(0, pos)] or (not ops and not pos):
+                os.remove(tmp)
+                return None, False, size, 0
+
+            sha1 = sha1.hexdigest()
+
+            if literal > DELTA_MAX_NEW * size or self._exists(sha1):
+                os.remove(tmp)
+                return sha1, False, size, literal
+
+            # mkstemp creates the file only readable by the owner
+            os.chmod(tmp, _new_file_mode(0o444))
+            _fsync_path(tmp)
+
+            with self._locked(['hash:' + sha1]):
+                if self._exists(sha1):
+                    os.remove(tmp)
+                    return sha1, False, size, literal
+
+                dst = self._data_path(sha1)
+                self._make_dirs(dst)
+                os.rename(tmp, dst)
+                return sha1, True, size, literal
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _iter_delta(self, sha1, blob):
+        """
+        Rebuild the content of a delta piece by piece. The copies are read from one stream of the content of the
+        previous version as long as they go forward, so the versions back to the last full one are read once each
+        for a content whose parts did not move.
+        :param sha1: str
+        :param blob: dict 'repo_blob' section of the description
+        :return: generator of bytes
+        """
+        with self._open_data(sha1) as f_r:
+            base = f_r.read(20).hex()
+            reader = _RangeReader(lambda: self._iter_range(base, self._stored_blob(base)))
+            ops = _PiecesFile(_iter_decompressed(f_r, blob.get('codec', 'none')))
+
+            for head in iter(lambda: ops.read(DELTA_OP.size), b''):
+                if len(head) != DELTA_OP.size:
+                    raise RepositoryError("Delta {} is damaged".format(sha1))
+
+                op, n, length = DELTA_OP.unpack(head)
+
+                if op == b'C':
+                    yield from reader.read(n, length)
+                    continue
+
+                while n:
+                    data = ops.read(min(n, CHUNK_SIZE))
+                    if not data:
+                        raise RepositoryError("Delta {} is damaged".format(sha1))
+                    n -= len(data)
+                    yield data
+
+    def _store_version(self, file, base, base_blob, mime, codec):
+        """
+        Store a file as the version after the hash file base, as delta if base is not preceded by VERSION_SNAPSHOT
+        deltas and the delta is small enough
+        :param file: str
+        :param base: str
+        :param base_blob: dict 'repo_blob' section of the description of base
+        :param mime: bytes mime type of the file
+        :param codec: str
+        :return: (str, bool, int, dict) sha1sum or None if the content is the content of base, whether the hash
+                 file was new to the repository, the size of the content and the 'repo_blob' section of the new
+                 hash file
+        """
+        depth = base_blob.get('depth', 0) + 1 if base_blob.get('layout') == 'delta' else 1
+
+        if depth <= VERSION_SNAPSHOT:
+            delta_codec = codec if b"text" in mime else None
+            sha1, new, size, literal = self._store_delta(file, base, delta_codec)
+            if sha1 is None or new or self._exists(sha1):
+                return sha1, new, size, {'codec': _parse_codec(delta_codec)[0] if delta_codec else 'none',
+                                         'layout': 'delta', 'base': base, 'depth': depth, 'size': size}
+        elif os.path.getsize(file) == base_blob['size'] and _same_content(file, self._iter_range(base, base_blob)):
+            return None, False, base_blob['size'], None
+
+        file, sha1, new, mime, size, blob, chunks = self._ingest(file, codec)
+
+        if sha1 is None:
+            raise RepositoryError("No such File: '{}'".format(file))
+
+        return None if sha1 == base else sha1, new, size, blob
+
+    def update(self, tagname, file, description=None, codec=None):
+        """
+        Store a new version of the file of a tag and move the tag to it. The new version is stored as delta
+        against the previous one unless VERSION_SNAPSHOT deltas precede it or it differs too much, see
+        DELTA_MAX_NEW. The description of the new version is copied from the previous one and lists all versions
+        of the tag in its 'repo_versions' section. The older versions are kept as long as a tagged file lists them.
+        :param tagname: str
+        :param file: str
+        :param description: str new description section or None to keep the one of the previous version
+        :param codec: str compression codec of text files. Default is the repository codec.
+        :return: UpdateResult
+        """
+        import magic
+        from datetime import date
+
+        codec = codec or self.config()['codec']
+        _parse_codec(codec)
+
+        try:
+            with _trace('mime'):
+                mime = magic.from_file(file, mime=True)
+        except FileNotFoundError:
+            raise RepositoryError("No such File: '{}'".format(file))
+
+        old = self.resolve(tagname)
+
+        try:
+            old_blob = self._stored_blob(old)
+            sha1, new, size, blob = self._store_version(file, old, old_blob, mime, codec)
+
+            if sha1 is not None and not new and self._read_desc(sha1) is None:
+                # Left without tags and description, e.g. by an add of an existing tag. How it is stored is unknown.
+                with self._locked(['hash:' + sha1]):
+                    if self._read_desc(sha1) is None and self._untagged(sha1, time.time()):
+                        self._commit([['drop', sha1]])
+                sha1, new, size, blob = self._store_version(file, old, old_blob, mime, codec)
+        except FileNotFoundError:
+            if self._exists(old):
+                raise
+            raise RepositoryError("'{}' was changed meanwhile".format(tagname))
+
+        def versions(json_data):
+            return json_data.get('repo_versions') or [{"version": 1, "sha1": old, "date": json_data['repo_date'],
+                                                       "size": self._content_size(old, old_blob)}]
+
+        if sha1 is None:
+            return UpdateResult(tagname, False, versions(self.get_desc(tagname))[-1]['version'], old, False, False,
+                                size, 0)
+
+        with self._locked(['tag:' + tagname]):
+            with self._locked(['hash:' + old, 'hash:' + sha1]):
+                if self.resolve(tagname) != old:
+                    raise RepositoryError("'{}' was changed meanwhile".format(tagname))
+                if not self._exists(sha1):
+                    raise RepositoryError("The stored version of '{}' was removed meanwhile".format(tagname))
+                if not new:
+                    blob = self._stored_blob(sha1)
+
+                old_desc = self._read_desc(old) or {"repo_date": str(date.today()), "tags": [tagname]}
+                chain = versions(old_desc)
+
+                json_data = None if new else self._read_desc(sha1)
+                if json_data is not None and json_data.get('repo_versions') and \
+                        sha1 not in set(v['sha1'] for v in chain):
+                    raise RepositoryError("The content of {} is a version of another file".format(file))
+
+                if json_data is None:
+                    json_data = {key: _copy_json(value) for key, value in old_desc.items()
+                                 if key not in ('tags', 'repo_blob', 'repo_versions')}
+                    json_data['repo_blob'] = blob
+                    json_data['tags'] = []
+                json_data['repo_date'] = str(date.today())
+                json_data['tags'].append(tagname)
+                if description is not None:
+                    json_data['Description'] = description
+
+                version = chain[-1]['version'] + 1
+                chain.append({"version": version, "sha1": sha1, "date": json_data['repo_date'], "size": size})
+                json_data['repo_versions'] = chain
+
+                # The previous version keeps the versions before it
+                old_desc['tags'] = [t for t in old_desc['tags'] if t != tagname]
+                old_desc['repo_versions'] = chain[:-1]
+
+                steps = [['unlink', tagname], ['link', sha1, tagname], ['desc', old, old_desc],
+                         ['desc', sha1, json_data], ['versions', sha1, _older_versions(json_data, sha1)],
+                         ['versions', old, _older_versions(old_desc, old)]]
+
+                # The new hash file has to be on disk before the tag points to it
+                _fsync_path(os.path.dirname(self._data_path(sha1)))
+                self._commit(steps)
+
+            if new:
+                with self._get_index() as index:
+                    index.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)",
+                                  (sha1, size, mime.decode('utf-8') if isinstance(mime, bytes) else mime,
+                                   blob['codec'], blob.get('layout')))
+
+        stored = os.path.getsize(self._data_path(sha1)) if new else 0
+
+        return UpdateResult(tagname, True, version, sha1, new, blob.get('layout') == 'delta', size, stored)
+
+    def get_version(self, tagname, version):
+        """
+        Returns the hash file name and the 'repo_blob' section of the description of a version of the file of a
+        tag, see update
+        :param tagname: str
+        :param version: int
+        :return: (str, dict)
+        """
+        sha1 = self.resolve(tagname)
+        chain = (self._read_desc(sha1) or {}).get('repo_versions') or [{"version": 1, "sha1": sha1}]
+
+        for entry in chain:
+            if entry['version'] == version:
+                return entry['sha1'], self._stored_blob(entry['sha1'])
+
+        raise RepositoryError("'{}' has no version {}. Its versions are {}".format(
+            tagname, version, ", ".join(str(entry['version']) for entry in chain)))
+
+    # Packs
+
+    def _get_packs(self, create=False):
+        """
+        Open the database of the packed hash files holding their locations, descriptions and tags
+        :param create: bool create the database if the repository has no packs yet
+        :return: sqlite3.Connection or None if there are no packs
+        """
+        if self._packs is None:
+            path = os.path.join(self.path, PACK_DIR, PACK_INDEX)
+
+            if not create and not os.path.exists(path):
+                return None
+
+            # Repositories without packs do not need sqlite3 for listing their tags
+            import sqlite3
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # serve reads packed files on the threads of its executor
+            self._packs = sqlite3.connect(path, timeout=600, check_same_thread=False)
+            with self._packs:
+                self._packs.execute("CREATE TABLE IF NOT EXISTS objects (sha1 TEXT PRIMARY KEY, pack TEXT NOT NULL, "
+                                    "offset INTEGER NOT NULL, length INTEGER NOT NULL, desc TEXT NOT NULL)")
+                self._packs.execute("CREATE INDEX IF NOT EXISTS objects_pack ON objects (pack)")
+                self._packs.execute("CREATE TABLE IF NOT EXISTS tags (tag TEXT PRIMARY KEY, sha1 TEXT NOT NULL)")
+                self._packs.execute("CREATE INDEX IF NOT EXISTS tags_sha1 ON tags (sha1)")
+
+        return self._packs
+
+    def _packed(self, sha1):
+        """
+        Returns the location of a packed hash file
+        :param sha1: str
+        :return: (pack, offset, length) tuple or None if the hash file is not packed
+        """
+        packs = self._get_packs()
+
+        if packs is None:
+            return None
+
+        return packs.execute("SELECT pack, offset, length FROM objects WHERE sha1 = ?", (sha1,)).fetchone()
+
+    def _packed_tag(self, tagname):
+        """
+        Returns the hash file name of a tag of a packed hash file
+        :param tagname: str
+        :return: str or None if there is no such tag
+        """
+        packs = self._get_packs()
+        row = packs.execute("SELECT sha1 FROM tags WHERE tag = ?", (tagname,)).fetchone() if packs else None
+
+        return row[0] if row else None
+
+    def _exists(self, sha1):
+        """
+        Check whether a hash file is stored, as file or packed
+        :param sha1: str
+        :return: bool
+        """
+        return os.path.exists(self._data_path(sha1)) or self._packed(sha1) is not None
+
+    def _tag_exists(self, tagname):
+        """
+        Check whether a tag exists, as tag file or as tag of a packed hash file
+        :param tagname: str
+        :return: bool
+        """
+        return os.path.lexists(os.path.join(self.path, "tags", tagname)) or self._packed_tag(tagname) is not None
+
+    def _read_packed(self, sha1):
+        """
+        Read a packed hash file. The record header is checked against the location in the pack database.
+        :param sha1: str
+        :return: bytes or None if the hash file is not packed
+        """
+        for retry in (False, True):
+            location = self._packed(sha1)
+
+            if location is None:
+                return None
+
+            pack, offset, length = location
+
+            try:
+                with open(os.path.join(self.path, PACK_DIR, pack), 'rb') as f_r, _trace('read pack', 'io', pack=pack):
+                    f_r.seek(offset)
+                    header = f_r.read(PACK_RECORD.size)
+                    data = f_r.read(length)
+            except FileNotFoundError:
+                if retry:
+                    raise
+                continue  # The pack was rewritten by repack meanwhile
+
+            if len(header) != PACK_RECORD.size or PACK_RECORD.unpack(header) != (bytes.fromhex(sha1), length) or \
+                    len(data) != length:
+                raise RepositoryError("Pack {} is damaged at offset {}".format(pack, offset))
+
+            return data
+
+    def _open_data(self, sha1):
+        """
+        Open a hash file for reading. Packed hash files are read into memory.
+        :param sha1: str
+        :return: binary file
+        """
+        import io
+
+        try:
+            return open(self._data_path(sha1), 'rb')
+        except FileNotFoundError:
+            data = self._read_packed(sha1)
+            if data is None:
+                raise
+            return io.BytesIO(data)
+
+    def repack(self, max_size=PACK_MAX_BLOB, pack_size=PACK_SIZE, progress=None):
+        """
+        Move the tagged hash files up to max_size bytes into pack files. Their descriptions go to the pack database
+        and their tag files are replaced by tags in the pack database, so a packed file takes no inode. Chunk
+        manifests, seekable files and files without recorded codec stay as they are. Packs in which less than
+        PACK_MIN_LIVE of the bytes are still referenced are rewritten.
+        :param max_size: int
+        :param pack_size: int size up to which a pack is filled
+        :param progress: function called with the number of handled files and the number of all files to pack
+        :return: RepackResult
+        """
+        packs = self._get_packs(create=True)
+        pack_dir = os.path.join(self.path, PACK_DIR)
+
+        with self._locked(['packs']):
+            tags = collections.defaultdict(list)
+            for sha1, tagname in self.list_tags():
+                if sha1 is not None:
+                    tags[sha1].append(tagname)
+
+            candidates = []
+            for entry in self._scan("data"):
+                if _is_hash_name(entry.name) and entry.name in tags and \
+                        entry.stat(follow_symlinks=False).st_size <= max_size:
+                    candidates.append(entry.name)
+
+            live = collections.Counter()
+            for pack, length in packs.execute("SELECT pack, length FROM objects"):
+                live[pack] += PACK_RECORD.size + length
+
+            sizes = {name: os.path.getsize(os.path.join(pack_dir, name)) for name in os.listdir(pack_dir)
+                     if name.endswith(PACK_SUFFIX)}
+            sparse = sorted(name for name, size in sizes.items() if live[name] < size * PACK_MIN_LIVE)
+            current = [name for name in sorted(sizes) if name not in sparse and sizes[name] < pack_size]
+
+            writer = _PackWriter(pack_dir, pack_size, current[-1] if current else None)
+            packed = []
+            packed_tags = 0
+
+            try:
+                for start in range(0, len(candidates), 1000):
+                    batch = candidates[start:start + 1000]
+                    with self._locked(['tag:' + tagname for sha1 in batch for tagname in tags[sha1]]):
+                        with self._locked(['hash:' + sha1 for sha1 in batch]):
+                            moved = self._pack_files(writer, batch, tags)
+                    packed += moved
+                    packed_tags += sum(len(tags[sha1]) for sha1 in moved)
+                    if progress is not None:
+                        progress(start + len(batch), len(candidates))
+
+                repacked = 0
+                freed = 0
+                for name in sparse:
+                    moved = []
+                    with open(os.path.join(pack_dir, name), 'rb') as f_r:
+                        for sha1, offset, length in packs.execute("SELECT sha1, offset, length FROM objects "
+                                                                  "WHERE pack = ?", (name,)).fetchall():
+                            f_r.seek(offset + PACK_RECORD.size)
+                            moved.append(writer.append(sha1, f_r.read(length)) + (sha1, name))
+                    writer.flush()
+
+                    # Files dropped meanwhile are not moved back to life
+                    with packs:
+                        packs.executemany("UPDATE objects SET pack = ?, offset = ? WHERE sha1 = ? AND pack = ?", moved)
+
+                    os.remove(os.path.join(pack_dir, name))
+                    repacked += len(moved)
+                    freed += sizes[name] - live[name]
+            finally:
+                writer.close()
+
+            _fsync_path(pack_dir)
+
+        return RepackResult(len(packed), packed_tags, repacked, sparse, freed)
+
+    def _pack_files(self, writer, batch, tags):
+        """
+        Move hash files with their descriptions and tags into packs. The tags and hash files have to be locked.
+        Hash files whose tags changed since they were listed are left for the next repack.
+        :param writer: _PackWriter
+        :param batch: list of hash file names
+        :param tags: dict of the listed tags of the hash files
+        :return: list of the packed hash file names
+        """
+        objects = []
+        packed_tags = []
+
+        for sha1 in batch:
+            try:
+                stat = os.lstat(self._data_path(sha1))
+            except FileNotFoundError:
+                continue
+
+            json_data = self._read_desc(sha1)
+            blob = (json_data or {}).get('repo_blob', {})
+
+            if stat.st_nlink != len(tags[sha1]) + 1 or 'codec' not in blob or blob.get('layout') is not None:
+                continue
+
+            with open(self._data_path(sha1), 'rb') as f_r:
+                data = f_r.read()
+
+            objects.append((sha1,) + writer.append(sha1, data) + (len(data), json.dumps(json_data)))
+            packed_tags += [(tagname, sha1) for tagname in tags[sha1]]
+
+        writer.flush()
+
+        with self._get_packs() as packs:
+            packs.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)", objects)
+            packs.executemany("INSERT OR REPLACE INTO tags VALUES (?, ?)", packed_tags)
+
+        # The packed copies are complete. Until the files are removed readers keep using them.
+        for tagname, sha1 in packed_tags:
+            try:
+                os.remove(os.path.join(self.path, "tags", tagname))
+            except FileNotFoundError:
+                pass
+            self._tags_cache.pop(tagname, None)
+
+        with self._get_index() as index:
+            index.executemany("DELETE FROM tags WHERE tag = ?", [(tagname,) for tagname, sha1 in packed_tags])
+
+        _fsync_path(os.path.join(self.path, "tags"))
+
+        # The description goes last like in _drop
+        dirs = set()
+        for sha1 in (o[0] for o in objects):
+            for path in (self._data_path(sha1), self._desc_path(sha1)):
+                os.remove(path)
+                dirs.add(os.path.dirname(path))
+            self._descs_cache.pop(sha1, None)
+
+        for path in dirs:
+            _fsync_path(path)
+
+        return [o[0] for o in objects]
+
+    # Space
+
+    def gc(self, dry_run=False, min_age=GC_MIN_AGE):
+        """
+        Remove what no tag refers to: hash files without tags which are no older version of a tagged file,
+        descriptions and block indexes without hash file, chunks no manifest refers to, cached renderings of
+        descriptions which changed since and temporary files left by crashed processes. Each directory is read in
+        one pass. Hash files, renderings and temporary files changed less than min_age seconds ago are kept as they
+        may belong to a running add or desc.
+        :param dry_run: bool only report what would be removed
+        :param min_age: float
+        :return: GCResult
+        """
+        now = time.time()
+        blobs, descs, stray, indexes = [], [], [], []
+        hashes = set()
+
+        # Versions of files whose tags were removed by a crashed process, or which refer to each other
+        if dry_run:
+            sizes = {sha1: os.path.getsize(self._data_path(sha1)) for sha1 in self._unreachable_versions()
+                     if os.path.exists(self._data_path(sha1))}
+        else:
+            sizes = self._sweep_versions()
+        versions = list(sizes)
+        referenced = set(r[0] for r in self._get_index().execute("SELECT sha1 FROM versions WHERE refs > 0"))
+
+        for entry in self._scan("data"):
+            stat = entry.stat(follow_symlinks=False)
+            old = now - stat.st_ctime >= min_age
+            if _is_hash_name(entry.name):
+                hashes.add(entry.name)
+                if stat.st_nlink == 1 and old and entry.name not in referenced and entry.name not in sizes:
+                    blobs.append(entry.name)
+                    sizes[entry.name] = stat.st_size
+            elif entry.name.endswith(BLOCK_SUFFIX) and _is_hash_name(entry.name[:-len(BLOCK_SUFFIX)]):
+                indexes.append((entry, stat.st_size))
+            elif entry.name.startswith(TMP_PREFIX) and old:
+                stray.append(os.path.relpath(entry.path, self.path))
+                sizes[stray[-1]] = stat.st_size
+
+        for entry, size in indexes:
+            if entry.name[:-len(BLOCK_SUFFIX)] not in hashes:
+                stray.append(os.path.relpath(entry.path, self.path))
+                sizes[stray[-1]] = size
+
+        for entry in self._scan("desc"):
+            if _is_hash_name(entry.name) and entry.name not in hashes:
+                descs.append(entry.name)
+                sizes["desc/" + entry.name] = entry.stat().st_size
+            elif entry.name.startswith(TMP_PREFIX) and now - entry.stat().st_ctime >= min_age:
+                stray.append(os.path.relpath(entry.path, self.path))
+                sizes[stray[-1]] = entry.stat().st_size
+
+        if not dry_run and (blobs or descs):
+            with self._locked(['hash:' + sha1 for sha1 in blobs + descs]):
+                # Check again under the locks. A hash file may have been tagged or stored meanwhile.
+                drop = [sha1 for sha1 in blobs if self._untagged(sha1, now - min_age)]
+                drop += [sha1 for sha1 in descs if not os.path.exists(self._data_path(sha1))]
+                self._commit([['drop', sha1] for sha1 in drop])
+            blobs = [sha1 for sha1 in blobs if sha1 in drop]
+            descs = [sha1 for sha1 in descs if sha1 in drop]
+
+        blobs = sorted(versions) + blobs
+        chunks = self._gc_chunks(dry_run, stray, sizes)
+        renders = self._gc_renders(dry_run, now - min_age, sizes)
+
+        if not dry_run:
+            for path in stray:
+                try:
+                    os.remove(os.path.join(self.path, path))
+                except FileNotFoundError:
+                    pass
+
+        size = sum(sizes[sha1] for sha1 in blobs) + sum(sizes["desc/" + sha1] for sha1 in descs) + \
+            sum(sizes[path] for path in stray + renders) + sum(sizes["chunks/" + sha1] for sha1 in chunks)
+
+        return GCResult(blobs, descs, chunks, stray, renders, size)
+
+    def _untagged(self, sha1, before):
+        """
+        Check whether a hash file has no tags, is no older version of another file and was not changed after before
+        :param sha1: str
+        :param before: float time
+        :return: bool
+        """
+        try:
+            stat = os.lstat(self._data_path(sha1))
+        except FileNotFoundError:
+            return False
+
+        return stat.st_nlink == 1 and stat.st_ctime <= before and not self._version_refs(sha1)
+
+    def _gc_chunks(self, dry_run, stray, sizes):
+        """
+        Find and remove the chunks no manifest refers to and the temporary files of the chunk store. The exclusive
+        lock of the chunk store waits for running adds of chunked files.
+        :param dry_run: bool
+        :param stray: list the temporary files are appended to
+        :param sizes: dict the sizes of the found files are added to
+        :return: list of chunk names
+        """
+        chunks_dir = os.path.join(self.path, "chunks")
+
+        if not os.path.isdir(chunks_dir):
+            return []
+
+        with self._locked(['chunks']):
+            referenced = set(r[0] for r in self._get_index().execute("SELECT sha1 FROM chunks WHERE refs > 0"))
+            unused = []
+
+            with os.scandir(chunks_dir) as it:
+                for entry in it:
+                    if _is_hash_name(entry.name) and entry.name not in referenced:
+                        unused.append(entry.name)
+                        sizes["chunks/" + entry.name] = entry.stat().st_size
+                    elif entry.name.startswith(TMP_PREFIX):
+                        stray.append(os.path.join("chunks", entry.name))
+                        sizes[stray[-1]] = entry.stat().st_size
+
+            if not dry_run:
+                with self._get_index() as index:
+                    index.execute("DELETE FROM chunks WHERE refs <= 0")
+                for chunk_sha1 in unused:
+                    os.remove(os.path.join(chunks_dir, chunk_sha1))
+
+        return unused
+
+    def _gc_renders(self, dry_run, before, sizes):
+        """
+        Find and remove the cached renderings no tag would take from the cache any more. The cache key of a
+        rendering changes with the description, see _render_key, so every desc --set, tag or rm leaves the
+        renderings of the description before behind.
+        :param dry_run: bool
+        :param before: float time. Renderings changed after it are kept.
+        :param sizes: dict the sizes of the found files are added to
+        :return: list of paths relative to the repository
+        """
+        render_dir = os.path.join(self.path, RENDER_DIR)
+
+        if not os.path.isdir(render_dir):
+            return []
+
+        current = set()
+        for sha1, tagname in self.list_tags():
+            if sha1 is None:
+                continue
+            try:
+                json_data = self.get_desc(tagname)
+            except RepositoryError:
+                continue # Removed meanwhile
+            for format in (Format(2).name, Format(3).name):
+                current.add(_render_key(json_data, tagname, format) + FORMAT_EXTENSIONS[format])
+
+        unused = []
+        with os.scandir(render_dir) as it:
+            for entry in it:
+                stat = entry.stat(follow_symlinks=False)
+                if entry.name not in current and stat.st_ctime <= before:
+                    unused.append(os.path.join(RENDER_DIR, entry.name))
+                    sizes[unused[-1]] = stat.st_size
+
+        if not dry_run:
+            for path in unused:
+                try:
+                    os.remove(os.path.join(self.path, path))
+                except FileNotFoundError:
+                    pass
+
+        return unused
+
+    def usage(self):
+        """
+        Account the space of the repository. The sizes and types of the contents are remembered in the index when
+        they are added. Contents added before are measured once, compressed files are decompressed for it. The
+        record headers and removed records of packs count as overhead.
+        :return: Usage
+        """
+        index = self._get_index()
+        known = {r[0]: list(r[1:]) for r in index.execute("SELECT sha1, size, mime, codec, layout FROM blobs")}
+        by_codec = collections.defaultdict(lambda: [0, 0, 0])
+        by_mime = collections.defaultdict(lambda: [0, 0, 0])
+        files = logical = stored = tagged = saved = overhead = 0
+        measured = []
+        contents = []  # (sha1, stored size, number of tags)
+
+        for entry in self._scan("data"):
+            stat = entry.stat(follow_symlinks=False)
+            stored += stat.st_size
+
+            if _is_hash_name(entry.name):
+                contents.append((entry.name, stat.st_size, stat.st_nlink - 1))
+            else:
+                overhead += stat.st_size
+
+        packs = self._get_packs()
+        if packs is not None:
+            links = collections.Counter(r[0] for r in packs.execute("SELECT sha1 FROM tags"))
+            for sha1, length in packs.execute("SELECT sha1, length FROM objects"):
+                contents.append((sha1, length, links[sha1]))
+                overhead -= length
+            with os.scandir(os.path.join(self.path, PACK_DIR)) as it:
+                for entry in it:
+                    stored += entry.stat().st_size
+                    overhead += entry.stat().st_size
+
+        for sha1, stored_size, links in contents:
+            if sha1 not in known:
+                blob = self._stored_blob(sha1)
+                known[sha1] = [self._content_size(sha1, blob), None, blob['codec'], blob.get('layout')]
+                measured.append(tuple([sha1] + known[sha1]))
+
+            size, mime, codec, layout = known[sha1]
+            files += 1
+            logical += size
+            tagged += size * links
+            saved += size * max(links - 1, 0)
+
+            for group, name in ((by_codec, layout if layout in ('chunked', 'delta') else codec),
+                                (by_mime, mime or 'unknown')):
+                group[name][0] += 1
+                group[name][1] += size
+                group[name][2] += stored_size
+
+        with index:
+            index.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)", measured)
+
+        for path in ("desc", "chunks", RENDER_DIR, "journal"):
+            try:
+                if path == "desc":
+                    size = sum(entry.stat().st_size for entry in self._scan(path) if entry.is_file())
+                else:
+                    with os.scandir(os.path.join(self.path, path)) as it:
+                        size = sum(entry.stat().st_size for entry in it if entry.is_file())
+            except FileNotFoundError:
+                continue
+            stored += size
+            if path != "chunks":
+                overhead += size
+
+        for name in (INDEX_FILE, CONFIG_FILE, LOCK_FILE):
+            try:
+                size = os.path.getsize(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            stored += size
+            overhead += size
+
+        return Usage(files, logical, stored, tagged, saved, dict(by_codec), dict(by_mime), self.chunk_stats(),
+                     overhead)
+
+    # Reading files
+
+    def get_blob(self, tagname):
+        """
+        Returns the hash file name and the 'repo_blob' section of the description of a tag. The codec of files
+        added before it was recorded is guessed.
+        :param tagname: str
+        :return: (str, dict)
+        """
+        sha1 = self.resolve(tagname)
+
+        return sha1, self._stored_blob(sha1)
+
+    def _stored_blob(self, sha1):
+        """
+        Returns the 'repo_blob' section of the description of a hash file. The codec of files added before it was
+        recorded is guessed.
+        :param sha1: str
+        :return: dict
+        """
+        blob = dict((self._read_desc(sha1) or {}).get('repo_blob', {}))
+
+        # Files added before the codec was recorded are zlib compressed if not recognized by magic
+        if 'codec' not in blob:
+            import magic
+            mime = magic.from_file(self._data_path(sha1), mime=True)
+            blob['codec'] = 'zlib' if mime == b'application/octet-stream' else 'none'
+
+        return blob
+
+    def _get_block_offsets(self, sha1, first, last):
+        """
+        Read the block size, the file size and the offsets of the blocks first to last (inclusive) and of the
+        end of block last from the block index of a seekable file
+        :param sha1: str
+        :param first: int
+        :param last: int or None for the last block of the file
+        :return: (int, int, list)
+        """
+        with open(self._hash_path("data", sha1 + BLOCK_SUFFIX), 'rb') as f_r:
+            block_size, size = struct.unpack('<QQ', f_r.read(16))
+            blocks = (size + block_size - 1) // block_size
+            last = blocks - 1 if last is None else min(last, blocks - 1)
+
+            if last < first:
+                return block_size, size, []
+
+            f_r.seek(16 + 8 * first)
+            n = last - first + 2
+            return block_size, size, list(struct.unpack('<{}Q'.format(n), f_r.read(8 * n)))
+
+    def _iter_range(self, sha1, blob, offset=0, length=None):
+        """
+        Read a range of the original content of a data file piece by piece. For chunked and seekable files only
+        the chunks or blocks covering the range are read and decompressed. Deltas are rebuilt up to the end of the
+        range.
+        :param sha1: str
+        :param blob: dict 'repo_blob' section of the description
+        :param offset: int
+        :param length: int or None to read to the end of the file
+        :return: generator of bytes
+        """
+        path = self._data_path(sha1)
+        codec = blob.get('codec', 'none')
+        layout = blob.get('layout')
+        end = None if length is None else offset + length
+
+        def cut(data, pos):
+            # Restrict data starting at file position pos to the range
+            return data[max(offset - pos, 0):None if end is None else max(end - pos, 0)]
+
+        if end is not None and end <= offset:
+            return
+
+        if layout == 'chunked':
+            pos = 0
+            for chunk_sha1, size in self._get_manifest(sha1)['chunks']:
+                if end is not None and pos >= end:
+                    break
+                if pos + size > offset:
+                    with open(os.path.join(self.path, "chunks", chunk_sha1), 'rb') as f_r:
+                        data = f_r.read()
+                    yield cut(_decompress(data, _sniff_codec(data)), pos)
+                pos += size
+        elif layout == 'delta':
+            pos = 0
+            for data in self._iter_delta(sha1, blob):
+                if end is not None and pos >= end:
+                    break
+                if pos + len(data) > offset:
+                    yield cut(data, pos)
+                pos += len(data)
+        elif layout == 'blocks':
+            block_size = blob['block_size']
+            first = offset // block_size
+            last = None if end is None else (end - 1) // block_size
+            block_size, size, offsets = self._get_block_offsets(sha1, first, last)
+            with open(path, 'rb') as f_r:
+                f_r.seek(offsets[0] if offsets else 0)
+                for i in range(len(offsets) - 1):
+                    data = _decompress(f_r.read(offsets[i + 1] - offsets[i]), codec)
+                    yield cut(data, (first + i) * block_size)
+        elif codec == 'none':
+            with self._open_data(sha1) as f_r:
+                f_r.seek(offset)
+                while end is None or f_r.tell() < end:
+                    data = f_r.read(CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - f_r.tell()))
+                    if not data:
+                        break
+                    yield data
+        else:
+            # No random access possible. Decompress and skip everything before the range.
+            decompressor = CODECS[codec].decompressor()
+            pos = 0
+            with self._open_data(sha1) as f_r:
+                for chunk in iter(lambda: f_r.read(CHUNK_SIZE), b''):
+                    data = decompressor.decompress(chunk)
+                    if pos + len(data) > offset:
+                        yield cut(data, pos)
+                    pos += len(data)
+                    if end is not None and pos >= end:
+                        break
+
+    def iter_range(self, tagname, offset=0, length=None):
+        """
+        Read a range of bytes of a file in the repository piece by piece. Only the needed parts of seekable and
+        chunked files are decompressed.
+        :param tagname: str
+        :param offset: int
+        :param length: int or None to read to the end of the file
+        :return: generator of bytes
+        """
+        sha1, blob = self.get_blob(tagname)
+
+        return self._iter_range(sha1, blob, offset, length)
+
+    def read_range(self, tagname, offset=0, length=None):
+        """
+        Read a range of bytes of a file in the repository
+        :param tagname: str
+        :param offset: int
+        :param length: int or None to read to the end of the file
+        :return: bytes
+        """
+        return b''.join(self.iter_range(tagname, offset, length))
+
+    def get(self, tagname, target, link=False, version=None):
+        """
+        Copy a file from the repository. Uncompressed files are copied by the kernel if possible, compressed
+        files are decompressed chunk by chunk and deltas are rebuilt from the versions before them.
+        :param tagname: str
+        :param target: str path of the new file or of a directory, or an open binary file
+        :param link: bool create a symbolic link to the repository file. Only for uncompressed files.
+        :param version: int version of a file stored by update, see get_version. Default is the current version.
+        :return: str path of the new file or None if target is an open file
+        """
+        import shutil
+
+        sha1, blob = self.get_blob(tagname) if version is None else self.get_version(tagname, version)
+        src = self._data_path(sha1)
+        plain = blob.get('layout') is None and blob['codec'] == 'none' and os.path.exists(src)
+
+        if link and not plain:
+            raise RepositoryError("Only uncompressed files outside of packs can be linked. '{}' is stored {}".format(
+                tagname, 'compressed' if blob['codec'] != 'none' or blob.get('layout') else 'in a pack'))
+
+        if not isinstance(target, str):
+            if link:
+                raise RepositoryError("Only paths can be linked")
+            self._write_content(sha1, blob, target)
+            target.flush()
+            return None
+
+        dst = os.path.expanduser(target)
+
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, tagname)
+
+        if os.path.isfile(dst):
+            raise RepositoryError("File already exists at {}".format(dst))
+
+        if link:
+            mode = os.stat(src).st_mode
+            if mode & 0o222:
+                # Stored before hash files were read only
+                try:
+                    os.chmod(src, mode & 0o555)
+                except PermissionError:
+                    raise RepositoryError("'{}' is writable and can not be linked. Get a copy instead".format(tagname))
+            os.symlink(src, dst)
+            return dst
+
+        with open(dst, 'wb') as f_w:
+            self._write_content(sha1, blob, f_w)
+
+        if plain:
+            shutil.copystat(src, dst)
+            # The copy is writable again like any new file
+            os.chmod(dst, os.stat(dst).st_mode | _new_file_mode(0o222))
+
+        return dst
+
+    def _write_content(self, sha1, blob, f_w):
+        """
+        Write the original content of a data file to an open file
+        :param sha1: str
+        :param blob: dict 'repo_blob' section of the description
+        :param f_w: file
+        :return: None
+        """
+        with _trace('write content', 'io', codec=blob['codec'], layout=blob.get('layout')) as span:
+            if blob.get('layout') is not None:
+                for data in self._iter_range(sha1, blob):
+                    f_w.write(data)
+                    span.add(len(data))
+                return
+
+            with self._open_data(sha1) as f_r:
+                if blob['codec'] == 'none':
+                    span.add(_copy_file_data(f_r, f_w))
+                else:
+                    span.add(_decompress_stream(f_r, f_w, blob['codec']))
+
+    def _content_size(self, sha1, blob):
+        """
+        Returns the size of the original content of a data file. Files compressed as a whole are decompressed to
+        count their bytes.
+        :param sha1: str
+        :param blob: dict 'repo_blob' section of the description
+        :return: int
+        """
+        if blob.get('layout') == 'chunked':
+            return self._get_manifest(sha1)['size']
+        if blob.get('layout') == 'blocks':
+            return self._get_block_offsets(sha1, 0, 0)[1]
+        if blob.get('layout') == 'delta':
+            return blob['size']
+        if blob.get('codec', 'none') == 'none':
+            try:
+                return os.path.getsize(self._data_path(sha1))
+            except FileNotFoundError:
+                if self._packed(sha1) is None:
+                    raise
+                return self._packed(sha1)[2]
+
+        return sum(len(data) for data in self._iter_range(sha1, blob))
+
+
+def _parse_range(value, size):
+    """
+    Parse the value of a HTTP Range header. Only single byte ranges are supported.
+    :param value: str
+    :param size: int size of the content
+    :return: (start, end) tuple with end exclusive, None if the range is not satisfiable or False if the header
+             has to be ignored
+    """
+    unit, _, spec = value.partition("=")
+
+    if unit.strip() != 'bytes' or "," in spec:
+        return False
+
+    first, _, last = spec.strip().partition("-")
+
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = size if not last else min(int(last) + 1, size)
+    except ValueError:
+        return False
+
+    if start >= size or end <= start:
+        return None
+
+    return start, end
+
+
+class _Server(object):
+    """
+    Read only HTTP/1.1 API of a repository on asyncio. One process serves all clients over persistent
+    connections. The event loop only parses requests and writes responses. Lookups, renderings and reads of file
+    contents run on the thread pool of the event loop. Each thread keeps its own repository object with warm tag
+    and description caches and its own renderer, as neither may be shared between threads.
+
+    GET /tags?pattern=<shell pattern>   JSON list of {"tag": ..., "sha1": ...} objects
+    GET /tags/<tag>                     JSON with the hash file name, the size and the aliases of a tag
+    GET /desc/<tag>?format=<format>     Description as json (default), markdown, html5 or pdf
+    GET /blob/<tag>                     File content. Single byte ranges are supported.
+    """
+
+    REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 416: 'Range Not Satisfiable', 500: 'Internal Server Error'}
+
+    CONTENT_TYPES = {'json': 'application/json', 'markdown': 'text/markdown; charset=utf-8',
+                     'html5': 'text/html; charset=utf-8', 'pdf': 'application/pdf'}
+
+    def __init__(self, repo):
+        import threading
+
+        self._path = repo.path
+        self._local = threading.local()
+        self._sizes = dict() # sha1: size of the original content
+
+    def _thread_repo(self):
+        """
+        Returns the repository object and the renderer of the current thread of the thread pool
+        :return: (Repository, _Renderer)
+        """
+        if not hasattr(self._local, 'repo'):
+            self._local.repo = Repository(self._path)
+            self._local.renderer = _Renderer()
+
+        return self._local.repo, self._local.renderer
+
+    async def _run(self, func, *args):
+        """
+        Run a blocking function on the thread pool
+        :param func: function called with the repository object and the renderer of the thread and args
+        :return: the result of func
+        """
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: func(*self._thread_repo(), *args))
+
+    async def serve(self, host, port):
+        """
+        Serve until cancelled
+        :param host: str
+        :param port: int
+        :return: None
+        """
+        import asyncio
+
+        server = await asyncio.start_server(self._handle, host, port)
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        import asyncio
+
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+
+                lines = head.decode('latin-1').split("\r\n")
+                request = lines[0].split(" ")
+                headers = dict()
+
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                if len(request) != 3:
+                    await self._send(writer, 400, b"Bad request\n", keep_alive=False)
+                    break
+
+                method, target, version = request
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+
+                if 'content-length' in headers:
+                    await reader.readexactly(int(headers['content-length']))
+
+                await self._dispatch(writer, method, target, headers, keep_alive)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status, body=b'', content_type='text/plain; charset=utf-8', headers=None,
+                    keep_alive=True, head=False):
+        """
+        Write a response with a complete body
+        :param writer: asyncio.StreamWriter
+        :param status: int
+        :param body: bytes
+        :param content_type: str
+        :param headers: dict additional headers
+        :param keep_alive: bool
+        :param head: bool omit the body for HEAD requests
+        :return: None
+        """
+        self._write_head(writer, status, dict({'Content-Type': content_type, 'Content-Length': len(body)},
+                                              **(headers or {})), keep_alive)
+        if not head:
+            writer.write(body)
+        await writer.drain()
+
+    def _write_head(self, writer, status, headers, keep_alive):
+        """
+        Write the status line and the headers of a response
+        :param writer: asyncio.StreamWriter
+        :param status: int
+        :param headers: dict
+        :param keep_alive: bool
+        :return: None
+        """
+        lines = ["HTTP/1.1 {} {}".format(status, self.REASONS[status])]
+        lines += ["{}: {}".format(key, value) for key, value in headers.items()]
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    async def _dispatch(self, writer, method, target, headers, keep_alive):
+        from urllib.parse import urlsplit, unquote, parse_qs
+
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = [unquote(part) for part in url.path.strip("/").split("/")]
+        head = method == 'HEAD'
+        send = partial(self._send, writer, keep_alive=keep_alive, head=head)
+
+        if method not in ('GET', 'HEAD'):
+            await send(405, b"Only GET and HEAD are supported\n", headers={'Allow': 'GET, HEAD'})
+            return
+
+        try:
+            if path == ['tags']:
+                tags = await self._run(lambda repo, renderer: [{'tag': tag, 'sha1': sha1} for sha1, tag in
+                                                               repo.list_tags(query.get('pattern'))])
+                await send(200, json.dumps(tags).encode('utf-8'), self.CONTENT_TYPES['json'])
+            elif len(path) == 2 and path[0] == 'tags':
+                sha1, blob, aliases = await self._run(lambda repo, renderer: repo.get_blob(path[1]) +
+                                                      (repo.aliases(path[1]),))
+                info = {'tag': path[1], 'sha1': sha1, 'size': await self._size(sha1, blob), 'aliases': aliases}
+                await send(200, json.dumps(info).encode('utf-8'), self.CONTENT_TYPES['json'])
+            elif len(path) == 2 and path[0] == 'desc':
+                format = query.get('format', Format(4).name)
+                if format not in self.CONTENT_TYPES:
+                    await send(400, "Unknown format: {}\n".format(format).encode('utf-8'))
+                    return
+                await send(200, await self._render(path[1], format), self.CONTENT_TYPES[format])
+            elif len(path) == 2 and path[0] == 'blob':
+                await self._send_blob(writer, path[1], headers, keep_alive, head)
+            else:
+                await send(404, b"Not found\n")
+        except RepositoryError as e:
+            await send(404, "{}\n".format(e).encode('utf-8'))
+        except ConnectionError:
+            raise
+        except Exception as e:
+            print("{} {}: {!r}".format(method, target, e), file=sys.stderr)
+            await send(500, b"Internal server error\n")
+
+    async def _size(self, sha1, blob):
+        if sha1 not in self._sizes:
+            self._sizes[sha1] = await self._run(lambda repo, renderer: repo._content_size(sha1, blob))
+
+        return self._sizes[sha1]
+
+    async def _render(self, tagname, format):
+        return await self._run(lambda repo, renderer: repo._render(tagname, format, renderer)[0])
+
+    async def _send_blob(self, writer, tagname, headers, keep_alive, head):
+        import asyncio
+
+        sha1, blob = await self._run(lambda repo, renderer: repo.get_blob(tagname))
+        etag = '"{}"'.format(sha1)
+
+        if headers.get('if-none-match') == etag:
+            await self._send(writer, 304, headers={'ETag': etag}, keep_alive=keep_alive, head=True)
+            return
+
+        size = await self._size(sha1, blob)
+        status, start, end = 200, 0, size
+        response = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes', 'ETag': etag}
+
+        if 'range' in headers and headers.get('if-range', etag) == etag:
+            byte_range = _parse_range(headers['range'], size)
+            if byte_range is None:
+                await self._send(writer, 416, headers={'Content-Range': 'bytes */{}'.format(size)},
+                                 keep_alive=keep_alive, head=head)
+                return
+            if byte_range:
+                status, (start, end) = 206, byte_range
+                response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+
+        response['Content-Length'] = end - start
+        self._write_head(writer, status, response, keep_alive)
+
+        if not head:
+            loop = asyncio.get_running_loop()
+            # The pieces are read on any thread of the pool one after the other, so the stream has a repository
+            # object of its own
+            pieces = Repository(self._path)._iter_range(sha1, blob, start, end - start)
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, next, pieces, None)
+                    if data is None:
+                        break
+                    writer.write(data)
+                    await writer.drain()
+            except ConnectionError:
+                raise
+            except Exception as e:
+                # The head is sent already. Drop the connection so the client notices the truncated content.
+                print("GET /blob/{}: {!r}".format(tagname, e), file=sys.stderr)
+                raise ConnectionAbortedError(str(e))
+            finally:
+                pieces.close()
+
+        await writer.drain()
+
+
+# Sync protocol. Each message is a JSON object prefixed by its length as 4 byte big endian integer. Hash sets follow
+# their message as concatenated binary sha1s. Hash files and chunks are streamed as records: a message with the kind
+# and the metadata followed by a pack record (PACK_RECORD header and data). A message {"kind": "end"} ends a stream.
+# A server which failed replies {"error": message} and exits.
+
+def _send_message(f_w, message):
+    """
+    Write a message of the sync protocol
+    :param f_w: binary file
+    :param message: dict
+    :return: None
+    """
+    data = json.dumps(message).encode('utf-8')
+    f_w.write(struct.pack('>I', len(data)))
+    f_w.write(data)
+
+
+def _read_exactly(f_r, n):
+    """
+    Read n bytes of the sync protocol
+    :param f_r: binary file
+    :param n: int
+    :return: bytes
+    """
+    data = f_r.read(n)
+
+    if len(data) != n:
+        raise RepositoryError("The sync connection was closed")
+
+    return data
+
+
+def _receive_message(f_r, eof=False):
+    """
+    Read a message of the sync protocol. An error reply of the server is raised as RepositoryError.
+    :param f_r: binary file
+    :param eof: bool return None at the end of the input instead of raising
+    :return: dict
+    """
+    head = f_r.read(4)
+
+    if not head and eof:
+        return None
+
+    head += _read_exactly(f_r, 4 - len(head))
+    message = json.loads(_read_exactly(f_r, struct.unpack('>I', head)[0]).decode('utf-8'))
+
+    if 'error' in message:
+        raise RepositoryError(message['error'])
+
+    return message
+
+
+def _send_hashes(f_w, hashes):
+    """
+    Write a set of sha1s as concatenated binary digests
+    :param f_w: binary file
+    :param hashes: iterable of str
+    :return: None
+    """
+    f_w.write(b"".join(bytes.fromhex(sha1) for sha1 in hashes))
+
+
+def _receive_hashes(f_r, n):
+    """
+    Read n binary sha1s
+    :param f_r: binary file
+    :param n: int
+    :return: set of str
+    """
+    data = _read_exactly(f_r, 20 * n)
+
+    return set(data[i:i + 20].hex() for i in range(0, len(data), 20))
+
+
+def _iter_file(f_r):
+    """
+    Read an open file piece by piece and close it at the end
+    :param f_r: binary file
+    :return: generator of bytes
+    """
+    with f_r:
+        for piece in iter(lambda: f_r.read(CHUNK_SIZE), b''):
+            yield piece
+
+
+def _send_records(f_w, records):
+    """
+    Stream hash files or chunks as records
+    :param f_w: binary file
+    :param records: iterable of (header, pieces) tuples, see _SyncPeer.read
+    :return: None
+    """
+    for header, pieces in records:
+        _send_message(f_w, header)
+        f_w.write(PACK_RECORD.pack(bytes.fromhex(header['sha1']), header['size'] - header.get('offset', 0)))
+        for piece in pieces:
+            f_w.write(piece)
+
+    _send_message(f_w, {'kind': 'end'})
+
+
+def _receive_records(f_r):
+    """
+    Read a stream of records. The data of each record is read lazily and skipped if it was not consumed before
+    the next record is taken.
+    :param f_r: binary file
+    :return: generator of (header, pieces) tuples
+    """
+    while True:
+        header = _receive_message(f_r)
+
+        if header['kind'] == 'end':
+            return
+
+        sha1, length = PACK_RECORD.unpack(_read_exactly(f_r, PACK_RECORD.size))
+        if sha1.hex() != header['sha1'] or length != header['size'] - header.get('offset', 0):
+            raise RepositoryError("Damaged sync record of {}".format(header['sha1']))
+
+        pieces = _receive_pieces(f_r, length)
+        yield header, pieces
+
+        for _ in pieces:
+            pass
+
+
+def _receive_pieces(f_r, n):
+    """
+    Read n bytes of the sync protocol piece by piece
+    :param f_r: binary file
+    :param n: int
+    :return: generator of bytes
+    """
+    while n:
+        piece = _read_exactly(f_r, min(n, CHUNK_SIZE))
+        n -= len(piece)
+        yield piece
+
+
+class _SyncPeer(object):
+    """
+    One side of rms sync on a local repository. _RemotePeer offers the same methods for a repository at the other
+    end of a pipe to 'rms sync-serve'.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def tags(self, patterns=None):
+        """
+        Returns the tags with hash file
+        :param patterns: list of shell patterns of the tags or None for all tags
+        :return: dict {tag: sha1}
+        """
+        return {tag: sha1 for sha1, tag in self.repo.list_tags()
+                if sha1 is not None and (not patterns or any(fnmatch.fnmatchcase(tag, p) for p in patterns))}
+
+    def contents(self):
+        """
+        Returns the summary of the stored data the other side needs to send only what is missing
+        :return: (set, set, dict) the hash files, loose and packed, the chunks and {sha1: size} of the partially
+                 received hash files of interrupted syncs
+        """
+        repo = self.repo
+        hashes = repo.hashes()
+        chunks = set()
+        partial = dict()
+
+        # Create or upgrade the index before the writers start. A rebuild by one of them would drop the chunk
+        # references of the files the others received but did not tag yet.
+        repo._get_index()
+
+        packs = repo._get_packs()
+        if packs is not None:
+            hashes.update(r[0] for r in packs.execute("SELECT sha1 FROM objects"))
+
+        if os.path.isdir(os.path.join(repo.path, "chunks")):
+            with os.scandir(os.path.join(repo.path, "chunks")) as it:
+                chunks = set(entry.name for entry in it if _is_hash_name(entry.name))
+
+        with os.scandir(os.path.join(repo.path, "data")) as it:
+            for entry in it:
+                if entry.name.startswith(SYNC_PREFIX):
+                    partial[entry.name[len(SYNC_PREFIX):]] = entry.stat().st_size
+
+        return hashes, chunks, partial
+
+    def versions(self, sha1s):
+        """
+        Returns the older versions of files stored by update, which have to be copied with them
+        :param sha1s: list of str
+        :return: dict {sha1: list of the hash files of its older versions} of the files with versions
+        """
+        chains = dict()
+
+        for sha1 in sha1s:
+            older = _older_versions(self.repo._read_desc(sha1) or {}, sha1)
+            if older:
+                chains[sha1] = older
+
+        return chains
+
+    def chunks(self, sha1s):
+        """
+        Returns the chunks of the chunk manifests among hash files
+        :param sha1s: list of str
+        :return: set of str
+        """
+        repo = self.repo
+        chunks = set()
+
+        for sha1 in sha1s:
+            desc = repo._read_desc(sha1)
+            if desc is not None and _is_chunked(desc):
+                chunks.update(chunk_sha1 for chunk_sha1, size in repo._get_manifest(sha1)['chunks'])
+
+        return chunks
+
+    def _chunk_record(self, sha1):
+        """
+        Returns the record of a chunk for read
+        :param sha1: str
+        :return: (header, pieces) tuple
+        """
+        f_r = open(os.path.join(self.repo.path, "chunks", sha1), 'rb')
+        return {'kind': 'chunk', 'sha1': sha1, 'size': os.fstat(f_r.fileno()).st_size}, _iter_file(f_r)
+
+    def read_chunks(self, sha1s):
+        """
+        Stream chunks, see read
+        :param sha1s: iterable of str
+        :return: generator of (header, pieces) tuples
+        """
+        for sha1 in sha1s:
+            yield self._chunk_record(sha1)
+
+    def read(self, sha1s, offsets=None, chunks=()):
+        """
+        Stream hash files with their descriptions. The chunks of a chunk manifest the other side does not have are
+        sent before the manifest. The descriptions are sent without tags, see link.
+        :param sha1s: list of str
+        :param offsets: dict {sha1: offset} to continue partially received hash files at
+        :param chunks: set of the chunks the other side has
+        :return: generator of (header, pieces) tuples. header is {'kind': 'chunk', 'sha1', 'size'} or
+                 {'kind': 'object', 'sha1', 'size', 'offset', 'desc', 'index'}, index is the hex block index of
+                 seekable files. pieces is a generator of the data from offset on and has to be consumed before
+                 the next record.
+        """
+        repo = self.repo
+        offsets = offsets or {}
+        chunks = set(chunks)
+
+        for sha1 in sha1s:
+            desc = repo._read_desc(sha1)
+
+            if desc is None or not repo._exists(sha1):
+                raise RepositoryError("{} is not in the repository".format(sha1))
+
+            if _is_chunked(desc):
+                for chunk_sha1, size in repo._get_manifest(sha1)['chunks']:
+                    if chunk_sha1 not in chunks:
+                        chunks.add(chunk_sha1)
+                        yield self._chunk_record(chunk_sha1)
+
+            index = None
+            if desc.get('repo_blob', {}).get('layout') == 'blocks':
+                with open(repo._hash_path("data", sha1 + BLOCK_SUFFIX), 'rb') as f_r:
+                    index = f_r.read().hex()
+
+            f_r = repo._open_data(sha1)
+            size = f_r.seek(0, os.SEEK_END)
+            offset = f_r.seek(min(offsets.get(sha1, 0), size))
+            desc['tags'] = []
+
+            yield {'kind': 'object', 'sha1': sha1, 'size': size, 'offset': offset, 'desc': desc, 'index': index}, \
+                _iter_file(f_r)
+
+    def write(self, records):
+        """
+        Store the streamed hash files, chunks and descriptions of read. Hash files are received into a temporary
+        file in the data directory which is kept after an interruption, so the next sync continues at its end.
+        Like the temporary files of add it is removed by gc after GC_MIN_AGE. Received hash files are stored in
+        batches of SYNC_BATCH with one journal for their descriptions and the tags listed in their headers.
+        :param records: iterable of (header, pieces) tuples. The headers of hash files may list the tags to add.
+        :return: (int, int, int, list, list) number of stored hash files and chunks, the bytes received for them,
+                 the new tags and the tags which existed already
+        """
+        files = chunks = size = 0
+        received = []
+        linked, taken = [], []
+
+        # New chunks are not referenced before their manifest is stored. Keep them from being removed meanwhile.
+        with self.repo._locked(['chunks'], shared=True):
+            for header, pieces in records:
+                if header['kind'] == 'chunk':
+                    new, n = self._write_chunk(header['sha1'], pieces)
+                    chunks += new
+                else:
+                    new, n = self._receive_object(header, pieces)
+                    if new:
+                        received.append(new)
+                size += n
+
+                if len(received) >= SYNC_BATCH:
+                    files += self._store_received(received, linked, taken)
+                    received = []
+
+            files += self._store_received(received, linked, taken)
+
+        return files, chunks, size, linked, taken
+
+    def _write_chunk(self, sha1, pieces):
+        """
+        Store a received chunk unless it exists. The chunk is checked against its name.
+        :param sha1: str
+        :param pieces: generator of bytes
+        :return: (bool, int) whether the chunk was new and its size
+        """
+        import hashlib
+
+        chunk_dir = os.path.join(self.repo.path, "chunks")
+        path = os.path.join(chunk_dir, sha1)
+        data = b"".join(pieces)
+
+        if os.path.exists(path):
+            return False, 0
+
+        codec = _sniff_codec(data)
+        if codec is None or hashlib.sha1(_decompress(data, codec)).hexdigest() != sha1:
+            raise RepositoryError("Received chunk {} is damaged".format(sha1))
+
+        os.makedirs(chunk_dir, exist_ok=True)
+        _write_file(path, data)
+        _fsync_path(chunk_dir)
+
+        return True, len(data)
+
+    def _receive_object(self, header, pieces):
+        """
+        Receive a hash file into its temporary file unless it exists. The data is checked against its name, the
+        chunks of a chunk manifest have to be stored before.
+        :param header: dict
+        :param pieces: generator of bytes
+        :return: (header, int) the header or None if the hash file exists and the bytes received
+        """
+        repo = self.repo
+        sha1 = header['sha1']
+
+        if repo._exists(sha1):
+            # Skip the data, the next record follows it
+            for _ in pieces:
+                pass
+            return None, 0
+
+        tmp = os.path.join(repo.path, "data", SYNC_PREFIX + sha1)
+        received = 0
+
+        with open(tmp, 'ab') as f_w, _trace('receive', 'io') as span:
+            # Continue the data of an interrupted sync at the offset the other side was asked for
+            f_w.truncate(header['offset'])
+            for piece in pieces:
+                f_w.write(piece)
+                received += len(piece)
+                span.add(len(piece))
+            f_w.flush()
+            os.fsync(f_w.fileno())
+
+        if os.path.getsize(tmp) != header['size']:
+            raise RepositoryError("Received {} is incomplete".format(sha1))
+
+        if _is_chunked(header['desc']):
+            with open(tmp, 'r') as f_r:
+                chunks = json.loads(f_r.read())['chunks']
+            if not all(os.path.exists(os.path.join(repo.path, "chunks", c)) for c, size in chunks):
+                os.remove(tmp)
+                raise RepositoryError("Chunks of {} were not received".format(sha1))
+        elif _get_file_sha1(tmp) != sha1:
+            os.remove(tmp)
+            raise RepositoryError("Received {} does not match its hash".format(sha1))
+
+        return header, received
+
+    def _store_received(self, headers, linked, taken):
+        """
+        Rename received hash files to their hash names and write their descriptions and tags in one journal. After
+        an interruption before, the next sync finds the complete temporary files and receives nothing for them.
+        :param headers: list of the headers of the received hash files
+        :param linked: list the new tags are appended to
+        :param taken: list the tags which existed already are appended to
+        :return: int number of stored hash files
+        """
+        repo = self.repo
+        chunk_dir = os.path.join(repo.path, "chunks")
+        steps = []
+        manifests = []
+        dirs = set()
+
+        with repo._locked(['tag:' + tagname for header in headers for tagname in header.get('tags', ())]), \
+                repo._locked(['hash:' + header['sha1'] for header in headers]):
+            for header in headers:
+                sha1 = header['sha1']
+                tmp = os.path.join(repo.path, "data", SYNC_PREFIX + sha1)
+
+                if repo._exists(sha1):
+                    os.remove(tmp)
+                    continue
+
+                dst = repo._data_path(sha1)
+                repo._make_dirs(dst)
+
+                if header['index'] is not None:
+                    _write_file(repo._hash_path("data", sha1 + BLOCK_SUFFIX), bytes.fromhex(header['index']))
+
+                if _is_chunked(header['desc']):
+                    with open(tmp, 'r') as f_r:
+                        manifest = json.loads(f_r.read())
+                    manifests.append([sha1, manifest['size'], [[c, size, os.path.getsize(os.path.join(chunk_dir, c))]
+                                                               for c, size in manifest['chunks']]])
+
+                os.chmod(tmp, os.stat(tmp).st_mode & 0o555)
+                os.rename(tmp, dst)
+                dirs.add(os.path.dirname(dst))
+
+                desc = header['desc']
+                for tagname in header.get('tags', ()):
+                    if repo._tag_exists(tagname):
+                        taken.append(tagname)
+                    else:
+                        steps.append(['link', sha1, tagname])
+                        desc['tags'].append(tagname)
+                        linked.append(tagname)
+                steps.append(['desc', sha1, desc])
+                if desc.get('repo_versions'):
+                    steps.append(['versions', sha1, _older_versions(desc, sha1)])
+
+            for path in dirs:
+                _fsync_path(path)
+
+            if manifests:
+                steps.append(['manifests', manifests])
+            repo._commit(steps)
+
+        return sum(step[0] == 'desc' for step in steps)
+
+    def link(self, tags):
+        """
+        Tag stored hash files. Existing tags are kept, also if they belong to other files.
+        :param tags: dict {tag: sha1}
+        :return: (list, list) the new tags and the existing tags of other files
+        """
+        from datetime import date
+
+        repo = self.repo
+        linked, conflicts = [], []
+
+        with repo._locked(['tag:' + tagname for tagname in tags]):
+            with repo._locked(['hash:' + sha1 for sha1 in set(tags.values())]):
+                descs = collections.OrderedDict()
+
+                for tagname, sha1 in sorted(tags.items()):
+                    if repo._tag_exists(tagname):
+                        try:
+                            if repo.resolve(tagname) == sha1:
+                                continue
+                        except RepositoryError:
+                            pass
+                        conflicts.append(tagname)
+                        continue
+
+                    if not repo._exists(sha1):
+                        raise RepositoryError("{} of tag '{}' was not received".format(sha1, tagname))
+
+                    if sha1 not in descs:
+                        descs[sha1] = repo._read_desc(sha1) or {"repo_date": str(date.today()), "tags": []}
+                    descs[sha1]['tags'].append(tagname)
+                    linked.append(tagname)
+
+                steps = [['link', tags[tagname], tagname] for tagname in linked]
+                steps += [['desc', sha1, json_data] for sha1, json_data in descs.items()]
+                repo._commit(steps)
+
+        return linked, conflicts
+
+    def close(self):
+        pass
+
+
+class _RemotePeer(object):
+    """
+    One side of rms sync at the other end of a pipe to 'rms sync-serve', started by a command like ssh. Offers the
+    methods of _SyncPeer.
+    """
+
+    def __init__(self, command):
+        """
+        :param command: list of str or str run by the shell
+        """
+        import subprocess
+
+        self._process = subprocess.Popen(command, shell=isinstance(command, str), stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self._r = self._process.stdout
+        self._w = self._process.stdin
+
+    def _request(self, message):
+        _send_message(self._w, message)
+        self._w.flush()
+        return _receive_message(self._r)
+
+    def tags(self, patterns=None):
+        return self._request({'op': 'tags', 'patterns': patterns})['tags']
+
+    def contents(self):
+        reply = self._request({'op': 'contents'})
+        return _receive_hashes(self._r, reply['hashes']), _receive_hashes(self._r, reply['chunks']), reply['partial']
+
+    def versions(self, sha1s):
+        return self._request({'op': 'versions', 'sha1s': sha1s})['versions']
+
+    def chunks(self, sha1s):
+        reply = self._request({'op': 'chunks', 'sha1s': sha1s})
+        return _receive_hashes(self._r, reply['chunks'])
+
+    def read_chunks(self, sha1s):
+        sha1s = list(sha1s)
+        _send_message(self._w, {'op': 'read_chunks', 'chunks': len(sha1s)})
+        _send_hashes(self._w, sha1s)
+        self._w.flush()
+        return _receive_records(self._r)
+
+    def read(self, sha1s, offsets=None, chunks=()):
+        _send_message(self._w, {'op': 'read', 'sha1s': sha1s, 'offsets': offsets or {}, 'chunks': len(chunks)})
+        _send_hashes(self._w, chunks)
+        self._w.flush()
+        return _receive_records(self._r)
+
+    def write(self, records):
+        _send_message(self._w, {'op': 'write'})
+        try:
+            _send_records(self._w, records)
+            self._w.flush()
+        except BrokenPipeError:
+            pass  # The server failed. Its reply tells why.
+        reply = _receive_message(self._r)
+        return reply['files'], reply['chunks'], reply['bytes'], reply['linked'], reply['taken']
+
+    def link(self, tags):
+        reply = self._request({'op': 'link', 'tags': tags})
+        return reply['linked'], reply['conflicts']
+
+    def close(self):
+        # The server exits at the end of its input. Closing its output too ends a server blocked on a reply.
+        for f in (self._w, self._r):
+            try:
+                f.close()
+            except OSError:
+                pass
+        self._process.wait()
+
+
+def _serve_sync(repo, f_r, f_w):
+    """
+    Answer the requests of a _RemotePeer until the end of the input
+    :param repo: Repository
+    :param f_r: binary file
+    :param f_w: binary file
+    :return: None
+    """
+    peer = _SyncPeer(repo)
+
+    while True:
+        request = _receive_message(f_r, eof=True)
+
+        if request is None:
+            return
+
+        try:
+            if request['op'] == 'tags':
+                _send_message(f_w, {'tags': peer.tags(request['patterns'])})
+            elif request['op'] == 'contents':
+                hashes, chunks, partial = peer.contents()
+                _send_message(f_w, {'hashes': len(hashes), 'chunks': len(chunks), 'partial': partial})
+                _send_hashes(f_w, hashes)
+                _send_hashes(f_w, chunks)
+            elif request['op'] == 'versions':
+                _send_message(f_w, {'versions': peer.versions(request['sha1s'])})
+            elif request['op'] == 'chunks':
+                chunks = peer.chunks(request['sha1s'])
+                _send_message(f_w, {'chunks': len(chunks)})
+                _send_hashes(f_w, chunks)
+            elif request['op'] == 'read_chunks':
+                _send_records(f_w, peer.read_chunks(_receive_hashes(f_r, request['chunks'])))
+            elif request['op'] == 'read':
+                chunks = _receive_hashes(f_r, request['chunks'])
+                _send_records(f_w, peer.read(request['sha1s'], request['offsets'], chunks))
+            elif request['op'] == 'write':
+                files, chunks, size, linked, taken = peer.write(_receive_records(f_r))
+                _send_message(f_w, {'files': files, 'chunks': chunks, 'bytes': size, 'linked': linked,
+                                    'taken': taken})
+            elif request['op'] == 'link':
+                linked, conflicts = peer.link(request['tags'])
+                _send_message(f_w, {'linked': linked, 'conflicts': conflicts})
+            else:
+                raise RepositoryError("Unknown sync request '{}'".format(request['op']))
+        except (RepositoryError, OSError) as e:
+            # A stream may be cut in the middle, the connection can not be used any more
+            try:
+                _send_message(f_w, {'error': str(e)})
+                f_w.flush()
+            except OSError:
+                pass
+            raise
+
+        f_w.flush()
+
+
+def _open_peer(location, remote_rms='rms', process=False):
+    """
+    Open one side of rms sync
+    :param location: str path of a repository (the .rms directory), ssh://[user@]host[:port]/path or exec:command.
+                     The command is run by the shell and has to speak the protocol of 'rms sync-serve' on its
+                     standard input and output, like 'exec:ssh host rms sync-serve /path'.
+    :param remote_rms: str command running rms on ssh hosts
+    :param process: bool serve a local repository by a 'rms sync-serve' process
+    :return: _SyncPeer or _RemotePeer
+    """
+    if location.startswith('exec:'):
+        return _RemotePeer(location[len('exec:'):])
+
+    if location.startswith('ssh://'):
+        import shlex
+        from urllib.parse import urlsplit
+
+        url = urlsplit(location)
+        host = url.hostname if url.username is None else url.username + '@' + url.hostname
+        port = ['-p', str(url.port)] if url.port else []
+        return _RemotePeer(shlex.split(os.environ.get(SSH_ENV, 'ssh')) + port +
+                           [host, '{} sync-serve {}'.format(remote_rms, shlex.quote(url.path))])
+
+    repo = Repository(location)
+
+    if process:
+        # The stub next to this module starts faster than this module run as script, which is compiled every time
+        entry = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rms')
+        if not os.path.isfile(entry):
+            entry = os.path.abspath(__file__)
+        return _RemotePeer([sys.executable, entry, 'sync-serve', repo.path])
+
+    repo.recover()
+    return _SyncPeer(repo)
+
+
+def sync_repositories(source, target, patterns=None, jobs=1, progress=None, remote_rms='rms'):
+    """
+    Copy the tagged files missing in the target repository from the source repository. The target sends a summary
+    of the hash files and chunks it holds and only the missing ones are streamed from the source with their
+    descriptions and stored in batches with their tags. The tags of files the target had already are added at the
+    end. The older versions of files stored by update are copied with them. Tags which exist in the target with
+    another file are kept and reported. An interrupted sync resumes where it stopped: hash files already received
+    are not sent again and the one received partly is continued.
+    :param source: str location, see _open_peer
+    :param target: str location
+    :param patterns: list of shell patterns of the tags to copy or None for all tags
+    :param jobs: int number of hash file streams at once. Each runs over its own connections, local repositories
+                 are served by processes then. The missing chunks are split among the streams and sent before the
+                 hash files.
+    :param progress: function called with the number of copied hash files and the total
+    :param remote_rms: str command running rms on ssh hosts
+    :return: SyncResult
+    """
+    import threading
+
+    peers = []
+
+    try:
+        peers.append(_open_peer(source, remote_rms))
+        peers.append(_open_peer(target, remote_rms))
+        src, dst = peers
+
+        with _trace('summary', 'io'):
+            tags = src.tags(patterns)
+            existing = dst.tags()
+            hashes, chunks, partial = dst.contents()
+
+        conflicts = sorted(tagname for tagname, sha1 in tags.items() if existing.get(tagname, sha1) != sha1)
+        tags = {tagname: sha1 for tagname, sha1 in tags.items() if tagname not in existing}
+        missing = set(tags.values()) - hashes
+        # The older versions of updated files come with them
+        missing = sorted(missing.union(*src.versions(sorted(missing)).values()) - hashes)
+        names = collections.defaultdict(list)
+        for tagname, sha1 in sorted(tags.items()):
+            names[sha1].append(tagname)
+        lock = threading.Lock()
+        done = [0]
+
+        def counted(records):
+            for header, pieces in records:
+                if header['kind'] == 'object':
+                    header['tags'] = names[header['sha1']]
+                yield header, pieces
+                if header['kind'] == 'object':
+                    with lock:
+                        done[0] += 1
+                        if progress:
+                            progress(done[0], len(missing))
+
+        def transfer(part, reader, writer, present):
+            offsets = {sha1: partial[sha1] for sha1 in part if sha1 in partial}
+            return writer.write(counted(reader.read(part, offsets, present)))
+
+        def send_chunks(part, reader, writer):
+            return writer.write(reader.read_chunks(part)) if part else (0, 0, 0, [], [])
+
+        parts = [missing[i::jobs] for i in range(min(max(jobs, 1), len(missing)))]
+
+        with _trace('transfer', 'io', files=len(missing), jobs=len(parts)):
+            if len(parts) > 1:
+                from concurrent.futures import ThreadPoolExecutor
+
+                # Files of several streams share chunks. Each missing chunk is sent by one stream before the files.
+                needed = sorted(src.chunks(missing) - chunks)
+                chunk_parts = [needed[i::len(parts)] for i in range(len(parts))]
+                present = chunks.union(needed)
+                streams = []
+
+                try:
+                    # fcntl locks belong to the process, so the writers of several threads can not share one
+                    for _ in parts:
+                        streams.append(_open_peer(source, remote_rms, process=True))
+                        streams.append(_open_peer(target, remote_rms, process=True))
+                    readers, writers = streams[0::2], streams[1::2]
+                    with ThreadPoolExecutor(len(parts)) as pool:
+                        results = list(pool.map(send_chunks, chunk_parts, readers, writers))
+                        results += pool.map(transfer, parts, readers, writers, [present] * len(parts))
+                finally:
+                    for peer in streams:
+                        peer.close()
+            else:
+                results = [transfer(part, src, dst, chunks) for part in parts]
+
+        linked = [tagname for r in results for tagname in r[3]]
+        taken = [tagname for r in results for tagname in r[4]]
+        stored = set(linked + taken)
+        tags = {tagname: sha1 for tagname, sha1 in tags.items() if tagname not in stored}
+
+        with _trace('link', 'io', tags=len(tags)):
+            # Tags taken in the target meanwhile are reported as conflicts
+            new, conflicted = dst.link(tags) if tags else ([], [])
+
+        return SyncResult(sum(r[0] for r in results), sum(r[1] for r in results), sum(r[2] for r in results),
+                          sorted(linked + new), sorted(conflicts + taken + conflicted))
+    finally:
+        for peer in peers:
+            peer.close()
+
+
+def _checkRepo():
+    """
+    Open the repository set by the RMS environment variable
+    :return: Repository
+    """
+    repo = _get_repo_path()
+
+    if repo is None:
+        sys.exit("RMS is not set! Run 'rms init' before to create a rms repository.")
+
+    repo = Repository(repo)
+
+    replayed = repo.recover()
+    if replayed:
+        print("Completed {} interrupted operations".format(replayed), file=sys.stderr)
+
+    if 'migrate_from' in repo.config():
+        print("The migration of the repository was interrupted. Run 'rms migrate {}' to complete it".format(
+            'sharded' if repo.config().get('shards') else 'flat'), file=sys.stderr)
+
+    return repo
+
+
+def empty(args):
+    """
+    Print help lines if no arguments
+    :param args: dict
+    :return: None
+    """
+    args.p.print_help()
+
+
+def init(args):
+    """
+    Initiate a new repository
+    :param args: dict
     :return: None
     """
     try:
-        os.makedirs(os.path.join(args.path, ".rms", "data"))
-        os.makedirs(os.path.join(args.path, ".rms", "tags"))
-        os.makedirs(os.path.join(args.path, ".rms", "desc"))
+        Repository.create(args.path, args.codec, args.layout == 'sharded')
         print("Create new repository at {}".format(os.path.join(args.path,".rms")))
         print("Add this RMS={} to your .profile file".format(os.path.join(args.path, ".rms")))
     except FileExistsError:
         print("Repository {} already exists".format(os.path.join(args.path, ".rms")), file=sys.stderr)
         print("Add this RMS={} to your .profile file".format(os.path.join(args.path, ".rms")), file=sys.stderr)
+    except RepositoryError:
+        raise
     except:
         print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
         raise
 
+
+def _print_tags(tags, format):
+    """
+    Print tags with their hash file names
+    :param tags: list of (sha1, tag) tuples
+    :param format: str text, json or tsv
+    :return: None
+    """
+    if format == 'json':
+        json.dump([{'tag': t, 'sha1': sha1} for sha1, t in tags], sys.stdout, indent=2)
+        print()
+    elif format == 'tsv':
+        for sha1, t in tags:
+            print("{}\t{}".format(t, sha1))
+    else:
+        for sha1, t in tags:
+            print(sha1, t)
+
+
 def show(args):
     """
     Show repository content
@@ -404,85 +5508,291 @@ def show(args):
     """
     repo = _checkRepo()
 
-    repo_hashes = _get_repo_hashes()
-    #print(repo_hashes)
-    print(_get_tags_inodes())
-    #print(_get_repo_tags())
+    tags = repo.list_tags(args.glob)
 
-    inodes = _get_tags_inodes()
-    for key in inodes:
-        for tag in inodes[key]:
-            print(_get_data_tag(tag), tag)
+    _print_tags(tags, args.format)
 
+    if args.format == 'text':
+        files, logical, chunks, unique, stored = repo.chunk_stats()
+        if files:
+            print("Chunk store: {} files with {:.1f} MB in {} unique chunks with {:.1f} MB ({:.1f} MB on disk). "
+                  "Dedup ratio {:.2f}".format(files, logical / 1e6, chunks, unique / 1e6, stored / 1e6,
+                                               logical / max(unique, 1)))
 
-def add(args):
+
+def search(args):
     """
-    Add new files or tag names
+    Search files by their descriptions
     :param args: dict
     :return: None
     """
     repo = _checkRepo()
-    args.file = os.path.expanduser(args.file)
 
-    try:
-        mime = magic.from_file(args.file, mime=True)
-    except FileNotFoundError:
-        sys.exit("No such File: '{}'".format(args.file))
-    except:
-        print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
-        raise
+    where = []
+    for condition in args.where or []:
+        key, sep, value = condition.partition('=')
+        if not sep:
+            sys.exit("'{}' is not a KEY=VALUE condition".format(condition))
+        where.append((key, value))
 
-    repo_hashes = _get_repo_hashes()
+    _print_tags(repo.search(" ".join(args.query), where, args.since, args.until), args.format)
 
-    filename = os.path.basename(args.file)
 
-    # check mime type if text
-    if b"text" in mime:
-        print("File is from type '{}' and will be compressed.".format(mime))
+def verify(args):
+    """
+    Check the content, tags and descriptions of the repository
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    start = time.time()
 
-        compressed = None
+    def progress(done, total):
+        if sys.stderr.isatty():
+            print("\r{}/{} files".format(done, total), end='', file=sys.stderr)
 
-        with open(args.file, "rb") as f:
-            compressed = zlib.compress(f.read(), 9)
+    result = repo.verify(args.jobs, args.full, progress)
 
-        # get sha1 sum
-        sha1 = _get_string_sha1(compressed)
+    if result.checked and sys.stderr.isatty():
+        print(file=sys.stderr)
 
-        # check if file is still in the repo
-        if sha1 in repo_hashes:
-            print("File is already in the repository. Add file name as tag. Description is discarded. Use 'rms set {\"Description\":\"Message\"}' to update the description section.")
+    for sha1 in result.corrupt:
+        print("Hash file {} does not match its content".format(sha1))
+    for tag in result.dangling_tags:
+        print("Tag {} has no hash file".format(tag))
+    for sha1 in result.orphan_descs:
+        print("Description {} has no hash file".format(sha1))
+    for sha1 in result.untagged:
+        print("Hash file {} has no tags".format(sha1))
+    for sha1, listed, linked in result.out_of_sync:
+        if listed is None:
+            print("Hash file {} with the tags {} has no description".format(sha1, ", ".join(linked)))
         else:
-            # write zipped file
-            with open(os.path.join(repo, "data", sha1), 'wb') as f:
-                f.write(compressed)
-    else:
-        # get sha1 sum
-        sha1 = _get_file_sha1(args.file)
+            print("Description {} lists the tags {} instead of {}".format(sha1, ", ".join(listed), ", ".join(linked)))
 
-        # check if file is still in the repo
-        if sha1 in repo_hashes:
-            print("File is already in the repository. Add file name as tag. Description is discarded. Use 'rms set {\"Description\":\"Message\"}' to update the description section.")
-        else:
-            shutil.copy2(args.file, os.path.join(repo, "data", sha1))
+    print("Verified {} hash files ({} unchanged since the last run) in {:.1f} s".format(
+        result.checked + result.cached, result.cached, time.time() - start))
+
+    problems = sum(len(p) for p in result[2:])
+    if problems:
+        sys.exit("{} problems found".format(problems))
+
+
+def migrate(args):
+    """
+    Convert the repository to another directory layout
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    start = time.time()
+
+    def progress(done, total):
+        if sys.stderr.isatty():
+            print("\r{}/{} files".format(done, total), end='', file=sys.stderr)
+
+    moved = repo.migrate(args.layout == 'sharded', progress)
+
+    if moved and sys.stderr.isatty():
+        print(file=sys.stderr)
+
+    print("Moved {} files to the {} layout in {:.1f} s".format(moved, args.layout, time.time() - start))
+
+
+def gc(args):
+    """
+    Remove hash files without tags and other unreferenced files
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    result = repo.gc(args.dry_run, args.min_age)
+    verb = "Would remove" if args.dry_run else "Removed"
+
+    for sha1 in result.blobs:
+        print("{} hash file {} without tags".format(verb, sha1))
+    for sha1 in result.descs:
+        print("{} description {} without hash file".format(verb, sha1))
+    for path in result.stray:
+        print("{} {}".format(verb, path))
+
+    print("{} {} hash files, {} descriptions, {} chunks, {} cached renderings and {} other files ({:.1f} MB)".format(
+        verb, len(result.blobs), len(result.descs), len(result.chunks), len(result.renders), len(result.stray),
+        result.size / 1e6))
+
+
+def repack(args):
+    """
+    Move small files into pack files and rewrite sparse packs
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    start = time.time()
+
+    def progress(done, total):
+        if sys.stderr.isatty():
+            print("\r{}/{} files".format(done, total), end='', file=sys.stderr)
+
+    result = repo.repack(args.max_size, args.pack_size, progress)
+
+    if result.packed and sys.stderr.isatty():
+        print(file=sys.stderr)
+
+    print("Packed {} files with {} tags, rewrote {} packs with {} files ({:.1f} MB freed) in {:.1f} s".format(
+        result.packed, result.tags, len(result.removed), result.repacked, result.freed / 1e6, time.time() - start))
+
+
+def du(args):
+    """
+    Show the space used by the repository
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    usage = repo.usage()
+    files, chunked, chunks, unique, chunk_stored = usage.chunks
+
+    if args.format == 'json':
+        json.dump(dict(usage._asdict(), chunks={'files': files, 'logical': chunked, 'chunks': chunks,
+                                                'unique': unique, 'stored': chunk_stored}),
+                  sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    def ratio(logical, stored):
+        return logical / stored if stored else 0
+
+    print("{} hash files with {:.1f} MB of content stored in {:.1f} MB (ratio {:.2f})".format(
+        usage.files, usage.logical / 1e6, usage.stored / 1e6, ratio(usage.logical, usage.stored)))
+    print("Tags refer to {:.1f} MB, deduplication saves {:.1f} MB".format(usage.tagged / 1e6, usage.saved / 1e6))
+    if files:
+        print("Chunk store: {:.1f} MB of chunked files in {:.1f} MB of unique chunks ({:.1f} MB on disk), "
+              "deduplication saves {:.1f} MB".format(chunked / 1e6, unique / 1e6, chunk_stored / 1e6,
+                                                     (chunked - unique) / 1e6))
+    print("Descriptions, indexes and caches: {:.1f} MB".format(usage.overhead / 1e6))
+
+    for title, groups in (("codec", usage.by_codec), ("type", usage.by_mime)):
+        print()
+        print("{:<28} {:>7} {:>12} {:>12} {:>7}".format(title, "files", "content MB", "stored MB", "ratio"))
+        for name, (count, logical, stored) in sorted(groups.items(), key=lambda g: -g[1][2]):
+            print("{:<28} {:>7} {:>12.1f} {:>12.1f} {:>7.2f}".format(name, count, logical / 1e6, stored / 1e6,
+                                                                    ratio(logical, stored)))
+
+
+def serve(args):
+    """
+    Serve the repository read only over HTTP until interrupted
+    :param args: dict
+    :return: None
+    """
+    import asyncio
+
+    repo = _checkRepo()
+
+    print("Serving {} on http://{}:{}/".format(repo.path, args.host, args.port), file=sys.stderr)
+    asyncio.run(_Server(repo).serve(args.host, args.port))
+
+
+def sync(args):
+    """
+    Copy the files missing in a repository from another one
+    :param args: dict
+    :return: None
+    """
+    start = time.time()
+
+    def progress(done, total):
+        if sys.stderr.isatty():
+            print("\r{}/{} files".format(done, total), end='', file=sys.stderr)
+
+    result = sync_repositories(args.source, args.target, args.tag, args.jobs, progress, args.remote_rms)
+
+    if result.files and sys.stderr.isatty():
+        print(file=sys.stderr)
+
+    for tagname in result.conflicts:
+        print("Tag '{}' exists in the target with another file".format(tagname), file=sys.stderr)
+
+    print("Copied {} files, {} chunks ({:.1f} MB) and {} tags in {:.1f} s".format(
+        result.files, result.chunks, result.bytes / 1e6, len(result.tags), time.time() - start))
+
+
+def sync_serve(args):
+    """
+    Serve a repository to rms sync over stdin and stdout
+    :param args: dict
+    :return: None
+    """
+    repo = Repository(args.path)
+    repo.recover()
 
-    # add hardlink
     try:
-        os.link(os.path.join(repo, "data", sha1), os.path.join(repo, "tags", os.path.basename(args.file)))
+        _serve_sync(repo, sys.stdin.buffer, sys.stdout.buffer)
+    except BrokenPipeError:
+        raise RepositoryError("The sync connection was closed")
 
-        # update json_desc
-        json_data = _get_json_by_tag(filename)
-        json_data['tags'].append(filename)
-        json_data['Description'] = args.description
 
-        # Create json object
-        with open(os.path.join(repo, "desc", sha1), 'w') as f_w:
-            json.dump(json_data, f_w)
+def reindex(args):
+    """
+    Rebuild the tag index
+    :param args: dict
+    :return: None
+    """
+    print("Indexed {} tags".format(_checkRepo().reindex()))
+
 
-    except FileExistsError:
-        pass # This error is okay
-    except:
-        print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
-        raise
+def add(args):
+    """
+    Add new files or tag names
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    files = _collect_files(args.file, args.from_file, args.description)
+    batch = len(files) > 1
+    start = time.time()
+
+    def progress(done, total):
+        if batch and sys.stderr.isatty():
+            print("\r{}/{} files".format(done, total), end='', file=sys.stderr)
+
+    results = repo.add(files, codec=args.codec, chunked=args.chunked, seekable=args.seekable, jobs=args.jobs,
+                       progress=progress, known=not args.rehash, confirm=args.confirm)
+
+    if batch and sys.stderr.isatty():
+        print(file=sys.stderr)
+
+    missing = [r for r in results if r.sha1 is None]
+
+    for r in missing:
+        if not batch:
+            sys.exit("No such File: '{}'".format(r.file))
+        print("No such File: '{}'".format(r.file), file=sys.stderr)
+
+    if not batch:
+        r = results[0]
+        if r.chunks is not None:
+            print("File is split into {} chunks.".format(len(r.chunks)))
+        elif r.blob['codec'] != 'none':
+            print("File is from type '{}' and will be compressed with {}.".format(r.mime, r.blob['codec']))
+        if not r.new:
+            print("File is already in the repository. Add file name as tag. Description is discarded. Use 'rms set {\"Description\":\"Message\"}' to update the description section.")
+    else:
+        elapsed = time.time() - start
+        size = sum(r.size for r in results)
+        print("Added {} files ({} new, {} tags) {:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(
+            len(results) - len(missing), sum(r.new for r in results), sum(r.tagged for r in results),
+            size / 1e6, elapsed, size / 1e6 / max(elapsed, 1e-6)))
+
+    if missing:
+        sys.exit("{} files could not be found".format(len(missing)))
 
 
 def rm(args):
@@ -495,33 +5805,13 @@ def rm(args):
 
     filename = args.file # No path allowed only filename
 
-    sha1 = _get_data_tag(filename)
-
-    try:
-        # Remove the tag
-        os.remove(os.path.join(repo, "tags", filename))
-    except FileExistsError:
-        sys.exit("Tag name '{}' does not exist".format(filename))
-    except:
-        print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
-        raise
+    tags = repo.remove(filename)
 
-    # Get inode count
-    if os.lstat(os.path.join(repo, "data", sha1)).st_nlink == 1:
+    if not tags:
         print("No tags for '{}' do exist. Remove file and its description file from the repository".format(filename))
-        # Remove also the data file
-        os.remove(os.path.join(repo, "data", sha1))
-        os.remove(os.path.join(repo, "desc", sha1))
     else:
-        json_data = _get_json_by_sha1(sha1)
-        json_data['tags'].remove(filename)
-
-        # Save json object
-        with open(os.path.join(repo, "desc", sha1), 'w') as f_w:
-            json.dump(json_data, f_w)
-
         print("Following tags are still existing")
-        for tag in json_data['tags']:
+        for tag in tags:
             print(tag)
 
 
@@ -533,67 +5823,74 @@ def get(args):
     """
     repo = _checkRepo()
 
-    tags = _get_repo_tags()
-
     filename = os.path.basename(args.file)
 
-    if os.path.isfile(os.path.expanduser(args.target)):
-        sys.exit("File already exists at {}".format(os.path.join(os.path.expanduser(args.target))))
-
-    if filename in tags:
-        src = os.path.join(repo, "tags", filename)
-        dst = os.path.expanduser(args.target)
-        try:
-            # if compressed decompress it
-            if magic.from_file(src, mime=True) == b'application/octet-stream':
-                with open(src, 'rb') as f_r:
-                    with open(dst, 'wb') as f_w:
-                        f_w.write(zlib.decompress(f_r.read()))
-            else:
-                shutil.copy2(src, dst)
-        except PermissionError:
-            print("You have no write permissions at {}".format(os.path.expanduser(args.target)), file=sys.stderr)
-        except:
-            print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
-            raise
+    try:
+        repo.get(filename, sys.stdout.buffer if args.target == '-' else args.target, args.link, args.version)
+    except BrokenPipeError:
+        # The reading end of the pipe was closed. Avoid another error while flushing stdout at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except PermissionError:
+        print("You have no write permissions at {}".format(os.path.expanduser(args.target)), file=sys.stderr)
+    except RepositoryError:
+        raise
+    except:
+        print("Unexpected error: {}".format(sys.exc_info()[0]), file=sys.stderr)
+        raise
 
 
-def tag(args):
+def update(args):
     """
-    Add new tag names for files in repository
+    Store a new version of a file
     :param args: dict
     :return: None
     """
     repo = _checkRepo()
 
-    tags = _get_repo_tags()
+    r = repo.update(os.path.basename(args.file), args.path, args.description, args.codec)
 
-    filename = os.path.basename(args.file)
+    if not r.updated:
+        print("'{}' is unchanged at version {}".format(r.tag, r.version))
+    elif not r.new:
+        print("Updated '{}' to version {}. The content is already in the repository.".format(r.tag, r.version))
+    else:
+        print("Updated '{}' to version {} stored {} ({:.1f} MB of {:.1f} MB)".format(
+            r.tag, r.version, 'as delta' if r.delta else 'in full', r.stored / 1e6, r.size / 1e6))
 
-    sha1 = _get_data_tag(filename)
 
-    if filename in tags:
-        if args.new_tag:
-            try:
-                os.link(os.path.join(repo, "tags", filename),
-                        os.path.join(repo, "tags", os.path.basename(args.new_tag)))
+def cat(args):
+    """
+    Write a range of a file from the repository to stdout
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
 
-                json_data = _get_json_by_tag(filename)
-                json_data['tags'].append(args.new_tag)
+    try:
+        for data in repo.iter_range(os.path.basename(args.file), args.offset, args.length):
+            sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        # The reading end of the pipe was closed. Avoid another error while flushing stdout at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
-                with open(os.path.join(repo, "desc", sha1), 'w') as f_w:
-                    json.dump(json_data, f_w)
 
-            except FileExistsError:
-                print("Tag is already set")  # This error is okay
-            except:
-                sys.exit("Unexpected error: {}".format(sys.exc_info()[0]))
+def tag(args):
+    """
+    Add new tag names for files in repository
+    :param args: dict
+    :return: None
+    """
+    repo = _checkRepo()
+
+    filename = os.path.basename(args.file)
 
-        inodes = _get_tags_inodes()
+    if args.new_tag and not repo.add_tag(filename, args.new_tag):
+        print("Tag is already set")  # This error is okay
 
-        print("Available tag names for file {}".format(filename))
-        for tag in inodes[os.lstat(os.path.join(repo, "tags", filename)).st_ino]:
-            print(tag)
+    print("Available tag names for file {}".format(filename))
+    for tag in repo.aliases(filename):
+        print(tag)
 
 
 def desc(args):
@@ -604,43 +5901,41 @@ def desc(args):
     """
     repo = _checkRepo()
 
-    filename = os.path.basename(args.file)
+    if args.render_all:
+        start = time.time()
+
+        def progress(done, total):
+            if sys.stderr.isatty():
+                print("\r{}/{} descriptions".format(done, total), end='', file=sys.stderr)
+
+        result = repo.render_all(args.render_all, args.format, args.file, args.jobs, progress)
+
+        if result.tags and sys.stderr.isatty():
+            print(file=sys.stderr)
 
-    sha1 = _get_data_tag(filename)
+        print("Rendered {} descriptions ({} converted, {} written) in {:.1f} s".format(
+            len(result.tags), len(result.converted), len(result.written), time.time() - start))
+        return
+
+    if args.file is None:
+        sys.exit("No file given")
+
+    filename = os.path.basename(args.file)
 
     if args.output:
         f = args.output
     else:
         f = sys.stdout.buffer
 
-    json_data = _get_json_by_tag(filename)
-    #with open(os.path.join(repo, "desc", _get_data_tag(filename)), 'r') as f_r:
-    #    json_data = json.loads(f_r.read())
+    json_data = repo.get_desc(filename)
 
     if args.keys:
         for key in json_data:
             print(key)
     elif args.clear:
-        json_data_new = {'tags':[],'repo_date':json_data['repo_date']}
-        with open(os.path.join(repo, "desc", sha1), 'w') as f_w:
-            json.dump(json_data_new, f_w)
+        repo.clear_desc(filename)
     elif args.get is None and args.set is None:
-        if args.format == Format(1).name: # markdown
-            f.write(_get_markdown(json_data, filename).encode('utf-8'))
-        elif args.format == Format(2).name: # html5
-            header = '<!DOCTYPE html><html><head><meta charset="UTF-8"><title>{}</title></head><body>'.format(filename)
-            footer = '</body></html>'
-            f.write((header + markdown(_get_markdown(json_data, filename), output_format='html5') + footer).encode('utf-8'))
-        elif args.format == Format(3).name: # pdf
-            options = {
-                'page-size': 'A4',
-                'encoding': "UTF-8"
-            }
-            f.write(pdfkit.from_string(markdown(_get_markdown(json_data, filename), output_format='html4'), False, options=options))
-        elif args.format == Format(4).name: # json
-            f.write(json.dumps(json_data,sort_keys=True, indent=2).encode('utf-8'))
-        else:
-            print("Unknown output format: {}".format(args.format), file=sys.stderr)
+        f.write(repo.render(filename, args.format))
     elif args.get:
         if args.get in json_data:
             if isinstance(json_data[args.get], list):
@@ -660,64 +5955,8 @@ def desc(args):
             except:
                 sys.exit("{} is not a json file nor a json string".format(args.set))
 
-
-        _dict_update(json_data, json_new)
-
-        with open(os.path.join(repo, "desc", sha1), 'w') as f_w:
-            json.dump(json_data, f_w)
+        repo.set_desc(filename, json_new)
 
 
 if __name__ == "__main__":
-    if DEBUG:
-        pass
-        #sys.argv.append("-V")
-        # sys.argv.append("init")
-
-        #sys.argv.append("add")
-        #sys.argv.append("../test/app")
-        #sys.argv.append("~/targets.ods")
-        #sys.argv.append("This file is a simple test file from the file text. It is only here to test rms functionality.")
-
-        #sys.argv.append("rm")
-        #sys.argv.append(".bashrc")
-
-
-        #sys.argv.append("get")
-        #sys.argv.append("text")
-        #sys.argv.append("~/test2")
-
-        #sys.argv.append("tag")
-        #sys.argv.append("app")
-        #sys.argv.append("-n")
-        #sys.argv.append("cp4")
-
-        #sys.argv.append("desc")
-        #sys.argv.append("app")
-        #sys.argv.append("-g")
-        #sys.argv.append("Description")
-        #sys.argv.append("-f")
-        #sys.argv.append("markdown")
-        #sys.argv.append("-o")
-        #sys.argv.append("/home/nauer/test.pdf")
-        # sys.argv.append("-k")
-
-       # sys.argv.append("--set")
-        #sys.argv.append('../test/test.json')
-
-        # sys.argv.append("-h")
-
-    if TESTRUN:
-        import doctest
-        doctest.testmod()
-    if PROFILE:
-        import cProfile
-        import pstats
-        profile_filename = 'linegrep_profile.txt'
-        cProfile.run('main()', profile_filename)
-        statsfile = open("profile_stats.txt", "wb")
-        p = pstats.Stats(profile_filename, stream=statsfile)
-        stats = p.strip_dirs().sort_stats('cumulative')
-        stats.print_stats()
-        statsfile.close()
-        sys.exit(0)
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())